@@ -0,0 +1,150 @@
+import re
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import List, Optional, Union
+
+import asyncpg
+import orjson
+
+from extract import (AGGREGATED_DETAILS_QUERY, FLAT_DETAILS_QUERY,
+                     RELATED_QUERIES, UPDATED_PAGE_QUERY, BatchSizer,
+                     PostgresMerger, PostgresProducer)
+from state_manager import Cursor, NIL_UUID, State
+from utils import async_backoff
+
+# Минимальная дата для пустого курсора (timestamptz требует tz)
+MIN_UPDATED_AT = datetime.min.replace(tzinfo=timezone.utc)
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """
+    Кодеки, приводящие строки asyncpg к тому же виду, что и psycopg2:
+    uuid - строкой, json - разобранным объектом
+    """
+    await conn.set_type_codec('uuid', schema='pg_catalog', format='text',
+                              encoder=str, decoder=str)
+    for json_type in ('json', 'jsonb'):
+        await conn.set_type_codec(json_type, schema='pg_catalog',
+                                  encoder=lambda value: orjson.dumps(
+                                      value).decode(),
+                                  decoder=orjson.loads)
+
+
+async def create_async_pool(connection_params: dict,
+                            max_size: int = 5) -> asyncpg.Pool:
+    """
+    Пул соединений asyncpg с параметрами из PostgresConfig
+    """
+    return await asyncpg.create_pool(
+        host=connection_params['host'],
+        port=connection_params['port'],
+        database=connection_params['dbname'],
+        user=connection_params['user'],
+        password=connection_params['password'],
+        min_size=1,
+        max_size=max_size,
+        init=init_connection)
+
+
+@lru_cache(maxsize=None)
+def to_asyncpg_query(query: str) -> str:
+    """
+    Замена плейсхолдеров psycopg2 (%s) на нумерованные ($1, $2, ...)
+    """
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', query)
+
+
+def to_timestamp(value: Union[str, datetime, None]) -> datetime:
+    """
+    asyncpg принимает для timestamptz только datetime
+    """
+    if value is None:
+        return MIN_UPDATED_AT
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class AsyncPostgresBase:
+    """
+    Базовый класс для работы с Postgres через asyncpg
+    """
+
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self.pool = pool
+
+    @async_backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+                   breaker='postgres')
+    async def _fetch_data(self, query, params) -> list:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(to_asyncpg_query(query), *params)
+
+
+class AsyncPostgresInricher(AsyncPostgresBase):
+    """
+    Асинхронное получение фильмов, связанных с персонами и жанрами
+    """
+
+    async def fetch_related_page(self, stream: str, ids: List[str],
+                                 after: Optional[Cursor],
+                                 limit: int) -> list:
+        after = after or Cursor(None, None)
+        return await self._fetch_data(RELATED_QUERIES[stream], (
+            [str(id) for id in ids], to_timestamp(after.updated_at),
+            after.id or NIL_UUID, limit))
+
+
+class AsyncPostgresMerger(AsyncPostgresBase):
+    """
+    Асинхронное получение подробной информации о фильмах
+    """
+
+    def __init__(self, pool: asyncpg.Pool, mode: str = 'flat') -> None:
+        super().__init__(pool)
+        if mode not in PostgresMerger.MODES:
+            raise ValueError(f'Unknown merger mode: {mode}')
+        self.mode = mode
+
+    async def fetch_film_work_details(self,
+                                      film_work_ids: List[str]) -> list:
+        query = (AGGREGATED_DETAILS_QUERY if self.mode == 'aggregated'
+                 else FLAT_DETAILS_QUERY)
+        return await self._fetch_data(query,
+                                      ([str(id) for id in film_work_ids],))
+
+
+class AsyncPostgresProducer(AsyncPostgresBase):
+    """
+    Асинхронное получение обновленных ID по курсору (updated_at, id)
+    """
+
+    def __init__(self, pool: asyncpg.Pool,
+                 state_manager: State,
+                 batch_size: int = 100,
+                 max_batch_size: Optional[int] = None,
+                 latency_target: Optional[float] = None) -> None:
+        super().__init__(pool)
+        self.state_manager = state_manager
+        self.sizer = BatchSizer(batch_size, max_batch_size, latency_target)
+
+    def has_backlog(self, stream: Optional[str] = None) -> bool:
+        return self.sizer.has_backlog(stream)
+
+    async def fetch_updated(self, stream: str,
+                            cursor: Optional[Cursor] = None) -> list:
+        """
+        Получение следующей страницы обновлений после курсора потока
+        """
+        if cursor is None:
+            cursor = self.state_manager.get_cursor(stream)
+        limit = self.sizer.limit(stream)
+        query = UPDATED_PAGE_QUERY.format(
+            table=PostgresProducer.TABLES[stream])
+        started = time.monotonic()
+        rows = await self._fetch_data(query, (
+            to_timestamp(cursor.updated_at), cursor.id or NIL_UUID, limit))
+        self.sizer.update(stream, limit, len(rows),
+                          time.monotonic() - started)
+        return rows
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from elasticsearch import (ApiError, AsyncElasticsearch,
+                           ConnectionError as ESConnectionError)
+
+from deadletter import DeadLetterStore
+from fingerprints import FingerprintStore
+from load import (BulkLine, LoadReport, collect_bulk_items,
+                  count_load_report, iter_bulk_chunks, log_load_report,
+                  save_fingerprints, skip_unchanged)
+from metrics import count_retry
+from resilience import (BulkThrottle, get_breaker, is_pressure, is_retryable,
+                        jittered_delay)
+
+
+class AsyncElasticsearchLoader:
+    """
+    Асинхронная загрузка в Elasticsearch.
+
+    Чанки режутся так же, как в потоковом режиме ElasticsearchLoader,
+    до `concurrency` bulk-запросов выполняются одновременно,
+    повторяются только отклонённые (429) документы. Размер чанка
+    и число запросов в полёте регулирует тот же BulkThrottle.
+    """
+
+    def __init__(self, es_host: str,
+                 chunk_size: int = 500,
+                 max_chunk_bytes: int = 10 * 1024 * 1024,
+                 concurrency: int = 4,
+                 max_retries: int = 5,
+                 initial_backoff: float = 0.5,
+                 max_backoff: float = 10.0,
+                 fingerprints: Optional[FingerprintStore] = None,
+                 dead_letters: Optional[DeadLetterStore] = None,
+                 throttle: Optional[BulkThrottle] = None) -> None:
+        self.es = AsyncElasticsearch(es_host)
+        self.logger = logging.getLogger('elasticsearch_loader')
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.fingerprints = fingerprints
+        self.dead_letters = dead_letters
+        self.throttle = throttle or BulkThrottle(chunk_size, concurrency)
+        self.breaker = get_breaker('elasticsearch')
+        self.last_report = LoadReport()
+        # Общий для всех потоков лимит одновременных bulk-запросов;
+        # лимит меняется, поэтому вместо семафора - счётчик и условие
+        self._active = 0
+        self._slots = asyncio.Condition()
+
+    async def close(self) -> None:
+        await self.es.close()
+
+    async def bulk_load(self, index: str,
+                        data: List[Dict[str, Any]]) -> int:
+        """
+        Загрузка данных в Elasticsearch
+        """
+        # Запросы к SQLite короткие, цикл событий они не задерживают
+        changed, hashes = skip_unchanged(self.fingerprints, index, data,
+                                         self.logger)
+        report = await self.streaming_load(index, changed)
+        if self.dead_letters is not None:
+            self.dead_letters.add_failed(index, report.failed, changed)
+        report.skipped = len(data) - len(changed)
+        save_fingerprints(self.fingerprints, index, hashes, report)
+        count_load_report(report)
+        return report.indexed
+
+    async def streaming_load(self, index: str,
+                             data: Iterable[Dict[str, Any]]) -> LoadReport:
+        started = time.monotonic()
+        report = LoadReport()
+        results = await asyncio.gather(*(
+            self._send_chunk(chunk)
+            for chunk in iter_bulk_chunks(index, data,
+                                          self.throttle.chunk_size,
+                                          self.max_chunk_bytes)))
+        for result in results:
+            report.merge(result)
+        report.elapsed = time.monotonic() - started
+        self.last_report = report
+        if report.requests:
+            log_load_report(self.logger, report)
+        return report
+
+    async def _send_chunk(self, chunk: List[BulkLine]) -> LoadReport:
+        """
+        Отправка чанка с повтором только отклонённых документов
+        """
+        report = LoadReport()
+        delay = self.initial_backoff
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                report.retried += len(chunk)
+                count_retry('AsyncElasticsearchLoader.bulk')
+                await asyncio.sleep(jittered_delay(delay))
+                delay = min(delay * 2, self.max_backoff)
+            while wait_time := self.breaker.retry_after():
+                await asyncio.sleep(wait_time)
+
+            body = b''.join(lines for _, lines in chunk)
+            report.requests += 1
+            report.bytes_sent += len(body)
+            await self._acquire()
+            started = time.monotonic()
+            try:
+                response = await self.es.bulk(operations=body)
+            except (ApiError, ESConnectionError) as e:
+                self.breaker.record_error(e)
+                if is_pressure(e):
+                    self.throttle.observe(time.monotonic() - started, True)
+                    report.rejected += len(chunk)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                self.logger.info('Bulk request failed: %s. Retrying in %s '
+                                 'seconds...', e, delay)
+                continue
+            finally:
+                await self._release()
+            self.breaker.record_success()
+
+            rejected = report.rejected
+            chunk = collect_bulk_items(chunk, response['items'], report)
+            self.throttle.observe(time.monotonic() - started,
+                                  report.rejected > rejected)
+            if not chunk:
+                return report
+
+        report.failed.extend((doc_id, 'rejected: retries exhausted')
+                             for doc_id, _ in chunk)
+        return report
+
+    async def _acquire(self) -> None:
+        async with self._slots:
+            await self._slots.wait_for(
+                lambda: self._active < self.throttle.concurrency)
+            self._active += 1
+
+    async def _release(self) -> None:
+        async with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
@@ -0,0 +1,181 @@
+"""
+Асинхронный движок ETL на asyncpg и AsyncElasticsearch.
+
+Потоки изменений фильмов, персон и жанров обрабатываются
+одновременно, формат состояния и преобразование общие с
+синхронным движком. Включается ETL_ENGINE=async или запуском
+из каталога etl:
+
+    python async_main.py
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from async_extract import (AsyncPostgresInricher, AsyncPostgresMerger,
+                           AsyncPostgresProducer, create_async_pool)
+from async_load import AsyncElasticsearchLoader
+from deadletter import configure_dead_letters, get_dead_letters
+from fanout import FanOut, FanOutJob
+from settings import (create_bulk_throttle, create_dead_letters,
+                      create_fingerprints, create_state_manager,
+                      elasticsearch_config, etl_config, metrics_config,
+                      postgres_config, postgres_pool_config,
+                      resilience_config)
+from metrics import count_rows, stage_timer, start_metrics_server
+from pipeline import Batch, last_cursor
+from scheduler import IdleBackoff
+from stages import checkpoint_batches
+from state_manager import State
+from transform import transform_merged
+
+logger = logging.getLogger('async_etl')
+
+
+async def extract_batch(producer: AsyncPostgresProducer,
+                        inricher: AsyncPostgresInricher,
+                        fanout: FanOut,
+                        stream: str) -> Optional[Batch]:
+    """
+    Следующая пачка фильмов потока.
+
+    Для персон и жанров это очередная порция связанных фильмов
+    по возобновляемому подкурсору FanOut, как в синхронном движке
+    """
+    job = fanout.pending(stream) if stream in FanOut.STREAMS else None
+    if job is None:
+        with stage_timer('producer'):
+            rows = await producer.fetch_updated(stream)
+        count_rows('producer', len(rows))
+        if not rows:
+            logger.info(f'No {stream} updates found.')
+            return None
+        batch = Batch(stream, last_cursor(rows), [row['id'] for row in rows])
+        if stream not in FanOut.STREAMS:
+            batch.film_ids = batch.ids
+            return batch
+        job = FanOutJob(stream, batch.ids, batch.cursor)
+    with stage_timer('inricher'):
+        rows = await inricher.fetch_related_page(stream, job.ids, job.after,
+                                                 fanout.chunk_size)
+        film_ids = fanout.advance(job, rows)
+    count_rows('inricher', len(film_ids))
+    return Batch(stream, job.cursor, job.ids, film_ids=film_ids, fanout=job)
+
+
+async def update_stream(stream: str,
+                        producer: AsyncPostgresProducer,
+                        inricher: AsyncPostgresInricher,
+                        merger: AsyncPostgresMerger,
+                        es_loader: AsyncElasticsearchLoader,
+                        state_manager: State,
+                        fanout: FanOut) -> bool:
+    """
+    Обработка одной пачки потока; возвращает False, если изменений нет
+    """
+    batch = await extract_batch(producer, inricher, fanout, stream)
+    if batch is None:
+        return False
+    with stage_timer('merger'):
+        film_work_details = await merger.fetch_film_work_details(
+            batch.film_ids)
+    count_rows('merger', len(film_work_details))
+
+    # Преобразование занимает CPU, поэтому выполняется вне цикла событий
+    dead_letters = get_dead_letters()
+    rejected = [] if dead_letters is not None else None
+    with stage_timer('transform'):
+        transformed_data = await asyncio.to_thread(
+            transform_merged, film_work_details, merger.mode,
+            etl_config.validation, rejected)
+    if rejected:
+        dead_letters.add_rejected(film_work_details, rejected)
+    count_rows('transform', len(transformed_data))
+
+    with stage_timer('load'):
+        await es_loader.bulk_load('movies', transformed_data)
+    count_rows('load', len(transformed_data))
+    checkpoint_batches(state_manager, fanout, [batch])
+    return True
+
+
+async def run_stream(stream: str,
+                     producer: AsyncPostgresProducer,
+                     inricher: AsyncPostgresInricher,
+                     merger: AsyncPostgresMerger,
+                     es_loader: AsyncElasticsearchLoader,
+                     state_manager: State,
+                     fanout: FanOut) -> None:
+    """
+    Бесконечная обработка одного потока изменений.
+
+    Потоки идут параллельно, поэтому от планировщика нужна только
+    растущая пауза простоя
+    """
+    backoff = IdleBackoff(etl_config.idle_sleep, etl_config.idle_max_sleep,
+                          etl_config.idle_backoff_factor)
+    while True:
+        try:
+            found = await update_stream(stream, producer, inricher, merger,
+                                        es_loader, state_manager, fanout)
+        except Exception as e:
+            logger.debug('Произошла ошибка во время ETL процесса: %s', e)
+            found = False
+        if found and (fanout.has_pending(stream) or (
+                etl_config.drain and producer.has_backlog(stream))):
+            backoff.reset()
+            continue
+        if found:
+            backoff.reset()
+            sleep = etl_config.idle_sleep
+        else:
+            sleep = backoff.idle()
+        state_manager.flush()
+        await asyncio.sleep(sleep)
+
+
+async def run(state_manager: State) -> None:
+    """
+    Запуск потоков фильмов, персон и жанров в одном цикле событий
+    """
+    pool = await create_async_pool(postgres_config,
+                                   postgres_pool_config.max_size)
+    producer = AsyncPostgresProducer(
+        pool, state_manager,
+        batch_size=etl_config.batch_size,
+        max_batch_size=etl_config.max_batch_size,
+        latency_target=resilience_config.pg_latency_target)
+    inricher = AsyncPostgresInricher(pool)
+    # Порции читает extract_batch через асинхронный inricher,
+    # FanOut только ведёт подкурсоры в состоянии
+    fanout = FanOut(None, state_manager,
+                    chunk_size=etl_config.fanout_chunk_size)
+    merger = AsyncPostgresMerger(pool, mode=etl_config.merger_mode)
+    dead_letters = create_dead_letters()
+    configure_dead_letters(dead_letters)
+    es_loader = AsyncElasticsearchLoader(
+        elasticsearch_config.host,
+        chunk_size=elasticsearch_config.bulk_chunk_size,
+        max_chunk_bytes=elasticsearch_config.bulk_max_chunk_bytes,
+        concurrency=elasticsearch_config.bulk_concurrency,
+        max_retries=elasticsearch_config.bulk_max_retries,
+        fingerprints=create_fingerprints(),
+        dead_letters=dead_letters,
+        throttle=create_bulk_throttle())
+
+    try:
+        await asyncio.gather(*(
+            run_stream(stream, producer, inricher, merger, es_loader,
+                       state_manager, fanout)
+            for stream in ('film', 'person', 'genre')))
+    finally:
+        await es_loader.close()
+        await pool.close()
+
+
+if __name__ == '__main__':
+    state_manager = create_state_manager()
+    if metrics_config.enabled:
+        start_metrics_server(metrics_config.port, metrics_config.host,
+                             state_manager)
+    asyncio.run(run(state_manager))
@@ -0,0 +1,275 @@
+"""
+Сквозные бенчмарки ETL на данных benchmarks.generate.
+
+Сценарии:
+- full: полная загрузка всех фильмов постранично (merge, transform,
+  load), шаг - пачка max_batch_size фильмов;
+- full_stream: полная загрузка как в reindex.py - один серверный
+  курсор и потоковый загрузчик; пиковая память не должна зависеть
+  от размера каталога;
+- steady: установившийся поток правок, --rounds раз по --touch
+  фильмов с новым updated_at; шаг - раунд от правки до полного
+  догона, то есть задержка доставки изменения в индекс;
+- renames: массовое переименование --persons персон и --genres жанров
+  с разветвлением на связанные фильмы; с --partial-updates через
+  частичное обновление индекса (имеет смысл только с настоящим
+  Elasticsearch, --es).
+
+Каждый сценарий идёт в отдельном процессе, поэтому пиковая память
+(peak MB) относится к нему одному. Без --es загрузка идёт в
+поддельный Elasticsearch (benchmarks.fake_es) в этом же процессе.
+Postgres берётся из .env. steady и renames меняют данные:
+перед сравнением с базовой линией сгенерируйте их заново с --reset.
+
+    python -m benchmarks.generate --films 100000 --reset
+    python -m benchmarks.bench_etl --save etl.json
+    python -m benchmarks.bench_etl --baseline etl.json
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from benchmarks.common import BenchResult, add_output_arguments, report
+from benchmarks.fake_es import FakeElasticsearch
+
+SCENARIOS = ('full', 'full_stream', 'steady', 'renames')
+
+TOUCH_FILMS_SQL = '''
+    UPDATE content.film_work SET updated_at = now()
+    WHERE id IN (SELECT id FROM content.film_work
+                 ORDER BY md5(id::text || %s) LIMIT %s);
+'''
+
+RENAME_SQL = '''
+    UPDATE content.{table} SET {column} = {column} || '*',
+                               updated_at = now()
+    WHERE id IN (SELECT id FROM content.{table}
+                 ORDER BY md5(id::text || %s) LIMIT %s);
+'''
+
+LAST_CURSOR_SQL = '''
+    SELECT updated_at, id FROM content.{table}
+    ORDER BY updated_at DESC, id DESC LIMIT 1;
+'''
+
+
+class Runner:
+    """
+    Конвейер ETL из main.py с отдельным состоянием и адресом
+    Elasticsearch для одного сценария
+    """
+
+    def __init__(self, es_url: str, state_path: str,
+                 partial_updates: bool = False,
+                 loader_mode: Optional[str] = None) -> None:
+        # Импорт здесь: settings читает настройки при импорте, а это
+        # должно происходить в процессе сценария
+        import main
+        import settings
+        from extract import (PostgresInricher, PostgresMerger,
+                             PostgresProducer)
+        from fanout import FanOut
+        from load import ElasticsearchLoader
+        from partial import PartialUpdater
+        from pool import get_pool
+        from state_manager import JsonFileStorage, State
+
+        self.main = main
+        self.settings = settings
+        config = settings.elasticsearch_config
+        self.state = State(JsonFileStorage(state_path))
+        self.pool = get_pool(settings.postgres_config,
+                             **settings.postgres_pool_config.dict())
+        self.producer = PostgresProducer(
+            settings.postgres_config, self.state, self.pool,
+            batch_size=settings.etl_config.batch_size,
+            max_batch_size=settings.etl_config.max_batch_size)
+        self.inricher = PostgresInricher(settings.postgres_config, self.pool)
+        self.merger = PostgresMerger(
+            settings.postgres_config, self.pool,
+            mode=settings.etl_config.merger_mode,
+            itersize=settings.etl_config.stream_itersize)
+        self.fanout = FanOut(self.inricher, self.state,
+                             chunk_size=settings.etl_config.fanout_chunk_size)
+        self.loader = ElasticsearchLoader(
+            es_url, mode=loader_mode or config.loader_mode,
+            chunk_size=config.bulk_chunk_size,
+            max_chunk_bytes=config.bulk_max_chunk_bytes,
+            concurrency=config.bulk_concurrency,
+            max_retries=config.bulk_max_retries,
+            throttle=settings.create_bulk_throttle())
+        self.updater = None
+        if partial_updates:
+            self.updater = PartialUpdater(
+                self.loader.es, self.inricher, self.state,
+                chunk_size=settings.etl_config.fanout_chunk_size)
+
+    def execute(self, query: str, params: tuple = ()) -> None:
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+            conn.commit()
+
+    def skip_to_end(self) -> None:
+        """
+        Курсоры всех потоков на последнюю запись: дальше
+        обрабатываются только новые правки
+        """
+        from state_manager import Cursor
+
+        cursors = {}
+        for stream, table in self.producer.TABLES.items():
+            rows = self.producer._fetch_data(
+                LAST_CURSOR_SQL.format(table=table), ())
+            if rows:
+                cursors[stream] = Cursor(rows[0]['updated_at'],
+                                         str(rows[0]['id']))
+        self.state.set_cursors(cursors)
+
+    def drain(self, result: BenchResult) -> None:
+        """
+        Циклы update_coalesced до исчерпания изменений
+        """
+        from coalesce import CoalesceStats
+        from load import LoadReport
+
+        totals = CoalesceStats()
+        while True:
+            self.loader.last_report = LoadReport()
+            if not self.main.update_coalesced(
+                    self.producer, self.fanout, self.merger, self.loader,
+                    self.state, totals, self.updater):
+                return
+            result.items += self.loader.last_report.indexed
+
+
+def run_full(runner: Runner, options: dict) -> BenchResult:
+    from pipeline import Batch, last_cursor
+    from stages import load_batch, merge_batch, transform_batch
+    from state_manager import Cursor
+
+    result = BenchResult('full')
+    cursor = Cursor(None, None)
+    while True:
+        with result.step():
+            rows = runner.producer.fetch_page(
+                'film_work', cursor,
+                runner.settings.etl_config.max_batch_size)
+            if not rows:
+                break
+            cursor = last_cursor(rows)
+            batch = Batch('film', cursor, [row['id'] for row in rows],
+                          film_ids=[row['id'] for row in rows])
+            batch = merge_batch(runner.merger, batch)
+            batch = transform_batch(runner.merger, batch)
+            load_batch(runner.loader, batch)
+        result.items += len(batch.documents)
+    # Последний шаг - пустая выборка, в задержки он не входит
+    result.elapsed -= result.latencies.pop()
+    return result
+
+
+def run_full_stream(runner: Runner, options: dict) -> BenchResult:
+    from reindex import load_catalogue
+
+    result = BenchResult('full_stream')
+    with result.step():
+        result.items = load_catalogue(runner.merger, runner.loader,
+                                      'benchmark_movies')
+    return result
+
+
+def run_steady(runner: Runner, options: dict) -> BenchResult:
+    result = BenchResult('steady')
+    runner.skip_to_end()
+    for round_number in range(options['rounds']):
+        runner.execute(TOUCH_FILMS_SQL,
+                       (f'{options["seed"]}-{round_number}',
+                        options['touch']))
+        with result.step():
+            runner.drain(result)
+    return result
+
+
+def run_renames(runner: Runner, options: dict) -> BenchResult:
+    name = 'renames_partial' if options['partial_updates'] else 'renames'
+    result = BenchResult(name)
+    runner.skip_to_end()
+    seed = str(options['seed'])
+    runner.execute(RENAME_SQL.format(table='person', column='full_name'),
+                   (seed, options['persons']))
+    runner.execute(RENAME_SQL.format(table='genre', column='name'),
+                   (seed, options['genres']))
+    with result.step():
+        runner.drain(result)
+    return result
+
+
+RUNNERS = {'full': run_full, 'full_stream': run_full_stream,
+           'steady': run_steady, 'renames': run_renames}
+
+
+def run_scenario(scenario: str, es_url: str, options: dict) -> dict:
+    """
+    Сценарий целиком; выполняется в отдельном процессе
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        runner = Runner(es_url, os.path.join(directory, 'state.json'),
+                        options['partial_updates'],
+                        'streaming' if scenario == 'full_stream' else None)
+        try:
+            return RUNNERS[scenario](runner, options).summary()
+        finally:
+            runner.pool.close()
+
+
+def run_scenarios(scenarios: List[str], es_url: str,
+                  options: dict) -> List[dict]:
+    summaries = []
+    context = multiprocessing.get_context('spawn')
+    for scenario in scenarios:
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=context) as executor:
+            summaries.append(executor.submit(
+                run_scenario, scenario, es_url, options).result())
+    return summaries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='сценарий (можно несколько); по умолчанию все')
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='раундов правок в steady')
+    parser.add_argument('--touch', type=int, default=50,
+                        help='фильмов на раунд в steady')
+    parser.add_argument('--persons', type=int, default=100,
+                        help='переименуемых персон в renames')
+    parser.add_argument('--genres', type=int, default=2,
+                        help='переименуемых жанров в renames')
+    parser.add_argument('--partial-updates', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--es', help='адрес настоящего Elasticsearch')
+    parser.add_argument('--es-latency', type=float, default=0.0,
+                        help='задержка поддельного bulk, секунды')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    options = {'rounds': args.rounds, 'touch': args.touch,
+               'persons': args.persons, 'genres': args.genres,
+               'partial_updates': args.partial_updates, 'seed': args.seed}
+    scenarios = args.scenario or list(SCENARIOS)
+    if args.es:
+        summaries = run_scenarios(scenarios, args.es, options)
+    else:
+        with FakeElasticsearch(latency=args.es_latency) as fake:
+            summaries = run_scenarios(scenarios, fake.url, options)
+    report(summaries, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Бенчмарки отдельных стадий ETL для поиска регрессий.
+
+- transform: transform_film_work_details на синтетических строках
+  плоского JOIN (Postgres не нужен);
+- bulk_load: ElasticsearchLoader в режимах simple и streaming против
+  поддельного Elasticsearch (или настоящего, --es);
+- fetch: PostgresMerger.fetch_film_work_details в режимах flat и
+  aggregated на данных benchmarks.generate (нужен Postgres из .env).
+
+Запуск из каталога etl:
+
+    python -m benchmarks.bench_stages --stage transform --stage bulk_load \\
+        --save stages.json
+    python -m benchmarks.bench_stages --baseline stages.json
+"""
+import argparse
+import random
+from typing import List
+
+from benchmarks.bench_transform import generate_flat_rows
+from benchmarks.common import BenchResult, add_output_arguments, report
+from benchmarks.fake_es import FakeElasticsearch
+from load import ElasticsearchLoader
+from transform import transform_film_work_details
+
+STAGES = ('transform', 'bulk_load', 'fetch')
+
+
+def bench_transform(args) -> List[dict]:
+    rows = generate_flat_rows(args.films, args.cast, args.genres)
+    result = BenchResult('transform')
+    for _ in range(args.repeat):
+        with result.step():
+            documents = transform_film_work_details(rows)
+        result.items += len(documents)
+    return [result.summary()]
+
+
+def bench_bulk_load(args) -> List[dict]:
+    rows = generate_flat_rows(args.films, args.cast, args.genres)
+    documents = transform_film_work_details(rows)
+    summaries = []
+    with FakeElasticsearch(latency=args.es_latency) as fake:
+        for mode in ('simple', 'streaming'):
+            loader = ElasticsearchLoader(args.es or fake.url, mode=mode)
+            result = BenchResult(f'bulk_load_{mode}')
+            for _ in range(args.repeat):
+                with result.step():
+                    result.items += loader.bulk_load(args.index, documents)
+            summaries.append(result.summary())
+    return summaries
+
+
+def bench_fetch(args) -> List[dict]:
+    # Настройки Postgres нужны только этой стадии
+    from extract import PostgresMerger
+    from settings import postgres_config
+    from pool import get_pool
+
+    pool = get_pool(postgres_config)
+    merger = PostgresMerger(postgres_config, pool)
+    ids = [row['id'] for row in merger._fetch_data(
+        'SELECT id FROM content.film_work ORDER BY id LIMIT %s;',
+        (args.films * args.repeat,))]
+    if not ids:
+        raise SystemExit('content.film_work is empty, '
+                         'run python -m benchmarks.generate first')
+
+    summaries = []
+    for mode in PostgresMerger.MODES:
+        merger.mode = mode
+        result = BenchResult(f'fetch_{mode}')
+        rng = random.Random(args.seed)
+        for _ in range(args.repeat):
+            batch = rng.sample(ids, min(args.films, len(ids)))
+            with result.step():
+                merger.fetch_film_work_details(batch)
+            result.items += len(batch)
+        summaries.append(result.summary())
+    return summaries
+
+
+BENCHMARKS = {'transform': bench_transform,
+              'bulk_load': bench_bulk_load,
+              'fetch': bench_fetch}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--stage', action='append', choices=STAGES,
+                        help='стадия (можно несколько); по умолчанию '
+                             'transform и bulk_load')
+    parser.add_argument('--films', type=int, default=200,
+                        help='фильмов в пачке')
+    parser.add_argument('--cast', type=int, default=20)
+    parser.add_argument('--genres', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--index', default='benchmark_movies')
+    parser.add_argument('--es', help='адрес настоящего Elasticsearch')
+    parser.add_argument('--es-latency', type=float, default=0.0,
+                        help='задержка поддельного bulk, секунды')
+    add_output_arguments(parser)
+    args = parser.parse_args()
+
+    summaries = []
+    for stage in args.stage or ('transform', 'bulk_load'):
+        summaries.extend(BENCHMARKS[stage](args))
+    report(summaries, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Бенчмарк преобразования плоских строк PostgresMerger в документы.
+
+Сравнивает transform_film_work_details с исходной реализацией
+на фильмах с большим составом и проверяет, что результат совпадает
+побайтно. Исходная реализация берёт последнего из нескольких
+режиссёров, текущая - наибольшее имя, поэтому такие фильмы
+не сравниваются. Исходная сохраняет порядок строк, текущая
+сортирует списки, поэтому для сравнения строки упорядочиваются.
+Запуск из каталога etl:
+
+    python -m benchmarks.bench_transform --films 200 --cast 40 --genres 5
+"""
+import argparse
+import json
+import time
+import uuid
+from typing import Callable, List, Set
+
+from transform import (transform_film_work_details,
+                       transform_film_work_details_legacy)
+
+
+def generate_flat_rows(films: int, cast: int, genres: int) -> List[dict]:
+    """
+    Синтетические строки плоского JOIN: персоны x жанры для каждого фильма
+    """
+    roles = ('actor', 'writer')
+    genre_names = [f'Genre {i}' for i in range(genres)]
+    rows = []
+    for film_index in range(films):
+        fw_id = str(uuid.uuid4())
+        # Один режиссёр на фильм: иначе реализации расходятся
+        persons = [('director' if i == 0 else roles[i % 2],
+                    str(uuid.uuid4()), f'Person {i}')
+                   for i in range(cast)]
+        for role, person_id, full_name in persons:
+            for name in genre_names:
+                rows.append({
+                    'fw_id': fw_id,
+                    'title': f'Film {film_index}',
+                    'description': None,
+                    'rating': 7.5,
+                    'role': role,
+                    'person_id': person_id,
+                    'full_name': full_name,
+                    'name': name,
+                })
+    return rows
+
+
+def single_director_films(rows: List[dict]) -> Set[str]:
+    """
+    Фильмы не больше чем с одним режиссёром
+    """
+    directors = {}
+    for row in rows:
+        directors.setdefault(row['fw_id'], set())
+        if row['role'] == 'director':
+            directors[row['fw_id']].add(row['person_id'])
+    return {fw_id for fw_id, ids in directors.items() if len(ids) <= 1}
+
+
+def sorted_rows(rows: List[dict]) -> List[dict]:
+    """
+    Строки в порядке, при котором исходная реализация тоже даёт
+    отсортированные жанры и персоны
+    """
+    return sorted(rows, key=lambda row: (row['fw_id'],
+                                         row['full_name'] or '',
+                                         str(row['person_id']),
+                                         row['name'] or ''))
+
+
+def measure(transform: Callable, rows: List[dict], repeat: int) -> float:
+    """
+    Лучшее время из repeat запусков, секунды
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        transform(rows)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--films', type=int, default=200)
+    parser.add_argument('--cast', type=int, default=40)
+    parser.add_argument('--genres', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = generate_flat_rows(args.films, args.cast, args.genres)
+
+    comparable = single_director_films(rows)
+    legacy = json.dumps([
+        document
+        for document in transform_film_work_details_legacy(sorted_rows(rows))
+        if document['id'] in comparable])
+    current = json.dumps([
+        document for document in transform_film_work_details(sorted_rows(rows))
+        if document['id'] in comparable])
+    if legacy != current:
+        raise SystemExit('Output differs from the legacy transform')
+
+    for name, transform in (('legacy', transform_film_work_details_legacy),
+                            ('current', transform_film_work_details)):
+        elapsed = measure(transform, rows, args.repeat)
+        print(f'{name:>8}: {len(rows) / elapsed:12.0f} rows/s '
+              f'({elapsed * 1000:.1f} ms for {len(rows)} rows)')
+
+
+if __name__ == '__main__':
+    main()
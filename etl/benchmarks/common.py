@@ -0,0 +1,126 @@
+"""
+Общие части бенчмарков: результаты с перцентилями задержек,
+пиковая память и сравнение с сохранённой базовой линией.
+"""
+import json
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from utils import peak_rss_mb
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Перцентиль q (0..100) методом ближайшего ранга
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+@dataclass
+class BenchResult:
+    """
+    Итог одного бенчмарка: items обработано за elapsed секунд,
+    latencies - время отдельных шагов (пачек, циклов, повторов)
+    """
+    name: str
+    items: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    peak_rss_mb: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        """
+        Замер одного шага: время идёт и в latencies, и в elapsed
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            took = time.perf_counter() - started
+            self.latencies.append(took)
+            self.elapsed += took
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'name': self.name,
+            'items': self.items,
+            'elapsed': round(self.elapsed, 4),
+            'throughput': round(self.throughput, 1),
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(self.latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 2),
+            'max_ms': round(max(self.latencies, default=0.0) * 1000, 2),
+            'peak_rss_mb': round(self.peak_rss_mb or peak_rss_mb(), 1),
+        }
+
+
+def print_summaries(summaries: List[dict]) -> None:
+    print(f'{"benchmark":<28}{"items":>10}{"items/s":>12}{"p50 ms":>10}'
+          f'{"p95 ms":>10}{"p99 ms":>10}{"peak MB":>10}')
+    for row in summaries:
+        print(f'{row["name"]:<28}{row["items"]:>10}'
+              f'{row["throughput"]:>12.1f}{row["p50_ms"]:>10.2f}'
+              f'{row["p95_ms"]:>10.2f}{row["p99_ms"]:>10.2f}'
+              f'{row["peak_rss_mb"]:>10.1f}')
+
+
+def save_summaries(path: str, summaries: List[dict]) -> None:
+    with open(path, 'w') as file:
+        json.dump(summaries, file, indent=2)
+
+
+def find_regressions(summaries: List[dict], baseline_path: str,
+                     tolerance: float) -> List[str]:
+    """
+    Бенчмарки, чья пропускная способность упала больше чем на
+    tolerance (доля) относительно базовой линии
+    """
+    with open(baseline_path) as file:
+        baseline = {row['name']: row for row in json.load(file)}
+    regressions = []
+    for row in summaries:
+        before: Optional[dict] = baseline.get(row['name'])
+        if not before or not before['throughput']:
+            continue
+        change = row['throughput'] / before['throughput'] - 1
+        if change < -tolerance:
+            regressions.append(f'{row["name"]}: {before["throughput"]:.1f}'
+                               f' -> {row["throughput"]:.1f} items/s '
+                               f'({change:.0%})')
+    return regressions
+
+
+def add_output_arguments(parser) -> None:
+    parser.add_argument('--save', help='записать результаты в JSON')
+    parser.add_argument('--baseline',
+                        help='JSON прошлого запуска для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='допустимое падение пропускной способности')
+
+
+def report(summaries: List[dict], args) -> None:
+    """
+    Печать, сохранение и проверка на регрессии; при регрессии
+    процесс завершается с кодом 1
+    """
+    print_summaries(summaries)
+    if args.save:
+        save_summaries(args.save, summaries)
+    if args.baseline:
+        regressions = find_regressions(summaries, args.baseline,
+                                       args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,158 @@
+"""
+Поддельный Elasticsearch для бенчмарков: принимает bulk-запросы
+и отвечает, что все документы проиндексированы.
+
+Позволяет мерить ETL без узла Elasticsearch: время загрузки тогда -
+сериализация, HTTP и разбор ответа на стороне клиента. --latency
+добавляет задержку к каждому bulk-запросу. Запуск отдельно
+(из каталога etl):
+
+    python -m benchmarks.fake_es --port 9201 --latency 0.02
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+# Клиент elasticsearch 8 проверяет этот заголовок в каждом ответе
+PRODUCT_HEADERS = {'X-Elastic-Product': 'Elasticsearch',
+                   'Content-Type': 'application/json'}
+
+INFO = {'name': 'fake', 'cluster_name': 'benchmark',
+        'version': {'number': '8.12.0', 'build_flavor': 'default'},
+        'tagline': 'You Know, for Search'}
+
+
+class BulkHandler(BaseHTTPRequestHandler):
+    server: 'FakeElasticsearch'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        self._reply(INFO if self.path in ('/', '') else {})
+
+    def do_HEAD(self) -> None:
+        self._reply(None)
+
+    def do_DELETE(self) -> None:
+        self._reply({'acknowledged': True})
+
+    def do_POST(self) -> None:
+        # Клиент отправляет bulk методом PUT, остальное - POST
+        body = self._read_body()
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/_bulk'):
+            self._reply(self._bulk(body))
+        elif path.endswith('/_update_by_query'):
+            self._reply({'updated': 0, 'failures': []})
+        elif self.command == 'PUT':
+            self._reply({'acknowledged': True})
+        else:
+            self._reply({'_shards': {'total': 1, 'successful': 1,
+                                     'failed': 0}})
+
+    do_PUT = do_POST
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _bulk(self, body: bytes) -> dict:
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        lines = [line for line in body.split(b'\n') if line]
+        items = []
+        position = 0
+        while position < len(lines):
+            action = json.loads(lines[position])
+            op, meta = next(iter(action.items()))
+            items.append({op: {'_index': meta.get('_index'),
+                               '_id': meta.get('_id'),
+                               'status': 201, 'result': 'created'}})
+            # У delete нет строки с документом
+            position += 1 if op == 'delete' else 2
+        self.server.count(len(items), len(body))
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, payload: Optional[dict]) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(200)
+        for name, value in PRODUCT_HEADERS.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """
+    Сервер в фоновом потоке; url - адрес для ElasticsearchLoader
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0) -> None:
+        super().__init__((host, port), BulkHandler)
+        self.latency = latency
+        self.documents = 0
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, documents: int, size: int) -> None:
+        with self._lock:
+            self.documents += documents
+            self.requests += 1
+            self.bytes_received += size
+
+    def start(self) -> 'FakeElasticsearch':
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='fake-es', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> 'FakeElasticsearch':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9201)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='задержка bulk-запроса, секунды')
+    args = parser.parse_args()
+
+    server = FakeElasticsearch(args.host, args.port, args.latency)
+    print(f'Fake Elasticsearch on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'{server.documents} documents in {server.requests} '
+              f'bulk requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Генератор синтетической схемы content для бенчмарков.
+
+Создаёт таблицы film_work, person, genre и таблицы связей (если их нет)
+и заполняет их через COPY. Данные воспроизводимы: id, имена и
+updated_at зависят только от --seed и размеров. Популярность персон
+неравномерна (--skew): у первых персон тысячи фильмов, как у звёзд
+в настоящем каталоге, поэтому переименования дают реальное
+разветвление. Запуск из каталога etl на локальном Postgres
+(настройки POSTGRES_* из .env):
+
+    python -m benchmarks.generate --films 100000 --persons 50000 \\
+        --genres 30 --cast 20 --genres-per-film 3 --reset
+
+Существующие данные удаляются только с --reset.
+"""
+import argparse
+import io
+import logging
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+from dotenv import load_dotenv
+
+from configs import PostgresConfig, pg_connection
+
+logger = logging.getLogger('benchmarks.generate')
+
+SCHEMA_SQL = '''
+    CREATE SCHEMA IF NOT EXISTS content;
+
+    CREATE TABLE IF NOT EXISTS content.film_work (
+        id uuid PRIMARY KEY,
+        title text NOT NULL,
+        description text,
+        creation_date date,
+        rating float,
+        type text NOT NULL,
+        created_at timestamptz,
+        updated_at timestamptz
+    );
+
+    CREATE TABLE IF NOT EXISTS content.genre (
+        id uuid PRIMARY KEY,
+        name text NOT NULL,
+        description text,
+        created_at timestamptz,
+        updated_at timestamptz
+    );
+
+    CREATE TABLE IF NOT EXISTS content.person (
+        id uuid PRIMARY KEY,
+        full_name text NOT NULL,
+        created_at timestamptz,
+        updated_at timestamptz
+    );
+
+    CREATE TABLE IF NOT EXISTS content.genre_film_work (
+        id uuid PRIMARY KEY,
+        genre_id uuid NOT NULL
+            REFERENCES content.genre (id) ON DELETE CASCADE,
+        film_work_id uuid NOT NULL
+            REFERENCES content.film_work (id) ON DELETE CASCADE,
+        created_at timestamptz
+    );
+
+    CREATE TABLE IF NOT EXISTS content.person_film_work (
+        id uuid PRIMARY KEY,
+        person_id uuid NOT NULL
+            REFERENCES content.person (id) ON DELETE CASCADE,
+        film_work_id uuid NOT NULL
+            REFERENCES content.film_work (id) ON DELETE CASCADE,
+        role text NOT NULL,
+        created_at timestamptz
+    );
+
+    -- Индексы, на которые опираются запросы ETL: курсор (updated_at, id)
+    -- и разветвление от персон и жанров к фильмам
+    CREATE INDEX IF NOT EXISTS film_work_updated_idx
+        ON content.film_work (updated_at, id);
+    CREATE INDEX IF NOT EXISTS person_updated_idx
+        ON content.person (updated_at, id);
+    CREATE INDEX IF NOT EXISTS genre_updated_idx
+        ON content.genre (updated_at, id);
+    CREATE UNIQUE INDEX IF NOT EXISTS film_work_person_role_idx
+        ON content.person_film_work (film_work_id, person_id, role);
+    CREATE INDEX IF NOT EXISTS person_film_work_person_idx
+        ON content.person_film_work (person_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS film_work_genre_idx
+        ON content.genre_film_work (film_work_id, genre_id);
+    CREATE INDEX IF NOT EXISTS genre_film_work_genre_idx
+        ON content.genre_film_work (genre_id);
+'''
+
+TABLES = ('person_film_work', 'genre_film_work', 'film_work', 'person',
+          'genre')
+
+# Начало отсчёта updated_at: фиксированное, чтобы данные совпадали
+# между запусками
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+COPY_CHUNK_SIZE = 10000
+
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def tsv(rows: Iterable[Sequence]) -> io.StringIO:
+    """
+    Строки в формате COPY ... FROM STDIN (текстовый, NULL = \\N)
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if value is None else str(value)
+                               for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cursor, table: str, columns: Sequence[str],
+              rows: Iterable[Sequence]) -> int:
+    """
+    Загрузка строк через COPY порциями, не держа таблицу в памяти
+    """
+    total = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, COPY_CHUNK_SIZE))
+        if not chunk:
+            return total
+        cursor.copy_expert(
+            f'COPY content.{table} ({", ".join(columns)}) FROM STDIN',
+            tsv(chunk))
+        total += len(chunk)
+
+
+def pick_person(rng: random.Random, persons: int, skew: float) -> int:
+    """
+    Индекс персоны: при skew > 1 первые персоны встречаются чаще
+    """
+    return min(int(persons * rng.random() ** skew), persons - 1)
+
+
+def film_rows(film_ids: List[str],
+              rng: random.Random) -> Iterator[Sequence]:
+    for i, film_id in enumerate(film_ids):
+        yield (film_id, f'Film {i}', f'Synthetic film {i} description',
+               None, round(rng.uniform(1, 10), 1), 'movie',
+               EPOCH, EPOCH + timedelta(seconds=i))
+
+
+def person_links(film_ids: List[str], person_ids: List[str], cast: int,
+                 skew: float, rng: random.Random) -> Iterator[Sequence]:
+    for film_id in film_ids:
+        members = {pick_person(rng, len(person_ids), skew)
+                   for _ in range(min(cast, len(person_ids)))}
+        # Один режиссёр, остальные - актёры и сценаристы 3:1
+        for n, person in enumerate(sorted(members)):
+            role = ('director' if n == 0
+                    else 'writer' if n % 4 == 0 else 'actor')
+            yield (make_uuid(rng), person_ids[person], film_id, role, EPOCH)
+
+
+def genre_links(film_ids: List[str], genre_ids: List[str],
+                genres_per_film: int,
+                rng: random.Random) -> Iterator[Sequence]:
+    for film_id in film_ids:
+        for genre_id in rng.sample(genre_ids,
+                                   min(genres_per_film, len(genre_ids))):
+            yield make_uuid(rng), genre_id, film_id, EPOCH
+
+
+def generate(conn, films: int, persons: int, genres: int, cast: int,
+             genres_per_film: int, skew: float = 2.0,
+             seed: int = 42) -> Dict[str, int]:
+    """
+    Заполнение схемы content; возвращает число строк по таблицам
+    """
+    rng = random.Random(seed)
+    genre_ids = [make_uuid(rng) for _ in range(genres)]
+    person_ids = [make_uuid(rng) for _ in range(persons)]
+    film_ids = [make_uuid(rng) for _ in range(films)]
+
+    counts = {}
+    with conn.cursor() as cursor:
+        counts['genre'] = copy_rows(
+            cursor, 'genre',
+            ('id', 'name', 'description', 'created_at', 'updated_at'),
+            ((genre_id, f'Genre {i}', None, EPOCH,
+              EPOCH + timedelta(seconds=i))
+             for i, genre_id in enumerate(genre_ids)))
+        counts['person'] = copy_rows(
+            cursor, 'person', ('id', 'full_name', 'created_at', 'updated_at'),
+            ((person_id, f'Person {i}', EPOCH, EPOCH + timedelta(seconds=i))
+             for i, person_id in enumerate(person_ids)))
+        counts['film_work'] = copy_rows(
+            cursor, 'film_work',
+            ('id', 'title', 'description', 'creation_date', 'rating',
+             'type', 'created_at', 'updated_at'),
+            film_rows(film_ids, rng))
+        counts['person_film_work'] = copy_rows(
+            cursor, 'person_film_work',
+            ('id', 'person_id', 'film_work_id', 'role', 'created_at'),
+            person_links(film_ids, person_ids, cast, skew, rng))
+        counts['genre_film_work'] = copy_rows(
+            cursor, 'genre_film_work',
+            ('id', 'genre_id', 'film_work_id', 'created_at'),
+            genre_links(film_ids, genre_ids, genres_per_film, rng))
+        cursor.execute('ANALYZE content.film_work, content.person, '
+                       'content.genre, content.person_film_work, '
+                       'content.genre_film_work;')
+    conn.commit()
+    return counts
+
+
+def prepare_schema(conn, reset: bool) -> None:
+    """
+    Создание схемы; существующие строки удаляются только при reset
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(SCHEMA_SQL)
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM content.film_work);')
+        if cursor.fetchone()[0]:
+            if not reset:
+                raise SystemExit('content.film_work is not empty, '
+                                 'pass --reset to replace the data')
+            cursor.execute('TRUNCATE ' + ', '.join(
+                f'content.{table}' for table in TABLES) + ';')
+    conn.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--persons', type=int, default=5000)
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--cast', type=int, default=20,
+                        help='персон на фильм')
+    parser.add_argument('--genres-per-film', type=int, default=3)
+    parser.add_argument('--skew', type=float, default=2.0,
+                        help='неравномерность популярности персон')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reset', action='store_true',
+                        help='удалить существующие данные content')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    with pg_connection(PostgresConfig().dict()) as conn:
+        prepare_schema(conn, args.reset)
+        started = time.perf_counter()
+        counts = generate(conn, args.films, args.persons, args.genres,
+                          args.cast, args.genres_per_film, args.skew,
+                          args.seed)
+    logger.info('Generated %s in %.1f s', counts,
+                time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main()
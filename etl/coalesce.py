@@ -0,0 +1,66 @@
+import logging
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List
+
+from pipeline import Batch
+
+logger = logging.getLogger('coalesce')
+
+
+@dataclass
+class CoalesceStats:
+    """
+    Метрики объединения: сколько фильмов затронули потоки
+    и сколько из них оказались повторами
+    """
+    cycles: int = 0
+    affected: int = 0
+    unique: int = 0
+    duplicates: int = 0
+    by_stream: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def duplicate_ratio(self) -> float:
+        return self.duplicates / self.affected if self.affected else 0.0
+
+    def merge(self, other: 'CoalesceStats') -> None:
+        self.cycles += other.cycles
+        self.affected += other.affected
+        self.unique += other.unique
+        self.duplicates += other.duplicates
+        for stream, count in other.by_stream.items():
+            self.by_stream[stream] = self.by_stream.get(stream, 0) + count
+
+    def as_dict(self) -> dict:
+        return dict(asdict(self), duplicate_ratio=self.duplicate_ratio)
+
+
+@dataclass
+class CoalescedWork:
+    """
+    Работа одного цикла: уникальные фильмы всех потоков.
+    Курсоры сдвигает checkpoint_batches по исходным пачкам
+    """
+    film_ids: List[str]
+    stats: CoalesceStats
+
+
+def coalesce_batches(batches: Iterable[Batch]) -> CoalescedWork:
+    """
+    Объединение фильмов из пачек всех потоков без повторов.
+
+    Порядок первого появления сохраняется, поэтому фильмы потока
+    film идут первыми.
+    """
+    film_ids: Dict[str, None] = {}
+    stats = CoalesceStats(cycles=1)
+
+    for batch in batches:
+        stats.by_stream[batch.stream] = len(batch.film_ids)
+        stats.affected += len(batch.film_ids)
+        for film_id in batch.film_ids:
+            film_ids.setdefault(str(film_id))
+
+    stats.unique = len(film_ids)
+    stats.duplicates = stats.affected - stats.unique
+    return CoalescedWork(list(film_ids), stats)
@@ -1,4 +1,5 @@
 from contextlib import contextmanager
+from typing import Literal
 
 import psycopg2
 from pydantic_settings import BaseSettings
@@ -30,13 +31,147 @@ class PostgresConfig(BaseSettings):
         )
 
 
+class PostgresPoolConfig(BaseSettings):
+    """
+    Конфигурация пула соединений с Postgres
+    """
+    max_size: int = 5
+    health_check_interval: float = 30.0
+
+    class Config:
+        env_prefix = 'POSTGRES_POOL_'
+
+
 class ElasticsearchConfig(BaseSettings):
     host: str
+    # Режим загрузки: simple (один bulk) или streaming (чанки в параллель)
+    loader_mode: Literal['simple', 'streaming'] = 'simple'
+    bulk_chunk_size: int = 500
+    bulk_max_chunk_bytes: int = 10 * 1024 * 1024
+    bulk_concurrency: int = 4
+    bulk_max_retries: int = 5
 
     class Config:
         env_prefix = 'ELASTICSEARCH_'
 
 
+class EtlConfig(BaseSettings):
+    """
+    Конфигурация ETL процесса
+    """
+    # Начальный размер страницы выборки обновлений
+    batch_size: int = 100
+    # Верхняя граница адаптивного размера страницы
+    max_batch_size: int = 1000
+    # Не ждать между циклами, пока есть непрочитанные обновления
+    drain: bool = True
+    # Пауза между циклами, когда обновлений нет; при долгом простое
+    # растёт в idle_backoff_factor раз до idle_max_sleep
+    idle_sleep: float = 0.5
+    idle_max_sleep: float = 30.0
+    idle_backoff_factor: float = 2.0
+    # Режим PostgresMerger: flat (плоский JOIN) или aggregated
+    merger_mode: Literal['flat', 'aggregated'] = 'flat'
+    # Валидация документов: по одному, пачкой или только в DEBUG
+    validation: Literal['document', 'batch', 'debug'] = 'document'
+    # Движок: sequential (цикл main), pipeline (стадии в потоках)
+    # или async (asyncpg и AsyncElasticsearch)
+    engine: Literal['sequential', 'pipeline', 'async'] = 'sequential'
+    # Строк за одно обращение к серверному курсору при потоковом
+    # чтении каталога (полная переиндексация)
+    stream_itersize: int = 2000
+    # Размер очереди между стадиями конвейера
+    pipeline_queue_size: int = 2
+    # Последовательный движок: объединять фильмы всех потоков за цикл
+    coalesce: bool = True
+    # Порция фильмов, связанных с изменёнными персонами и жанрами
+    fanout_chunk_size: int = 500
+    # Захват изменений: poll (опрос updated_at) или notify (LISTEN/NOTIFY)
+    change_capture: Literal['poll', 'notify'] = 'poll'
+    # Период догоняющего прохода по updated_at в режиме notify
+    catchup_interval: float = 60.0
+    # Не отправлять документы, не изменившиеся с прошлой загрузки
+    fingerprints: bool = False
+    fingerprints_path: str = 'etl_fingerprints.sqlite'
+    # Переименования персон и жанров частичным обновлением индекса
+    partial_updates: bool = False
+    # Дополнительные индексы из того же прохода через Postgres,
+    # через запятую: persons, genres
+    sinks: str = ''
+    # Очередь недоставленных документов: ошибки валидации и
+    # неисправимые ошибки Elasticsearch не останавливают пачку
+    dead_letters: bool = True
+    dead_letters_path: str = 'etl_dead_letters.sqlite'
+
+    class Config:
+        env_prefix = 'ETL_'
+
+
+class StateConfig(BaseSettings):
+    """
+    Конфигурация хранилища состояния
+    """
+    # json (файл), sqlite или redis (для нескольких процессов)
+    backend: Literal['json', 'sqlite', 'redis'] = 'json'
+    path: str = 'etl_state.json'
+    redis_url: str = 'redis://localhost:6379/0'
+    redis_key: str = 'etl_state'
+    # Как часто сбрасывать чекпоинты в хранилище (0 - сразу)
+    flush_interval: float = 0.0
+
+    class Config:
+        env_prefix = 'STATE_'
+
+
+class ResilienceConfig(BaseSettings):
+    """
+    Конфигурация предохранителей и регулирования нагрузки
+    """
+    # Ошибок подряд до размыкания предохранителя backend
+    breaker_failure_threshold: int = 5
+    # Сколько секунд предохранитель разомкнут до пробного вызова
+    breaker_reset_timeout: float = 30.0
+    # Задержка bulk-запроса, выше которой чанк и параллельность
+    # уменьшаются
+    bulk_latency_target: float = 2.0
+    bulk_min_chunk_size: int = 50
+    # Время запроса страницы изменений, выше которого страница
+    # уменьшается (0 - не регулировать)
+    pg_latency_target: float = 5.0
+
+    class Config:
+        env_prefix = 'RESILIENCE_'
+
+
+class SpoolConfig(BaseSettings):
+    """
+    Конфигурация дисковой очереди между преобразованием и загрузкой
+    """
+    enabled: bool = False
+    path: str = 'etl_spool'
+    # Размер сегмента, после которого запись идёт в новый файл
+    segment_bytes: int = 64 * 1024 * 1024
+    # Неподтверждённый объём, при котором извлечение приостанавливается
+    max_bytes: int = 1024 * 1024 * 1024
+    # Уровень сжатия zlib (1 - быстрее, 9 - компактнее)
+    compression_level: int = 1
+
+    class Config:
+        env_prefix = 'SPOOL_'
+
+
+class MetricsConfig(BaseSettings):
+    """
+    Конфигурация HTTP-сервера метрик Prometheus
+    """
+    enabled: bool = True
+    host: str = '0.0.0.0'
+    port: int = 8001
+
+    class Config:
+        env_prefix = 'METRICS_'
+
+
 class LoggingConfig(BaseSettings):
     """
     Конфигурация логирования
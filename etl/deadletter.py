@@ -0,0 +1,306 @@
+"""
+Очередь недоставленных документов (dead-letter queue).
+
+Фильм, не прошедший валидацию FilmWork, и документ, который
+Elasticsearch отклонил ошибкой, не исправимой повтором (например,
+mapper_parsing_exception), больше не останавливают цикл: они
+записываются в SQLite вместе с причиной и исходными строками или
+телом документа, остальная пачка загружается, чекпоинт сдвигается.
+
+После исправления данных записи обрабатываются заново (из каталога etl):
+
+    python deadletter.py list
+    python deadletter.py replay --index movies
+    python deadletter.py replay --index persons --id <id>
+"""
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import orjson
+
+from metrics import count_documents
+
+logger = logging.getLogger('deadletter')
+
+# Поток изменений, по которому находятся фильмы документа индекса
+INDEX_STREAMS = {'persons': 'person', 'genres': 'genre'}
+
+# Запись очереди: id документа, причина, исходные данные
+DeadLetter = Tuple[str, Any, Any]
+
+
+def error_reason(error: Any) -> str:
+    """
+    Краткая причина по ошибке Elasticsearch или строке
+    """
+    if isinstance(error, dict):
+        reason = f"{error.get('type')}: {error.get('reason')}"
+        if error.get('caused_by'):
+            reason += f" ({error_reason(error['caused_by'])})"
+        return reason
+    return str(error)
+
+
+def iter_bulk_sources(body: bytes
+                      ) -> Iterator[Tuple[str, str, Optional[bytes]]]:
+    """
+    Действия тела bulk-запроса: (индекс, id, строка документа)
+    """
+    lines = iter(body.splitlines())
+    for line in lines:
+        if not line:
+            continue
+        action = orjson.loads(line)
+        operation, meta = next(iter(action.items()))
+        source = None if operation == 'delete' else next(lines, None)
+        yield meta.get('_index'), str(meta.get('_id')), source
+
+
+class DeadLetterStore:
+    """
+    Недоставленные документы по (индекс, id) в файле SQLite.
+
+    Повторная ошибка того же документа обновляет причину и данные
+    и увеличивает attempts. Запись удаляется, только если после
+    replay документ не вернулся в очередь.
+    """
+
+    def __init__(self, path: str = 'etl_dead_letters.sqlite') -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                idx TEXT NOT NULL,
+                id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                payload TEXT,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                PRIMARY KEY (idx, id)
+            ) WITHOUT ROWID
+        ''')
+        self._conn.commit()
+
+    def add(self, index: str, stage: str,
+            letters: Iterable[DeadLetter]) -> int:
+        """
+        Запись документов, отклонённых на стадии stage
+        (transform или load)
+        """
+        now = time.time()
+        rows = [(index, str(doc_id), stage, error_reason(reason),
+                 orjson.dumps(payload, default=str).decode()
+                 if payload is not None else None, now, now)
+                for doc_id, reason, payload in letters]
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.executemany('''
+                INSERT INTO dead_letters
+                    (idx, id, stage, reason, payload, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idx, id) DO UPDATE SET
+                    stage = excluded.stage, reason = excluded.reason,
+                    payload = excluded.payload,
+                    attempts = attempts + 1,
+                    last_seen = excluded.last_seen
+            ''', rows)
+            self._conn.commit()
+        count_documents('dead_lettered', len(rows))
+        logger.warning('Dead-lettered %s %s documents at %s: %s%s',
+                       len(rows), index, stage,
+                       ', '.join(row[1] for row in rows[:5]),
+                       '...' if len(rows) > 5 else '')
+        return len(rows)
+
+    def add_rejected(self, details: list,
+                     rejected: List[Tuple[str, str]]) -> int:
+        """
+        Фильмы, не прошедшие валидацию, с их строками PostgresMerger
+        """
+        rows: Dict[str, list] = {str(fw_id): [] for fw_id, _ in rejected}
+        for row in details:
+            fw_id = str(row['fw_id'])
+            if fw_id in rows:
+                rows[fw_id].append(dict(row))
+        return self.add('movies', 'transform',
+                        ((fw_id, reason, rows[str(fw_id)])
+                         for fw_id, reason in rejected))
+
+    def add_failed(self, index: str, failed: List[Tuple[str, Any]],
+                   documents: Iterable[Dict[str, Any]] = ()) -> int:
+        """
+        Документы из LoadReport.failed с телами из documents
+        """
+        if not failed:
+            return 0
+        failed_ids = {str(doc_id) for doc_id, _ in failed}
+        sources = {str(doc['id']): doc for doc in documents
+                   if str(doc['id']) in failed_ids}
+        return self.add(index, 'load',
+                        ((doc_id, error, sources.get(str(doc_id)))
+                         for doc_id, error in failed))
+
+    def add_bulk_failures(self, body: bytes,
+                          results: List[Dict[str, Any]]) -> int:
+        """
+        Отклонённые действия готового тела bulk-запроса (режим simple
+        и дисковая очередь) с документами из этого тела
+        """
+        failed = {(result.get('_index'), str(result.get('_id'))): result
+                  for result in results}
+        by_index: Dict[str, List[DeadLetter]] = {}
+        for index, doc_id, source in iter_bulk_sources(body):
+            result = failed.get((index, doc_id))
+            if result is None:
+                continue
+            payload = orjson.loads(source) if source else None
+            by_index.setdefault(index, []).append(
+                (doc_id, result['error'], payload))
+        return sum(self.add(index, 'load', letters)
+                   for index, letters in by_index.items())
+
+    def entries(self, index: Optional[str] = None) -> List[Dict[str, Any]]:
+        query = ('SELECT idx, id, stage, reason, attempts, last_seen '
+                 'FROM dead_letters')
+        params: tuple = ()
+        if index is not None:
+            query += ' WHERE idx = ?'
+            params = (index,)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY last_seen',
+                                      params).fetchall()
+        return [dict(zip(('index', 'id', 'stage', 'reason', 'attempts',
+                          'last_seen'), row)) for row in rows]
+
+    def ids(self, index: str) -> List[str]:
+        return [entry['id'] for entry in self.entries(index)]
+
+    def resolve(self, index: str, ids: List[str], before: float) -> int:
+        """
+        Удаление записей, не обновлявшихся с момента before: документ
+        после replay загружен и в очередь не вернулся
+        """
+        with self._lock:
+            cursor = self._conn.executemany(
+                'DELETE FROM dead_letters '
+                'WHERE idx = ? AND id = ? AND last_seen < ?',
+                ((index, str(doc_id), before) for doc_id in ids))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def clear(self, index: Optional[str] = None) -> None:
+        with self._lock:
+            if index is None:
+                self._conn.execute('DELETE FROM dead_letters')
+            else:
+                self._conn.execute('DELETE FROM dead_letters WHERE idx = ?',
+                                   (index,))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_store: List[DeadLetterStore] = []
+
+
+def configure_dead_letters(store: Optional[DeadLetterStore]) -> None:
+    """
+    Очередь для стадии преобразования (ETL_DEAD_LETTERS)
+    """
+    _store[:] = [store] if store is not None else []
+
+
+def get_dead_letters() -> Optional[DeadLetterStore]:
+    return _store[0] if _store else None
+
+
+def replay(store: DeadLetterStore, index: str, ids: List[str],
+           inricher, merger, es_loader, chunk_size: int = 500) -> int:
+    """
+    Повторная обработка документов очереди через стадии ETL (stages).
+    Возвращает число записей, покинувших очередь
+    """
+    # Импорт внутри функции: stages сам импортирует этот модуль
+    from stages import load_batch, merge_batch, transform_batch
+    from pipeline import Batch
+
+    started = time.time()
+    if index == 'movies':
+        pages = (ids[start:start + chunk_size]
+                 for start in range(0, len(ids), chunk_size))
+    else:
+        pages = ([str(row['id']) for row in page]
+                 for page in inricher.iter_related_film_works(
+                     INDEX_STREAMS[index], ids, chunk_size))
+    if es_loader.fingerprints is not None:
+        # Иначе загрузчик сочтёт документы неизменившимися
+        es_loader.fingerprints.forget(index, ids)
+    for film_ids in pages:
+        batch = Batch('replay', None, [], film_ids=film_ids)
+        batch = merge_batch(merger, batch)
+        batch = transform_batch(merger, batch)
+        load_batch(es_loader, batch)
+    resolved = store.resolve(index, ids, started)
+    logger.info('Replayed %s %s documents: %s resolved, %s still failing',
+                len(ids), index, resolved, len(ids) - resolved)
+    return resolved
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('command', choices=('list', 'replay', 'clear'))
+    parser.add_argument('--index', choices=('movies', *INDEX_STREAMS))
+    parser.add_argument('--id', action='append',
+                        help='id документа (можно несколько); '
+                             'по умолчанию все записи индекса')
+    args = parser.parse_args()
+    if args.id and not args.index:
+        parser.error('--id requires --index')
+
+    # Импорт внутри функции: settings сам импортирует этот модуль
+    from settings import (create_es_loader, create_fingerprints,
+                          create_sinks, etl_config, postgres_config,
+                          postgres_pool_config)
+    from extract import PostgresInricher, PostgresMerger
+    from pool import get_pool
+
+    store = DeadLetterStore(etl_config.dead_letters_path)
+    if args.command == 'list':
+        for entry in store.entries(args.index):
+            print(f"{entry['index']}\t{entry['id']}\t{entry['stage']}\t"
+                  f"{entry['attempts']}\t{entry['reason']}")
+    elif args.command == 'clear':
+        store.clear(args.index)
+    else:
+        configure_dead_letters(store)
+        pool = get_pool(postgres_config, **postgres_pool_config.dict())
+        es_loader = create_es_loader(fingerprints=create_fingerprints(),
+                                     dead_letters=store)
+        create_sinks()
+        inricher = PostgresInricher(postgres_config, pool)
+        merger = PostgresMerger(postgres_config, pool,
+                                mode=etl_config.merger_mode)
+        for index in [args.index] if args.index else ['movies',
+                                                      *INDEX_STREAMS]:
+            ids = args.id or store.ids(index)
+            if ids:
+                replay(store, index, ids, inricher, merger, es_loader,
+                       etl_config.fanout_chunk_size)
+        pool.close()
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,156 +1,526 @@
 from datetime import datetime
-from psycopg2.extras import DictCursor
-from typing import List
-from configs import pg_connection
-from state_manager import State
+from itertools import count
+import logging
+import time
+from psycopg2.extras import DictCursor, NamedTupleCursor
+from typing import Iterator, List, Optional
+from pool import PostgresPool, get_pool
+from state_manager import Cursor, State, NIL_UUID
 from utils import backoff
 
+logger = logging.getLogger('extract')
+
+
+# Запросы общие для синхронного и асинхронного движков
+# Страница фильмов, связанных с персонами или жанрами, после
+# подкурсора (updated_at, id): разветвление читается порциями без потолка
+RELATED_BY_PERSON_QUERY = '''
+    SELECT fw.id, fw.updated_at
+    FROM content.film_work fw
+    WHERE EXISTS (
+        SELECT 1
+        FROM content.person_film_work pfw
+        WHERE pfw.film_work_id = fw.id
+          AND pfw.person_id = ANY(%s::uuid[])
+    )
+      AND (fw.updated_at, fw.id) > (%s::timestamptz, %s::uuid)
+    ORDER BY fw.updated_at, fw.id
+    LIMIT %s;
+'''
+
+RELATED_BY_GENRE_QUERY = '''
+    SELECT fw.id, fw.updated_at
+    FROM content.film_work fw
+    WHERE EXISTS (
+        SELECT 1
+        FROM content.genre_film_work gfw
+        WHERE gfw.film_work_id = fw.id
+          AND gfw.genre_id = ANY(%s::uuid[])
+    )
+      AND (fw.updated_at, fw.id) > (%s::timestamptz, %s::uuid)
+    ORDER BY fw.updated_at, fw.id
+    LIMIT %s;
+'''
+
+# Запрос связанных фильмов для каждого потока с разветвлением
+RELATED_QUERIES = {'person': RELATED_BY_PERSON_QUERY,
+                   'genre': RELATED_BY_GENRE_QUERY}
+
+# Текущие имена персон и признак режиссёра (режиссёр хранится
+# в документе только именем, без id)
+PERSON_NAMES_QUERY = '''
+    SELECT
+        p.id,
+        p.full_name,
+        EXISTS (
+            SELECT 1
+            FROM content.person_film_work pfw
+            WHERE pfw.person_id = p.id AND pfw.role = 'director'
+        ) as is_director
+    FROM content.person p
+    WHERE p.id = ANY(%s::uuid[]);
+'''
+
+GENRE_NAMES_QUERY = '''
+    SELECT id, name
+    FROM content.genre
+    WHERE id = ANY(%s::uuid[]);
+'''
+
+FLAT_DETAILS_SELECT = '''
+    SELECT
+        fw.id as fw_id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.type,
+        fw.created_at,
+        fw.updated_at,
+        pfw.role,
+        p.id as person_id,
+        p.full_name,
+        g.id as genre_id,
+        g.name
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id
+'''
+
+FLAT_DETAILS_QUERY = FLAT_DETAILS_SELECT + '''
+    WHERE fw.id = ANY(%s::uuid[]);
+'''
+
+AGGREGATED_DETAILS_SELECT = '''
+    SELECT
+        fw.id as fw_id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.type,
+        fw.created_at,
+        fw.updated_at,
+        COALESCE(g.genres, ARRAY[]::text[]) as genres,
+        COALESCE(p.actors, '[]'::json) as actors,
+        COALESCE(p.writers, '[]'::json) as writers,
+        p.director,
+        -- Для приёмников persons и genres: режиссёры и жанры с id
+        COALESCE(p.directors, '[]'::json) as directors,
+        COALESCE(g.genre_items, '[]'::jsonb) as genre_items
+    FROM content.film_work fw
+    LEFT JOIN LATERAL (
+        SELECT
+            array_agg(DISTINCT g.name) as genres,
+            jsonb_agg(DISTINCT jsonb_build_object('id', g.id::text,
+                                                  'name', g.name))
+                as genre_items
+        FROM content.genre_film_work gfw
+        JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE gfw.film_work_id = fw.id AND g.name <> ''
+    ) g ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT
+            json_agg(json_build_object('id', pr.id::text,
+                                       'name', pr.full_name)
+                     ORDER BY pr.full_name)
+                FILTER (WHERE pr.role = 'actor') as actors,
+            json_agg(json_build_object('id', pr.id::text,
+                                       'name', pr.full_name)
+                     ORDER BY pr.full_name)
+                FILTER (WHERE pr.role = 'writer') as writers,
+            max(pr.full_name COLLATE "C")
+                FILTER (WHERE pr.role = 'director') as director,
+            json_agg(json_build_object('id', pr.id::text,
+                                       'name', pr.full_name)
+                     ORDER BY pr.full_name)
+                FILTER (WHERE pr.role = 'director') as directors
+        FROM (
+            SELECT DISTINCT pfw.role, p.id, p.full_name
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ) pr
+    ) p ON TRUE
+'''
+
+AGGREGATED_DETAILS_QUERY = AGGREGATED_DETAILS_SELECT + '''
+    WHERE fw.id = ANY(%s::uuid[]);
+'''
+
+DETAILS_SELECTS = {'flat': FLAT_DETAILS_SELECT,
+                   'aggregated': AGGREGATED_DETAILS_SELECT}
+
+# Условия потокового чтения подробностей: сортировка по id фильма
+# ставит строки одного фильма подряд, и документ можно собрать,
+# не дожидаясь конца выборки
+STREAM_BY_IDS_FILTER = '''
+    WHERE fw.id = ANY(%s::uuid[])
+    ORDER BY fw.id;
+'''
+
+# Фильм считается изменённым с since и при изменении его персон
+# или жанров, как в потоках person и genre
+STREAM_SINCE_FILTER = '''
+    WHERE %(since)s::timestamptz IS NULL
+       OR fw.updated_at >= %(since)s::timestamptz
+       OR EXISTS (
+           SELECT 1
+           FROM content.person_film_work pfw
+           JOIN content.person p ON p.id = pfw.person_id
+           WHERE pfw.film_work_id = fw.id
+             AND p.updated_at >= %(since)s::timestamptz
+       )
+       OR EXISTS (
+           SELECT 1
+           FROM content.genre_film_work gfw
+           JOIN content.genre g ON g.id = gfw.genre_id
+           WHERE gfw.film_work_id = fw.id
+             AND g.updated_at >= %(since)s::timestamptz
+       )
+    ORDER BY fw.id;
+'''
+
+ID_RANGE_QUERY = '''
+    SELECT id, updated_at
+    FROM content.{table}
+    WHERE (%s::uuid IS NULL OR id > %s::uuid)
+      AND (%s::uuid IS NULL OR id < %s::uuid)
+    ORDER BY id
+    LIMIT %s;
+'''
+
+UPDATED_PAGE_QUERY = '''
+    SELECT id, updated_at
+    FROM content.{table}
+    WHERE (updated_at, id) > (%s::timestamptz, %s::uuid)
+    ORDER BY updated_at, id
+    LIMIT %s;
+'''
+
+
+class BatchSizer:
+    """
+    Адаптивный размер страницы потоков изменений: пока страницы
+    приходят полными, размер удваивается до max_batch_size,
+    иначе сбрасывается к batch_size. Если запрос страницы дольше
+    latency_target секунд, Postgres перегружен и размер уменьшается
+    вдвое
+    """
+
+    def __init__(self, batch_size: int = 100,
+                 max_batch_size: Optional[int] = None,
+                 latency_target: Optional[float] = None) -> None:
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size or batch_size
+        self.latency_target = latency_target
+        self.batch_sizes = {}
+        self.full_pages = {}
+        self.fill = {}
+        self.throttled = {}
+
+    def limit(self, stream: str) -> int:
+        return self.batch_sizes.get(stream, self.batch_size)
+
+    def update(self, stream: str, limit: int, fetched: int,
+               elapsed: float = 0.0) -> None:
+        full = fetched >= limit
+        self.full_pages[stream] = full
+        self.fill[stream] = min(fetched / limit, 1.0)
+        if self.latency_target and elapsed > self.latency_target:
+            self.batch_sizes[stream] = max(limit // 2, 1)
+            self.throttled[stream] = self.throttled.get(stream, 0) + 1
+            logger.info(f'{stream} page of {limit} took {elapsed:.2f}s, '
+                        f'batch size decreased to '
+                        f'{self.batch_sizes[stream]}')
+        elif full:
+            self.batch_sizes[stream] = min(limit * 2, self.max_batch_size)
+        else:
+            self.batch_sizes[stream] = self.batch_size
+
+    def fullness(self, stream: str) -> float:
+        """
+        Доля заполненной последней страницы потока
+        """
+        return self.fill.get(stream, 0.0)
+
+    def has_backlog(self, stream: Optional[str] = None) -> bool:
+        if stream is not None:
+            return self.full_pages.get(stream, False)
+        return any(self.full_pages.values())
+
+
+# Имена серверных курсоров уникальны в пределах соединения
+_stream_ids = count()
+
 
 class PostgresBase:
     """
     Базовый класс для работы с Postgres
     """
 
-    def __init__(self, connection_params: dict) -> None:
+    def __init__(self, connection_params: dict,
+                 pool: Optional[PostgresPool] = None) -> None:
         self.connection_params = connection_params
+        # Все экземпляры по умолчанию берут соединения из общего пула
+        self.pool = pool or get_pool(connection_params)
 
-    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10)
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='postgres')
     def _fetch_data(self, query, params) -> list:
-        with pg_connection(self.connection_params) as conn:
+        with self.pool.connection() as conn:
             with conn.cursor(cursor_factory=DictCursor) as cursor:
                 cursor.execute(query, params)
                 return cursor.fetchall()
 
+    def _stream_data(self, query, params,
+                     itersize: int = 2000) -> Iterator[tuple]:
+        """
+        Построчное чтение результата через именованный (серверный) курсор.
+
+        Postgres отдаёт строки порциями по itersize, поэтому в памяти
+        одна порция, сколько бы строк ни вернул запрос. Строки -
+        namedtuple, без словаря на каждую. Соединение занято, пока
+        генератор не исчерпан или не закрыт. Повторов нет: после
+        ошибки в середине выборку нужно начинать заново
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(name=f'etl_stream_{next(_stream_ids)}',
+                             cursor_factory=NamedTupleCursor) as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, params)
+                yield from cursor
+
 
 class PostgresInricher(PostgresBase):
     """
     Класс для получения подробной информации о фильмах и персонах
     """
 
-    def fetch_related_film_works(self, person_ids: List[str]) -> list:
+    def fetch_related_film_works(self, person_ids: List[str],
+                                 after: Optional[Cursor] = None,
+                                 limit: int = 100) -> list:
         """
         Получение списка фильмов, в которых участвует персона
         """
+        return self.fetch_related_page('person', person_ids, after, limit)
 
-        # Преобразование строк в UUID
-        str_person_ids = [str(id) for id in person_ids]
+    def fetch_related_film_works_by_genre(self, genre_ids: List[str],
+                                          after: Optional[Cursor] = None,
+                                          limit: int = 100) -> list:
+        """
+        Получение списка фильмов, связанных с определёнными жанрами.
+        """
+        return self.fetch_related_page('genre', genre_ids, after, limit)
 
-        query = '''
-                SELECT DISTINCT fw.id, fw.updated_at
-                FROM content.film_work fw
-                JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-                WHERE pfw.person_id = ANY(%s::uuid[])
-                ORDER BY fw.updated_at
-                LIMIT 100;
-                '''
-        return self._fetch_data(query, (str_person_ids,))
+    def fetch_person_names(self, person_ids: List[str]) -> list:
+        """
+        Имена персон и признак режиссёра
+        """
+        return self._fetch_data(PERSON_NAMES_QUERY,
+                                ([str(id) for id in person_ids],))
 
-    def fetch_related_film_works_by_genre(self, genre_ids: List[str]) -> list:
+    def fetch_genre_names(self, genre_ids: List[str]) -> list:
         """
-        Получение списка фильмов, связанных с определёнными жанрами.
+        Названия жанров
+        """
+        return self._fetch_data(GENRE_NAMES_QUERY,
+                                ([str(id) for id in genre_ids],))
+
+    def fetch_related_page(self, stream: str, ids: List[str],
+                           after: Optional[Cursor],
+                           limit: int) -> list:
+        """
+        Страница связанных фильмов строго после подкурсора
+        (updated_at, id) фильма
         """
         # Преобразование строк в UUID
-        str_genre_ids = [str(id) for id in genre_ids]
+        str_ids = [str(id) for id in ids]
+        after = after or Cursor(None, None)
+
+        return self._fetch_data(RELATED_QUERIES[stream],
+                                (str_ids,
+                                 after.updated_at or datetime.min,
+                                 after.id or NIL_UUID,
+                                 limit))
 
-        query = '''
-                SELECT DISTINCT fw.id, fw.updated_at
-                FROM content.film_work fw
-                JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-                WHERE gfw.genre_id = ANY(%s::uuid[])
-                ORDER BY fw.updated_at
-                LIMIT 100;
-                '''
-        return self._fetch_data(query, (str_genre_ids,))
+    def iter_related_film_works(self, stream: str, ids: List[str],
+                                limit: int = 500) -> Iterator[list]:
+        """
+        Все связанные фильмы страницами по limit
+        """
+        after = None
+        while True:
+            rows = self.fetch_related_page(stream, ids, after, limit)
+            if rows:
+                yield rows
+            if len(rows) < limit:
+                return
+            after = Cursor(rows[-1]['updated_at'], str(rows[-1]['id']))
 
 
 class PostgresMerger(PostgresBase):
     """
-    Класс для получения подробной информации о фильмах
+    Класс для получения подробной информации о фильмах.
+
+    Режим `flat` возвращает плоский LEFT JOIN (строка на каждую пару
+    персона x жанр), режим `aggregated` собирает жанры и персоны
+    на стороне Postgres и возвращает ровно одну строку на фильм.
     """
 
+    MODES = ('flat', 'aggregated')
+
+    def __init__(self, connection_params: dict,
+                 pool: Optional[PostgresPool] = None,
+                 mode: str = 'flat',
+                 itersize: int = 2000) -> None:
+        super().__init__(connection_params, pool)
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown merger mode: {mode}')
+        self.mode = mode
+        self.itersize = itersize
+
     def fetch_film_work_details(self, film_work_ids: List[str]) -> list:
         """
         Получение подробной информации о фильме
         """
+        if self.mode == 'aggregated':
+            return self.fetch_aggregated_film_work_details(film_work_ids)
+        return self.fetch_flat_film_work_details(film_work_ids)
+
+    def fetch_flat_film_work_details(self, film_work_ids: List[str]) -> list:
+        """
+        Получение подробной информации о фильме плоским JOIN
+        """
         # Преобразование UUID в строки для корректной работы с запросом
         str_film_work_ids = [str(id) for id in film_work_ids]
 
-        query = '''
-        SELECT
-            fw.id as fw_id,
-            fw.title,
-            fw.description,
-            fw.rating,
-            fw.type,
-            fw.created_at,
-            fw.updated_at,
-            pfw.role,
-            p.id as person_id,
-            p.full_name,
-            g.name
-        FROM content.film_work fw
-        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-        LEFT JOIN content.person p ON p.id = pfw.person_id
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.id = ANY(%s::uuid[]);
-        '''
-        return self._fetch_data(query, (str_film_work_ids,))
+        return self._fetch_data(FLAT_DETAILS_QUERY, (str_film_work_ids,))
+
+    def fetch_aggregated_film_work_details(self,
+                                           film_work_ids: List[str]) -> list:
+        """
+        Получение подробной информации о фильме одной строкой:
+        жанры, актёры, сценаристы и режиссёр агрегируются в Postgres
+        """
+        str_film_work_ids = [str(id) for id in film_work_ids]
+
+        return self._fetch_data(AGGREGATED_DETAILS_QUERY,
+                                (str_film_work_ids,))
+
+    def iter_film_work_details(self,
+                               film_work_ids: List[str]) -> Iterator[tuple]:
+        """
+        Потоковое чтение подробностей фильмов в режиме merger.
+
+        Строки одного фильма идут подряд (по порядку id), их собирает
+        transform.iter_film_work_documents
+        """
+        query = DETAILS_SELECTS[self.mode] + STREAM_BY_IDS_FILTER
+        return self._stream_data(query,
+                                 ([str(id) for id in film_work_ids],),
+                                 self.itersize)
+
+    def iter_catalogue(self, since: Optional[str] = None) -> Iterator[tuple]:
+        """
+        Потоковое чтение всего каталога (или фильмов, изменённых
+        начиная с since, в том числе через их персоны и жанры)
+        одним запросом
+        """
+        query = DETAILS_SELECTS[self.mode] + STREAM_SINCE_FILTER
+        return self._stream_data(query, {'since': since}, self.itersize)
+
+
+class PostgresScanner(PostgresBase):
+    """
+    Класс для полного обхода таблицы по диапазонам id
+    """
+
+    def fetch_id_range(self, table: str,
+                       after_id: Optional[str],
+                       before_id: Optional[str],
+                       limit: int) -> list:
+        """
+        Страница id из полуинтервала (after_id, before_id) по порядку id
+        """
+        query = ID_RANGE_QUERY.format(table=table)
+        return self._fetch_data(query, (after_id, after_id,
+                                        before_id, before_id, limit))
 
 
 class PostgresProducer(PostgresBase):
     """
-    Класс для получения обновленных ID
+    Класс для получения обновленных ID.
+
+    Обновления читаются постранично по составному курсору
+    (updated_at, id), поэтому записи с одинаковым updated_at
+    на границе страницы не теряются.
     """
 
+    # Таблица каждого потока изменений
+    TABLES = {'film': 'film_work', 'person': 'person', 'genre': 'genre'}
+
     def __init__(self, connection_params: dict,
-                 state_manager: State) -> None:
-        super().__init__(connection_params)
+                 state_manager: State,
+                 pool: Optional[PostgresPool] = None,
+                 batch_size: int = 100,
+                 max_batch_size: Optional[int] = None,
+                 latency_target: Optional[float] = None) -> None:
+        super().__init__(connection_params, pool)
         self.state_manager = state_manager
+        self.sizer = BatchSizer(batch_size, max_batch_size, latency_target)
 
     def fetch_updated_film_work_ids(self) -> list:
         """
         Получение обновленных ID фильмов.
         """
-        last_film_update = (self.state_manager.get_state('last_film_update')
-                            or datetime.min)
-        query = '''
-        SELECT id, updated_at
-        FROM content.film_work
-        WHERE updated_at > %s
-        ORDER BY updated_at
-        LIMIT 100;
-        '''
-        return self._fetch_data(query, (last_film_update,))
+        return self.fetch_updated('film')
 
     def fetch_updated_person_ids(self) -> list:
         """
         Получение обновленных ID персон
         """
-        last_person_update = (
-                self.state_manager.get_state('last_person_update')
-                or datetime.min
-        )
-        query = '''
-        SELECT id, updated_at
-        FROM content.person
-        WHERE updated_at > %s
-        ORDER BY updated_at
-        LIMIT 100;
-        '''
-        return self._fetch_data(query, (last_person_update,))
+        return self.fetch_updated('person')
 
     def fetch_updated_genres(self) -> list:
         """
         Получение обновленных данных о жанрах.
         """
-        last_genre_update = (self.state_manager.get_state('last_genre_update')
-                             or datetime.min)
-        query = '''
-        SELECT id, updated_at
-        FROM content.genre
-        WHERE updated_at > %s
-        ORDER BY updated_at
-        LIMIT 100;
-        '''
-        return self._fetch_data(query, (last_genre_update,))
+        return self.fetch_updated('genre')
+
+    def has_backlog(self) -> bool:
+        """
+        Вернула ли хотя бы одна из последних выборок полную страницу
+        """
+        return self.sizer.has_backlog()
+
+    def fullness(self, stream: str) -> float:
+        """
+        Доля заполненной последней страницы потока
+        """
+        return self.sizer.fullness(stream)
+
+    def fetch_page(self, table: str, cursor: Cursor, limit: int) -> list:
+        """
+        Страница записей таблицы строго после курсора (updated_at, id)
+        """
+        query = UPDATED_PAGE_QUERY.format(table=table)
+        return self._fetch_data(query, (cursor.updated_at or datetime.min,
+                                        cursor.id or NIL_UUID,
+                                        limit))
+
+    def fetch_updated(self, stream: str,
+                      cursor: Optional[Cursor] = None) -> list:
+        """
+        Получение следующей страницы обновлений после курсора потока.
+
+        Без явного курсора используется сохранённый в состоянии.
+        """
+        if cursor is None:
+            cursor = self.state_manager.get_cursor(stream)
+        limit = self.sizer.limit(stream)
+        started = time.monotonic()
+        rows = self.fetch_page(self.TABLES[stream], cursor, limit)
+        self.sizer.update(stream, limit, len(rows),
+                          time.monotonic() - started)
+        return rows
@@ -0,0 +1,134 @@
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+from extract import RELATED_QUERIES, PostgresInricher
+from state_manager import Cursor, State
+
+logger = logging.getLogger('fanout')
+
+
+def dump_cursor(cursor: Cursor) -> list:
+    """
+    Курсор в виде, пригодном для JSON-состояния
+    """
+    updated_at = cursor.updated_at
+    if isinstance(updated_at, datetime):
+        updated_at = updated_at.isoformat()
+    return [updated_at, None if cursor.id is None else str(cursor.id)]
+
+
+@dataclass
+class FanOutJob:
+    """
+    Переиндексация фильмов, связанных с пачкой персон или жанров.
+
+    cursor - курсор потока после пачки, он сохраняется только когда
+    обойдены все связанные фильмы; after - подкурсор по фильмам.
+    """
+    stream: str
+    ids: List[str]
+    cursor: Cursor
+    after: Cursor = Cursor(None, None)
+    done: bool = False
+    processed: int = 0
+    # Задание уже записано в состояние
+    persisted: bool = False
+
+    def as_state(self) -> dict:
+        return {'ids': [str(id) for id in self.ids],
+                'cursor': dump_cursor(self.cursor),
+                'after': dump_cursor(self.after),
+                'processed': self.processed}
+
+    @classmethod
+    def from_state(cls, stream: str, value: dict) -> 'FanOutJob':
+        return cls(stream, value['ids'], Cursor(*value['cursor']),
+                   Cursor(*value['after']),
+                   processed=value.get('processed', 0), persisted=True)
+
+
+class FanOut:
+    """
+    Возобновляемое разветвление изменений персон и жанров на фильмы.
+
+    Связанные фильмы читаются порциями по chunk_size, за цикл
+    обрабатывается одна порция на поток, поэтому большое
+    разветвление не задерживает поток фильмов. Незавершённое
+    разветвление хранится в состоянии под ключом fanout_{stream}
+    и после перезапуска продолжается с подкурсора.
+    """
+
+    STREAMS = tuple(RELATED_QUERIES)
+
+    def __init__(self, inricher: PostgresInricher,
+                 state_manager: State,
+                 chunk_size: int = 500) -> None:
+        self.inricher = inricher
+        self.state_manager = state_manager
+        self.chunk_size = chunk_size
+        self._pending = set()
+
+    @staticmethod
+    def key(stream: str) -> str:
+        return f'fanout_{stream}'
+
+    def pending(self, stream: str) -> Optional[FanOutJob]:
+        """
+        Незавершённое разветвление потока из состояния
+        """
+        value = self.state_manager.get_state(self.key(stream))
+        if not value:
+            return None
+        return FanOutJob.from_state(stream, value)
+
+    def has_pending(self, stream: Optional[str] = None) -> bool:
+        """
+        Осталось ли незавершённое разветвление после последней порции
+        """
+        if stream is not None:
+            return stream in self._pending
+        return bool(self._pending)
+
+    def next_chunk(self, job: FanOutJob) -> List[str]:
+        """
+        Очередная порция id связанных фильмов; сдвигает подкурсор задания
+        """
+        rows = self.inricher.fetch_related_page(job.stream, job.ids,
+                                                job.after, self.chunk_size)
+        return self.advance(job, rows)
+
+    def advance(self, job: FanOutJob, rows: list) -> List[str]:
+        """
+        Сдвиг подкурсора задания по прочитанной странице связанных
+        фильмов (её читает next_chunk или асинхронный движок)
+        """
+        if rows:
+            job.after = Cursor(rows[-1]['updated_at'], str(rows[-1]['id']))
+        job.processed += len(rows)
+        job.done = len(rows) < self.chunk_size
+        if job.done:
+            self._pending.discard(job.stream)
+        else:
+            self._pending.add(job.stream)
+            logger.info(f'Fan-out of {len(job.ids)} {job.stream} updates: '
+                        f'{job.processed} films so far, continuing '
+                        f'next cycle.')
+        return [row['id'] for row in rows]
+
+    def save(self, job: FanOutJob) -> None:
+        """
+        Сохранение подкурсора или удаление завершённого задания.
+
+        Вызывается после загрузки порции; курсор потока завершённого
+        задания вызывающий сохраняет раньше, чем удаляется задание.
+        """
+        if job.done:
+            # Разветвление в одну порцию в состояние не попадает
+            if job.persisted:
+                self.state_manager.set_state(self.key(job.stream), None)
+        else:
+            self.state_manager.set_state(self.key(job.stream),
+                                         job.as_state())
+            job.persisted = True
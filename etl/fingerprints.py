@@ -0,0 +1,158 @@
+"""
+Кэш отпечатков загруженных документов.
+
+Для каждого документа хранится хэш его содержимого, и загрузчик
+отправляет в Elasticsearch только изменившиеся документы. Кэш лежит
+в SQLite рядом с etl_state.json. Если индекс пересоздан или кэш
+потерян, его можно пересобрать по содержимому индекса (из каталога etl):
+
+    python fingerprints.py rebuild --index movies
+"""
+import argparse
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Tuple
+
+import orjson
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+
+logger = logging.getLogger('fingerprints')
+
+# Поиск хэшей пачкой, не больше лимита параметров SQLite
+LOOKUP_CHUNK_SIZE = 500
+
+
+def fingerprint(document: Dict[str, Any]) -> str:
+    """
+    Хэш содержимого документа, не зависящий от порядка ключей
+    """
+    body = orjson.dumps(document, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Отпечатки документов по (индекс, id) в файле SQLite.
+
+    Отпечаток записывается только после того, как Elasticsearch
+    принял документ, поэтому несостоявшаяся загрузка повторится.
+    """
+
+    def __init__(self, path: str = 'etl_fingerprints.sqlite') -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                idx TEXT NOT NULL,
+                id TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (idx, id)
+            ) WITHOUT ROWID
+        ''')
+        self._conn.commit()
+
+    def filter_changed(
+            self, index: str, documents: List[Dict[str, Any]]
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+        """
+        Документы, чей отпечаток отличается от сохранённого,
+        и их новые отпечатки
+        """
+        hashes = {str(doc['id']): fingerprint(doc) for doc in documents}
+        stored = self.lookup(index, list(hashes))
+        changed = {doc_id: value for doc_id, value in hashes.items()
+                   if stored.get(doc_id) != value}
+        return ([doc for doc in documents if str(doc['id']) in changed],
+                changed)
+
+    def lookup(self, index: str, ids: List[str]) -> Dict[str, str]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+                chunk = ids[start:start + LOOKUP_CHUNK_SIZE]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT id, hash FROM fingerprints '
+                    f'WHERE idx = ? AND id IN ({placeholders})',
+                    (index, *chunk))
+                found.update(rows)
+        return found
+
+    def save(self, index: str, hashes: Dict[str, str]) -> None:
+        """
+        Запись отпечатков принятых документов
+        """
+        if not hashes:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO fingerprints (idx, id, hash) '
+                'VALUES (?, ?, ?)',
+                ((index, doc_id, value) for doc_id, value in hashes.items()))
+            self._conn.commit()
+
+    def forget(self, index: str, ids: List[str]) -> None:
+        """
+        Удаление отпечатков документов, изменённых в обход загрузчика
+        """
+        with self._lock:
+            self._conn.executemany(
+                'DELETE FROM fingerprints WHERE idx = ? AND id = ?',
+                ((index, str(doc_id)) for doc_id in ids))
+            self._conn.commit()
+
+    def clear(self, index: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM fingerprints WHERE idx = ?',
+                               (index,))
+            self._conn.commit()
+
+    def rebuild(self, es: Elasticsearch, index: str,
+                batch_size: int = 1000) -> int:
+        """
+        Пересборка отпечатков индекса по документам в Elasticsearch
+        """
+        self.clear(index)
+        total = 0
+        hashes = {}
+        for hit in scan(es, index=index, size=batch_size,
+                        query={'query': {'match_all': {}}}):
+            hashes[hit['_id']] = fingerprint(hit['_source'])
+            if len(hashes) >= batch_size:
+                self.save(index, hashes)
+                total += len(hashes)
+                hashes = {}
+        self.save(index, hashes)
+        total += len(hashes)
+        logger.info(f'Rebuilt {total} fingerprints for index {index}')
+        return total
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=('rebuild', 'clear'))
+    parser.add_argument('--index', default='movies')
+    args = parser.parse_args()
+
+    # Импорт внутри функции: settings сам импортирует этот модуль
+    from settings import elasticsearch_config, etl_config
+
+    store = FingerprintStore(etl_config.fingerprints_path)
+    if args.command == 'rebuild':
+        store.rebuild(Elasticsearch(elasticsearch_config.host), args.index)
+    else:
+        store.clear(args.index)
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import copy
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+from elasticsearch import Elasticsearch
+
+logger = logging.getLogger('indices')
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MOVIES_INDEX_BODY = os.path.join(BASE_DIR, 'movies_index.json')
+
+# Настройки индекса на время массовой загрузки
+BULK_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+def load_index_body(path: str = MOVIES_INDEX_BODY) -> Dict[str, Any]:
+    """
+    Настройки и маппинг индекса (тот же файл использует create_index.sh)
+    """
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def versioned_name(alias: str) -> str:
+    """
+    Имя нового версионированного индекса для алиаса
+    """
+    return f'{alias}_{datetime.now(timezone.utc):%Y%m%d%H%M%S}'
+
+
+def create_bulk_index(es: Elasticsearch, name: str,
+                      body: Dict[str, Any],
+                      replicas: int = 1) -> Dict[str, Any]:
+    """
+    Создание индекса с отключённым refresh и без реплик.
+
+    Возвращает настройки, которые нужно вернуть после загрузки.
+    """
+    body = copy.deepcopy(body)
+    settings = body.get('settings', {})
+    restore = {
+        'refresh_interval': settings.get('refresh_interval', '1s'),
+        'number_of_replicas': settings.get('number_of_replicas', replicas),
+    }
+    settings.update(BULK_SETTINGS)
+    es.indices.create(index=name, settings=settings,
+                      mappings=body.get('mappings'))
+    logger.info('Index %s created with bulk settings', name)
+    return restore
+
+
+def restore_settings(es: Elasticsearch, name: str,
+                     settings: Dict[str, Any]) -> None:
+    """
+    Возврат рабочих настроек индекса после загрузки
+    """
+    es.indices.put_settings(index=name, settings={'index': settings})
+    es.indices.refresh(index=name)
+
+
+def force_merge(es: Elasticsearch, name: str) -> None:
+    """
+    Слияние сегментов индекса в один (может занять много времени)
+    """
+    es.options(request_timeout=3600).indices.forcemerge(
+        index=name, max_num_segments=1)
+
+
+def swap_alias(es: Elasticsearch, alias: str, index: str) -> List[str]:
+    """
+    Атомарное переключение алиаса на новый индекс.
+
+    Если под именем алиаса существует обычный индекс (как создаёт
+    create_index.sh), он удаляется в той же операции.
+    Возвращает индексы, с которых был снят алиас.
+    """
+    actions: List[Dict[str, Any]] = []
+    previous: List[str] = []
+    if es.indices.exists_alias(name=alias):
+        previous = list(es.indices.get_alias(name=alias).keys())
+        actions.extend({'remove': {'index': old, 'alias': alias}}
+                       for old in previous if old != index)
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    es.indices.update_aliases(actions=actions)
+    logger.info('Alias %s now points to %s', alias, index)
+    return [old for old in previous if old != index]
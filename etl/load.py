@@ -1,35 +1,436 @@
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+from dataclasses import dataclass, field
+from elasticsearch import (ApiError, ConnectionError as ESConnectionError,
+                           Elasticsearch)
+from itertools import islice
 import logging
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Set, Tuple, Union)
+
+import orjson
+
+from deadletter import DeadLetterStore
+from fingerprints import FingerprintStore
+from metrics import count_documents, count_retry
+from resilience import (BulkThrottle, get_breaker, is_pressure, is_retryable,
+                        jittered_delay)
 from utils import backoff
 
+# Документ, подготовленный к отправке: (id, строки action + source)
+BulkLine = Tuple[str, bytes]
+
+# Сериализация документа в строки bulk-запроса (индекс, документ)
+Serializer = Callable[[str, Dict[str, Any]], bytes]
+
+
+class BulkError(Exception):
+    """
+    Часть документов bulk-запроса не была проиндексирована
+    """
+
+
+@dataclass
+class LoadReport:
+    """
+    Итоги одной загрузки в Elasticsearch
+    """
+    indexed: int = 0
+    retried: int = 0
+    rejected: int = 0
+    skipped: int = 0
+    requests: int = 0
+    bytes_sent: int = 0
+    elapsed: float = 0.0
+    failed: List[Tuple[str, Any]] = field(default_factory=list)
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.indexed / self.elapsed if self.elapsed else 0.0
+
+    def merge(self, other: 'LoadReport') -> None:
+        self.indexed += other.indexed
+        self.retried += other.retried
+        self.rejected += other.rejected
+        self.skipped += other.skipped
+        self.requests += other.requests
+        self.bytes_sent += other.bytes_sent
+        self.failed.extend(other.failed)
+
+
+def to_bulk_lines(index: str, movie_data: Dict[str, Any]) -> bytes:
+    """
+    Строки action и source одного документа в формате NDJSON
+    """
+    action = orjson.dumps({'index': {'_index': index,
+                                     '_id': movie_data['id']}})
+    return action + b'\n' + orjson.dumps(movie_data) + b'\n'
+
+
+def to_bulk_ndjson(index: str, data: Iterable[Dict[str, Any]],
+                   serialize: Serializer = to_bulk_lines) -> bytes:
+    """
+    Сериализация документов сразу в тело bulk-запроса (NDJSON)
+    """
+    return b''.join(serialize(index, movie_data) for movie_data in data)
+
+
+def iter_bulk_chunks(index: str, data: Iterable[Dict[str, Any]],
+                     chunk_size: Union[int, Callable[[], int]],
+                     max_chunk_bytes: int,
+                     serialize: Serializer = to_bulk_lines
+                     ) -> Iterator[List[BulkLine]]:
+    """
+    Нарезка документов на чанки по количеству и размеру в байтах.
+
+    chunk_size может быть функцией: тогда размер каждого чанка
+    берётся заново, например у BulkThrottle
+    """
+    chunk: List[BulkLine] = []
+    size = 0
+    for movie_data in data:
+        lines = serialize(index, movie_data)
+        limit = chunk_size() if callable(chunk_size) else chunk_size
+        if chunk and (len(chunk) >= limit
+                      or size + len(lines) > max_chunk_bytes):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((movie_data['id'], lines))
+        size += len(lines)
+    if chunk:
+        yield chunk
+
+
+def collect_bulk_items(chunk: List[BulkLine], items: List[dict],
+                       report: LoadReport) -> List[BulkLine]:
+    """
+    Разбор ответа bulk: возвращает отклонённые (429) документы для повтора
+    """
+    retry = []
+    for bulk_line, item in zip(chunk, items):
+        # Ответ по действию документа: index, update или delete
+        result = next(iter(item.values()))
+        if 'error' not in result:
+            report.indexed += 1
+        elif result.get('status') == 429:
+            report.rejected += 1
+            retry.append(bulk_line)
+        else:
+            report.failed.append((bulk_line[0], result['error']))
+    return retry
+
+
+def skip_unchanged(fingerprints: Optional[FingerprintStore],
+                   index: str, data: List[Dict[str, Any]],
+                   logger: logging.Logger
+                   ) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    Отбрасывание документов, не изменившихся с прошлой загрузки
+    """
+    if fingerprints is None or not data:
+        return data, {}
+    changed, hashes = fingerprints.filter_changed(index, data)
+    skipped = len(data) - len(changed)
+    logger.info(f'Skipped {skipped} of {len(data)} unchanged documents '
+                f'({skipped / len(data):.0%})')
+    return changed, hashes
+
+
+def save_fingerprints(fingerprints: Optional[FingerprintStore],
+                      index: str, hashes: Dict[str, str],
+                      report: 'LoadReport') -> None:
+    """
+    Запоминание отпечатков документов, принятых Elasticsearch
+    """
+    if fingerprints is None or not hashes:
+        return
+    failed = {str(doc_id) for doc_id, _ in report.failed}
+    fingerprints.save(index, {doc_id: value
+                              for doc_id, value in hashes.items()
+                              if doc_id not in failed})
+
+
+def merge_futures(report: LoadReport,
+                  futures: Iterable[Future]) -> Optional[BaseException]:
+    """
+    Итоги завершённых чанков в report; возвращает первую ошибку
+    """
+    error = None
+    for future in futures:
+        exception = future.exception()
+        if exception is None:
+            report.merge(future.result())
+        elif error is None:
+            error = exception
+    return error
+
+
+def count_load_report(report: LoadReport) -> None:
+    """
+    Итоги загрузки в метрики документов
+    """
+    count_documents('indexed', report.indexed)
+    count_documents('skipped', report.skipped)
+    count_documents('rejected', report.rejected)
+    count_documents('retried', report.retried)
+    count_documents('failed', len(report.failed))
+
+
+def log_load_report(logger: logging.Logger, report: LoadReport) -> None:
+    """
+    Итоги загрузки и окончательно не принятые документы в лог
+    """
+    logger.info(f'Successfully indexed {report.indexed} documents '
+                f'in {report.requests} requests '
+                f'({report.docs_per_second:.0f} docs/s, '
+                f'{report.rejected} rejected, '
+                f'{report.retried} retried)')
+    for doc_id, error in report.failed:
+        logger.warning('Document %s was not indexed: %s', doc_id, error)
+
 
 class ElasticsearchLoader:
     """
-    Класс для загрузки данных в Elasticsearch
+    Класс для загрузки данных в Elasticsearch.
+
+    В режиме `simple` пачка уходит одним bulk-запросом и при любой
+    ошибке повторяется целиком. В режиме `streaming` документы режутся
+    на чанки по количеству и размеру в байтах, до `concurrency` чанков
+    отправляются параллельно, повторяются только отклонённые (429)
+    документы, а окончательно не принятые попадают в отчёт.
+
+    С кэшем отпечатков `fingerprints` документы, не изменившиеся
+    с прошлой загрузки, не отправляются.
+
+    В потоковом режиме размер чанка и число запросов в полёте
+    регулирует `throttle` (AIMD): отказы 429 и медленные ответы
+    уменьшают их, успешные запросы возвращают к chunk_size и
+    concurrency. Ошибки соединения размыкают общий предохранитель
+    Elasticsearch.
     """
-    def __init__(self, es_host: str) -> None:
+    def __init__(self, es_host: str,
+                 mode: str = 'simple',
+                 chunk_size: int = 500,
+                 max_chunk_bytes: int = 10 * 1024 * 1024,
+                 concurrency: int = 4,
+                 max_retries: int = 5,
+                 initial_backoff: float = 0.5,
+                 max_backoff: float = 10.0,
+                 fingerprints: Optional[FingerprintStore] = None,
+                 dead_letters: Optional[DeadLetterStore] = None,
+                 throttle: Optional[BulkThrottle] = None) -> None:
         self.es = Elasticsearch(es_host)
         self.logger = logging.getLogger('elasticsearch_loader')
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.fingerprints = fingerprints
+        self.dead_letters = dead_letters
+        self.throttle = throttle or BulkThrottle(chunk_size, concurrency)
+        self.breaker = get_breaker('elasticsearch')
+        self.last_report = LoadReport()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix='bulk')
+
+    def bulk_load(self, index: str, data: list,
+                  serialize: Serializer = to_bulk_lines) -> int:
+        """
+        Загрузка данных в Elasticsearch.
+
+        serialize задаёт действие bulk для документа (по умолчанию
+        index целиком)
+        """
+        if not data:
+            return 0
+        changed, hashes = skip_unchanged(self.fingerprints, index, data,
+                                         self.logger)
+        if not changed:
+            report = LoadReport()
+        elif self.mode == 'streaming':
+            report = self.streaming_load(index, changed, serialize)
+            if self.dead_letters is not None:
+                self.dead_letters.add_failed(index, report.failed, changed)
+        else:
+            report = LoadReport()
+            report.indexed = self.bulk_load_ndjson(
+                to_bulk_ndjson(index, changed, serialize), report)
+        report.skipped = len(data) - len(changed)
+        self.last_report = report
+        save_fingerprints(self.fingerprints, index, hashes, report)
+        count_load_report(report)
+        return report.indexed
 
-    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10)
-    def bulk_load(self, index: str, data: list) -> int:
+    def load_stream(self, index: str, documents: Iterable[Dict[str, Any]],
+                    batch_size: int = 5000) -> int:
         """
-        Загрузка данных в Elasticsearch
+        Загрузка генератора документов без сбора его в список.
+
+        В потоковом режиме без отпечатков документы сразу режутся
+        на чанки, в памяти только чанки в полёте. Иначе документы
+        идут через bulk_load пачками по batch_size
         """
-        actions = [
-            {
-                '_index': index,
-                '_id': movie_data['id'],
-                '_source': movie_data
-            }
-            for movie_data in data
-        ]
+        if self.mode == 'streaming' and self.fingerprints is None:
+            report = self.streaming_load(index, documents)
+            if self.dead_letters is not None:
+                self.dead_letters.add_failed(index, report.failed)
+            count_load_report(report)
+            return report.indexed
+
+        started = time.monotonic()
+        report = LoadReport()
+        documents = iter(documents)
+        while batch := list(islice(documents, batch_size)):
+            self.bulk_load(index, batch)
+            report.merge(self.last_report)
+        report.elapsed = time.monotonic() - started
+        self.last_report = report
+        return report.indexed
 
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def bulk_load_ndjson(self, body: bytes,
+                         report: Optional[LoadReport] = None) -> int:
+        """
+        Отправка готового NDJSON тела bulk-запроса.
+
+        Клиент передаёт байты как есть, без повторной сериализации.
+        Запрос с ошибками документов повторяется целиком. С очередью
+        недоставленных документы с ошибками, которые повтор не
+        исправит, откладываются в неё (и в report.failed), а
+        остальное считается загруженным
+        """
         try:
-            success, _ = bulk(self.es, actions, stats_only=True)
-            self.logger.info(f'Successfully indexed {success} documents')
-            return success
+            response = self.es.bulk(operations=body)
         except Exception as e:
             self.logger.debug('Error during bulk index: %s', e)
             raise
+
+        items = response['items']
+        results = [next(iter(item.values())) for item in items]
+        failed = [result for result in results if 'error' in result]
+        if failed:
+            self.logger.debug('Bulk index errors: %s', failed[:5])
+            rejected = [result for result in failed
+                        if result.get('status') == 429]
+            if self.dead_letters is None or rejected:
+                raise BulkError(f'{len(failed)} of {len(items)} '
+                                f'documents failed to index')
+            self.dead_letters.add_bulk_failures(body, failed)
+            if report is not None:
+                report.failed.extend((result.get('_id'), result['error'])
+                                     for result in failed)
+
+        success = len(items) - len(failed)
+        self.logger.info(f'Successfully indexed {success} documents')
+        return success
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def update_by_query(self, index: str, query: Dict[str, Any],
+                        script: Dict[str, Any]) -> int:
+        """
+        Скрипт по документам запроса (без refresh); документы,
+        изменённые параллельно, пропускаются. Возвращает число
+        обновлённых документов
+        """
+        response = self.es.update_by_query(index=index, query=query,
+                                           script=script,
+                                           conflicts='proceed',
+                                           refresh=False)
+        if response.get('failures'):
+            self.logger.warning('Update by query failures: %s',
+                                response['failures'][:5])
+        return response['updated']
+
+    def streaming_load(self, index: str,
+                       data: Iterable[Dict[str, Any]],
+                       serialize: Serializer = to_bulk_lines
+                       ) -> LoadReport:
+        """
+        Потоковая загрузка с несколькими bulk-запросами в полёте.
+
+        Ошибки соединения после max_retries попыток пробрасываются,
+        чтобы вызывающий не сдвигал чекпоинт.
+        """
+        started = time.monotonic()
+        report = LoadReport()
+        in_flight: Set[Future] = set()
+
+        try:
+            chunks = iter_bulk_chunks(index, data,
+                                      lambda: self.throttle.chunk_size,
+                                      self.max_chunk_bytes, serialize)
+            for chunk in chunks:
+                while len(in_flight) >= self.throttle.concurrency:
+                    done, in_flight = wait(in_flight,
+                                           return_when=FIRST_COMPLETED)
+                    error = merge_futures(report, done)
+                    if error is not None:
+                        raise error
+                in_flight.add(self._executor.submit(self._send_chunk, chunk))
+        except BaseException:
+            # Запросы в полёте дожидаются, но пробрасывается исходная
+            # ошибка, а не ошибки этих запросов
+            done, _ = wait(in_flight)
+            merge_futures(report, done)
+            raise
+        done, _ = wait(in_flight)
+        error = merge_futures(report, done)
+        if error is not None:
+            raise error
+
+        report.elapsed = time.monotonic() - started
+        self.last_report = report
+        log_load_report(self.logger, report)
+        return report
+
+    def _send_chunk(self, chunk: List[BulkLine]) -> LoadReport:
+        """
+        Отправка чанка с повтором только отклонённых документов
+        """
+        report = LoadReport()
+        delay = self.initial_backoff
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                report.retried += len(chunk)
+                count_retry('ElasticsearchLoader.bulk')
+                time.sleep(jittered_delay(delay))
+                delay = min(delay * 2, self.max_backoff)
+            # Пока предохранитель разомкнут, запросы не отправляются
+            while wait_time := self.breaker.retry_after():
+                time.sleep(wait_time)
+
+            body = b''.join(lines for _, lines in chunk)
+            report.requests += 1
+            report.bytes_sent += len(body)
+            started = time.monotonic()
+            try:
+                response = self.es.bulk(operations=body)
+            except (ApiError, ESConnectionError) as e:
+                self.breaker.record_error(e)
+                if is_pressure(e):
+                    self.throttle.observe(time.monotonic() - started, True)
+                    report.rejected += len(chunk)
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                self.logger.info('Bulk request failed: %s. Retrying in %s '
+                                 'seconds...', e, delay)
+                continue
+            self.breaker.record_success()
+
+            rejected = report.rejected
+            chunk = collect_bulk_items(chunk, response['items'], report)
+            self.throttle.observe(time.monotonic() - started,
+                                  report.rejected > rejected)
+            if not chunk:
+                return report
+
+        report.failed.extend((doc_id, 'rejected: retries exhausted')
+                             for doc_id, _ in chunk)
+        return report
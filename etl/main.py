@@ -1,115 +1,313 @@
-from utils import create_etl_state_json
 from load import ElasticsearchLoader
 from extract import PostgresProducer, PostgresInricher, PostgresMerger
-from transform import transform_film_work_details
 import logging
-from configs import PostgresConfig, LoggingConfig, ElasticsearchConfig
-from state_manager import State, JsonFileStorage
-from dotenv import load_dotenv
+from coalesce import CoalesceStats, coalesce_batches
+from deadletter import configure_dead_letters
+from fanout import FanOut
+from notify import ChangeEvent, ChangeListener
+from partial import PartialUpdater
+from pool import get_pool
+from metrics import (count_coalesced, start_metrics_server, watch_pool,
+                     watch_spool)
+from pipeline import Batch, Pipeline, Stage, StreamSource
+from resilience import snapshot
+from scheduler import StreamScheduler
+from settings import (create_dead_letters, create_es_loader,
+                      create_fingerprints, create_sinks, create_spool,
+                      create_state_manager, etl_config, metrics_config,
+                      postgres_config, postgres_pool_config,
+                      resilience_config)
+from spool import SpoolReplayer, SpoolWriter
+from stages import (checkpoint_batch, checkpoint_batches, extract_batch,
+                    extract_chunk, load_batch, merge_batch, transform_batch)
+from state_manager import State
+from functools import partial
 import time
-from typing import Optional
+from typing import Iterable, List, Optional
 
-# Загрузка конфигурации
-load_dotenv()
-postgres_config = PostgresConfig().dict()
-logging_config = LoggingConfig()
-elasticsearch_config = ElasticsearchConfig()
+logger = logging.getLogger(__name__)
 
-# Настройка логирования
-logging.basicConfig(level=getattr(logging, logging_config.level),
-                    format=logging_config.format)
 
-logger = logging.getLogger(__name__)
+def create_scheduler() -> StreamScheduler:
+    return StreamScheduler(PostgresProducer.TABLES,
+                           min_sleep=etl_config.idle_sleep,
+                           max_sleep=etl_config.idle_max_sleep,
+                           factor=etl_config.idle_backoff_factor,
+                           drain=etl_config.drain)
 
 
-# Основной код ETL процесса
-def update_films(producer: PostgresProducer,
-                 merger: PostgresMerger,
-                 es_loader: ElasticsearchLoader) -> Optional[int]:
+def stream_fullness(producer: PostgresProducer, fanout: FanOut,
+                    stream: str) -> float:
     """
-    Обновление данных о фильмах
+    Заполненность потока для планировщика: незавершённое
+    разветвление считается полной страницей
     """
-    updated_film_work_ids = producer.fetch_updated_film_work_ids()
-    if not updated_film_work_ids:
-        logger.info('No film updates found.')
-        return
-
-    film_work_details = merger.fetch_film_work_details(
-        [film['id'] for film in updated_film_work_ids])
+    if fanout.has_pending(stream):
+        return 1.0
+    return producer.fullness(stream)
 
-    transformed_data = transform_film_work_details(film_work_details)
 
-    try:
-        es_loader.bulk_load('movies', transformed_data)
-        logger.info(f'Successfully loaded {len(transformed_data)} '
-                    f'films to Elasticsearch.')
+# Основной код ETL процесса
+def update_stream(stream: str,
+                  producer: PostgresProducer,
+                  fanout: FanOut,
+                  merger: PostgresMerger,
+                  es_loader: ElasticsearchLoader,
+                  updater: Optional[PartialUpdater] = None
+                  ) -> Optional[Batch]:
+    """
+    Последовательная обработка одной пачки потока всеми стадиями
+    """
+    batch = extract_batch(producer, fanout, stream, updater)
+    if batch is None:
+        return None
+    if not batch.film_ids:
+        return batch
+    batch = merge_batch(merger, batch)
+    batch = transform_batch(merger, batch)
+    batch = load_batch(es_loader, batch)
+    return batch
 
-    except Exception as e:
-        logger.debug('Failed to load film data into Elasticsearch: %s', e)
-        raise
 
-    return max(film['updated_at'] for film in updated_film_work_ids)
+def update_films(producer: PostgresProducer,
+                 fanout: FanOut,
+                 merger: PostgresMerger,
+                 es_loader: ElasticsearchLoader,
+                 updater: Optional[PartialUpdater] = None
+                 ) -> Optional[Batch]:
+    """
+    Обновление данных о фильмах
+    """
+    return update_stream('film', producer, fanout, merger, es_loader,
+                         updater)
 
 
-def update_persons(producer, inricher, merger, es_loader) -> Optional[int]:
+def update_persons(producer: PostgresProducer,
+                   fanout: FanOut,
+                   merger: PostgresMerger,
+                   es_loader: ElasticsearchLoader,
+                   updater: Optional[PartialUpdater] = None
+                   ) -> Optional[Batch]:
     """
     Обновление данных о персонах
     """
-    updated_person_ids = producer.fetch_updated_person_ids()
-    if not updated_person_ids:
-        logger.info('No person updates found.')
-        return
-
-    related_film_works = inricher.fetch_related_film_works(
-        [person['id'] for person in updated_person_ids])
-
-    film_work_details = merger.fetch_film_work_details(
-        [fw['id'] for fw in related_film_works])
-
-    transformed_data = transform_film_work_details(film_work_details)
-
-    try:
-        es_loader.bulk_load('movies', transformed_data)
-        logger.info('Successfully loaded related '
-                    'films to Elasticsearch.')
-    except Exception as e:
-        logger.debug('Failed to load person-related film '
-                     'data into Elasticsearch: %s', e)
-        raise
-
-    return max(person['updated_at'] for person in updated_person_ids)
+    return update_stream('person', producer, fanout, merger, es_loader,
+                         updater)
 
 
 def update_genres(producer: PostgresProducer,
-                  inricher: PostgresInricher,
+                  fanout: FanOut,
                   merger: PostgresMerger,
-                  es_loader: ElasticsearchLoader) -> Optional[int]:
+                  es_loader: ElasticsearchLoader,
+                  updater: Optional[PartialUpdater] = None
+                  ) -> Optional[Batch]:
     """
     Обновление данных о жанрах и связанных с ними фильмах
     """
-    updated_genre_ids = producer.fetch_updated_genres()
-    if not updated_genre_ids:
-        logger.info('No genre updates found.')
-        return
+    return update_stream('genre', producer, fanout, merger, es_loader,
+                         updater)
+
+
+def update_streams(producer: PostgresProducer,
+                   fanout: FanOut,
+                   merger: PostgresMerger,
+                   es_loader: ElasticsearchLoader,
+                   state_manager: State,
+                   updater: Optional[PartialUpdater] = None,
+                   streams: Optional[Iterable[str]] = None,
+                   scheduler: Optional[StreamScheduler] = None) -> bool:
+    """
+    Один цикл по потокам (по умолчанию всем), каждый поток загружается
+    отдельно. Возвращает False, если изменений нет
+    """
+    found = False
+    if streams is None:
+        streams = PostgresProducer.TABLES
+    for stream in streams:
+        started = time.monotonic()
+        batch = update_stream(stream, producer, fanout, merger, es_loader,
+                              updater)
+        if batch is not None:
+            if batch.film_ids and updater is not None:
+                updater.mark_stale()
+            checkpoint_batches(state_manager, fanout, [batch])
+            found = True
+        if scheduler is not None:
+            scheduler.record(stream,
+                             stream_fullness(producer, fanout, stream),
+                             time.monotonic() - started)
+    return found
+
+
+def update_coalesced(producer: PostgresProducer,
+                     fanout: FanOut,
+                     merger: PostgresMerger,
+                     es_loader: ElasticsearchLoader,
+                     state_manager: State,
+                     totals: CoalesceStats,
+                     updater: Optional[PartialUpdater] = None,
+                     streams: Optional[Iterable[str]] = None,
+                     scheduler: Optional[StreamScheduler] = None) -> bool:
+    """
+    Один цикл по потокам (по умолчанию всем): каждый затронутый фильм
+    загружается один раз, курсоры потоков сдвигаются вместе после
+    загрузки. Возвращает False, если изменений нет
+    """
+    streams = list(PostgresProducer.TABLES if streams is None else streams)
+    batches = []
+    elapsed = {}
+    for stream in streams:
+        started = time.monotonic()
+        batch = extract_batch(producer, fanout, stream, updater)
+        elapsed[stream] = time.monotonic() - started
+        if batch is not None:
+            batches.append(batch)
+
+    started = time.monotonic()
+    if batches:
+        work = coalesce_batches(batches)
+        if work.film_ids:
+            batch = Batch('coalesced', None, [], film_ids=work.film_ids)
+            batch = merge_batch(merger, batch)
+            batch = transform_batch(merger, batch)
+            load_batch(es_loader, batch)
+            if updater is not None:
+                updater.mark_stale()
+        checkpoint_batches(state_manager, fanout, batches)
+
+    if scheduler is not None:
+        # Общая загрузка делится поровну между потоками с изменениями
+        shared = (time.monotonic() - started) / max(len(batches), 1)
+        loaded = {batch.stream for batch in batches}
+        for stream in streams:
+            scheduler.record(stream,
+                             stream_fullness(producer, fanout, stream),
+                             elapsed[stream]
+                             + (shared if stream in loaded else 0.0))
+    if not batches:
+        return False
+
+    totals.merge(work.stats)
+    count_coalesced(work.stats)
+    logger.info(f'Coalesced {work.stats.affected} film updates into '
+                f'{work.stats.unique} documents '
+                f'({work.stats.duplicates} duplicates skipped; '
+                f'{totals.duplicates} in total, '
+                f'{totals.duplicate_ratio:.0%} of all updates).')
+    return True
+
+
+def update_events(events: List[ChangeEvent],
+                  inricher: PostgresInricher,
+                  merger: PostgresMerger,
+                  es_loader: ElasticsearchLoader) -> int:
+    """
+    Загрузка фильмов, затронутых уведомлениями об изменениях.
 
-    related_film_works = inricher.fetch_related_film_works_by_genre(
-        [genre['id'] for genre in updated_genre_ids])
+    Курсоры не сдвигаются: их по-прежнему двигает догоняющий проход
+    """
+    film_ids = dict.fromkeys(event.id for event in events
+                             if event.stream == 'film')
+    for stream in FanOut.STREAMS:
+        ids = [event.id for event in events if event.stream == stream]
+        if not ids:
+            continue
+        for page in inricher.iter_related_film_works(
+                stream, ids, etl_config.fanout_chunk_size):
+            film_ids.update(dict.fromkeys(str(fw['id']) for fw in page))
+
+    if film_ids:
+        batch = Batch('notify', None, [], film_ids=list(film_ids))
+        batch = merge_batch(merger, batch)
+        batch = transform_batch(merger, batch)
+        load_batch(es_loader, batch)
+    return len(film_ids)
+
+
+def run_notify(producer: PostgresProducer,
+               inricher: PostgresInricher,
+               fanout: FanOut,
+               merger: PostgresMerger,
+               es_loader: ElasticsearchLoader,
+               state_manager: State,
+               updater: Optional[PartialUpdater] = None) -> None:
+    """
+    ETL процесс, разбуженный уведомлениями LISTEN/NOTIFY.
 
-    film_work_details = merger.fetch_film_work_details(
-        [fw['id'] for fw in related_film_works])
+    Изменённые фильмы загружаются сразу по id из уведомлений.
+    Проход по updated_at выполняется при (пере)подключении слушателя
+    и раз в catchup_interval секунд, подбирая пропущенные события
+    """
+    listener = ChangeListener(postgres_config)
+    if etl_config.coalesce:
+        update_cycle = partial(update_coalesced, producer, fanout, merger,
+                               es_loader, state_manager, CoalesceStats(),
+                               updater)
+    else:
+        update_cycle = partial(update_streams, producer, fanout, merger,
+                               es_loader, state_manager, updater)
+    next_sweep = 0.0
 
-    transformed_data = transform_film_work_details(film_work_details)
+    while True:
+        try:
+            if listener.listen() or time.monotonic() >= next_sweep:
+                # Догоняющий проход до конца накопленных изменений
+                while update_cycle() and (producer.has_backlog()
+                                          or fanout.has_pending()):
+                    pass
+                next_sweep = time.monotonic() + etl_config.catchup_interval
+
+            state_manager.flush()
+            events = listener.wait(max(next_sweep - time.monotonic(), 0))
+            if events:
+                loaded = update_events(events, inricher, merger, es_loader)
+                logger.info(f'Loaded {loaded} films for {len(events)} '
+                            f'change notifications.')
+                if loaded and updater is not None:
+                    updater.mark_stale()
+        except Exception as e:
+            logger.debug('Произошла ошибка во время ETL процесса: %s', e)
+            time.sleep(etl_config.idle_sleep)
 
-    try:
-        es_loader.bulk_load('movies', transformed_data)
-        logger.info('Successfully loaded related '
-                    'films for updated genres to Elasticsearch.')
-    except Exception as e:
-        logger.debug('Failed to load genre-related '
-                     'film data into Elasticsearch: %s', e)
-        raise
 
-    return max(genre['updated_at'] for genre in updated_genre_ids)
+def run_pipeline(producer: PostgresProducer,
+                 fanout: FanOut,
+                 merger: PostgresMerger,
+                 es_loader: ElasticsearchLoader,
+                 state_manager: State) -> None:
+    """
+    ETL процесс в виде конвейера стадий с ограниченными очередями.
+
+    Изменения персон и жанров разветвляются на фильмы порциями
+    через FanOut, как в последовательном движке. После ошибки
+    конвейер пересоздаётся и продолжает с последних сохранённых
+    чекпоинтов и подкурсоров.
+    """
+    while True:
+        jobs = {stream: fanout.pending(stream) for stream in FanOut.STREAMS}
+        source = StreamSource(partial(extract_chunk, producer, fanout, jobs),
+                              state_manager, PostgresProducer.TABLES)
+
+        def poll(source=source) -> Optional[Batch]:
+            batch = source()
+            if batch is None:
+                # Изменений нет - сбрасываем накопленные чекпоинты
+                state_manager.flush()
+            return batch
+
+        pipeline = Pipeline(poll, [
+            Stage('merge', partial(merge_batch, merger)),
+            Stage('transform', partial(transform_batch, merger)),
+            Stage('load', partial(load_batch, es_loader)),
+            Stage('checkpoint', partial(checkpoint_batch, state_manager,
+                                        fanout)),
+        ], queue_size=etl_config.pipeline_queue_size,
+            idle_sleep=etl_config.idle_sleep)
+        try:
+            pipeline.run()
+        except Exception as e:
+            logger.debug('Произошла ошибка во время ETL процесса: %s', e)
+        time.sleep(etl_config.idle_sleep)
 
 
 def main() -> None:
@@ -117,50 +315,113 @@ def main() -> None:
     Основной код ETL процесса
     """
 
-    # Создание файла состояний etl_state.json
-    create_etl_state_json(file_path='etl_state.json')
-
     # Инициализация менеджера состояний
-    state_manager = State(JsonFileStorage('etl_state.json'))
+    state_manager = create_state_manager()
+
+    if metrics_config.enabled:
+        start_metrics_server(metrics_config.port, metrics_config.host,
+                             state_manager)
+
+    if etl_config.engine == 'async':
+        # Импорт внутри функции: asyncpg нужен только этому движку
+        import asyncio
+        import async_main
+
+        asyncio.run(async_main.run(state_manager))
+        return
+
+    # Общий пул соединений для всех классов извлечения данных
+    pool = get_pool(postgres_config, **postgres_pool_config.dict())
+    watch_pool(pool)
 
     # Инициализация ETL процесса
-    producer = PostgresProducer(postgres_config, state_manager)
-    inricher = PostgresInricher(postgres_config)
-    merger = PostgresMerger(postgres_config)
-    es_loader = ElasticsearchLoader(elasticsearch_config.host)
+    producer = PostgresProducer(
+        postgres_config, state_manager, pool,
+        batch_size=etl_config.batch_size,
+        max_batch_size=etl_config.max_batch_size,
+        latency_target=resilience_config.pg_latency_target)
+    inricher = PostgresInricher(postgres_config, pool)
+    merger = PostgresMerger(postgres_config, pool,
+                            mode=etl_config.merger_mode)
+    fanout = FanOut(inricher, state_manager,
+                    chunk_size=etl_config.fanout_chunk_size)
+    fingerprints = create_fingerprints()
+    dead_letters = create_dead_letters()
+    configure_dead_letters(dead_letters)
+    es_loader = create_es_loader(fingerprints=fingerprints,
+                                 dead_letters=dead_letters)
+    # Индексы persons и genres строятся из тех же подробностей фильмов
+    create_sinks()
+    # С очередью пачки пишутся на диск, а в Elasticsearch их
+    # отправляет фоновый поток; чекпоинт сдвигается после записи
+    spool = create_spool()
+
+    # Частичное обновление индекса при переименовании персон и жанров.
+    # С очередью не используется: более старые пачки из очереди
+    # затёрли бы новое имя, записанное в индекс напрямую
+    updater = None
+    if etl_config.partial_updates and spool is not None:
+        logger.warning('Partial updates are disabled while the spool is '
+                       'enabled, renames trigger a full rebuild.')
+    elif etl_config.partial_updates:
+        updater = PartialUpdater(es_loader.es, inricher, state_manager,
+                                 fingerprints=fingerprints,
+                                 chunk_size=etl_config.fanout_chunk_size)
+
+    if spool is not None:
+        SpoolReplayer(spool, es_loader).start()
+        watch_spool(spool)
+        es_loader = SpoolWriter(spool, fingerprints)
+
+    if etl_config.engine == 'pipeline':
+        run_pipeline(producer, fanout, merger, es_loader, state_manager)
+        return
+
+    if etl_config.change_capture == 'notify':
+        run_notify(producer, inricher, fanout, merger, es_loader,
+                   state_manager, updater)
+        return
+
+    # Накопленная метрика повторной работы, устранённой объединением
+    coalesce_stats = CoalesceStats()
+    scheduler = create_scheduler()
 
     while True:
+        if spool is not None and spool.full():
+            # Elasticsearch не успевает: не читаем больше, чем
+            # помещается в очередь
+            logger.info('Spool is full, waiting for the loader...')
+            time.sleep(etl_config.idle_sleep)
+            continue
+        streams = scheduler.due()
         try:
-            # Обновление данных о фильмах
-            last_film_update = update_films(producer, merger, es_loader)
-            if last_film_update:
-                state_manager.set_state('last_film_update',
-                                        last_film_update.isoformat())
-
-            # Обновление данных о персонах
-            last_person_update = update_persons(producer,
-                                                inricher,
-                                                merger,
-                                                es_loader)
-            if last_person_update:
-                state_manager.set_state('last_person_update',
-                                        last_person_update.isoformat())
-
-            #  Обновление данных о жанрах пакетами
-            last_genre_update = update_genres(producer,
-                                              inricher,
-                                              merger,
-                                              es_loader)
-            if last_genre_update:
-                state_manager.set_state('last_genre_update',
-                                        last_genre_update.isoformat())
-
+            if etl_config.coalesce:
+                update_coalesced(producer, fanout, merger, es_loader,
+                                 state_manager, coalesce_stats, updater,
+                                 streams, scheduler)
+            else:
+                update_streams(producer, fanout, merger, es_loader,
+                               state_manager, updater, streams, scheduler)
         except Exception as e:
             logger.debug('Произошла ошибка во время ETL процесса: %s', e)
+            sleep = etl_config.idle_sleep
+        else:
+            # Полные страницы и незавершённое разветвление опрашиваются
+            # без паузы, пустые потоки ждут всё дольше до idle_max_sleep
+            sleep = scheduler.sleep_time()
+        finally:
+            logger.debug('Postgres pool stats: %s', pool.stats.as_dict())
+        if sleep <= 0:
+            continue
 
         # Пауза перед следующим циклом обновления
+        state_manager.flush()
+        logger.debug('Scheduler stats: %s', scheduler.snapshot())
+        logger.debug('Resilience stats: %s', snapshot())
+        if spool is not None:
+            logger.debug('Spool stats: %s', spool.stats())
         logger.info('Ожидание следующего цикла обновления...')
-        time.sleep(0.5)
+        time.sleep(sleep)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+"""
+Метрики ETL в формате Prometheus.
+
+Стадии отмечают время и число строк в гистограммах и счётчиках
+prometheus_client (несколько микросекунд на пачку). Отставание
+потоков, состояние предохранителей и статистика пула соединений
+вычисляются только при запросе /metrics, поэтому в цикле ETL
+ничего не стоят.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+from prometheus_client import (REGISTRY, Counter, Gauge, Histogram,
+                               start_http_server)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+import resilience
+from state_manager import State, cursor_order
+
+logger = logging.getLogger('metrics')
+
+STAGES = ('producer', 'inricher', 'merger', 'transform', 'load')
+
+STREAMS = ('film', 'person', 'genre')
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_duration_seconds', 'Время обработки пачки стадией',
+    ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+             1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+STAGE_ROWS = Counter(
+    'etl_stage_rows', 'Строки и документы, обработанные стадией',
+    ['stage'])
+
+DOCUMENTS = Counter(
+    'etl_documents', 'Документы по результату загрузки в Elasticsearch',
+    ['result'])
+
+RETRIES = Counter(
+    'etl_retries', 'Повторы вызовов после ошибок', ['operation'])
+
+COALESCE_FILMS = Counter(
+    'etl_coalesce_films',
+    'Фильмы в циклах объединения: затронутые потоками, уникальные '
+    'и повторы, не загруженные второй раз', ['result'])
+
+COALESCE_STREAM_FILMS = Counter(
+    'etl_coalesce_stream_films',
+    'Фильмы, затронутые потоком в циклах объединения', ['stream'])
+
+SPOOL_PENDING = Gauge(
+    'etl_spool_pending_bytes',
+    'Сжатый объём дисковой очереди, ещё не загруженный в Elasticsearch')
+
+# Дочерние метрики создаются заранее: labels() на каждой пачке
+# обходится дороже
+_stage_seconds = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+_stage_rows = {stage: STAGE_ROWS.labels(stage) for stage in STAGES}
+
+
+def stage_timer(stage: str) -> Histogram:
+    """
+    Контекстный менеджер, записывающий время стадии:
+
+        with stage_timer('merger'):
+            ...
+    """
+    return _stage_seconds[stage].time()
+
+
+def count_rows(stage: str, count: int) -> None:
+    _stage_rows[stage].inc(count)
+
+
+def count_documents(result: str, count: int) -> None:
+    if count:
+        DOCUMENTS.labels(result).inc(count)
+
+
+def count_coalesced(stats) -> None:
+    """
+    Итоги цикла объединения (CoalesceStats) в счётчики
+    """
+    COALESCE_FILMS.labels('affected').inc(stats.affected)
+    COALESCE_FILMS.labels('unique').inc(stats.unique)
+    COALESCE_FILMS.labels('duplicates').inc(stats.duplicates)
+    for stream, count in stats.by_stream.items():
+        COALESCE_STREAM_FILMS.labels(stream).inc(count)
+
+
+def count_retry(operation: str) -> None:
+    RETRIES.labels(operation).inc()
+
+
+def watch_pool(pool) -> None:
+    """
+    Статистика пула считается при запросе /metrics
+    """
+    REGISTRY.register(PoolCollector(pool))
+
+
+def watch_spool(spool) -> None:
+    """
+    Объём очереди считается при запросе /metrics
+    """
+    SPOOL_PENDING.set_function(spool.pending_bytes)
+
+
+class LagCollector:
+    """
+    Отставание потоков: сейчас минус updated_at чекпоинта в State.
+
+    Если изменений давно нет, отставание тоже растёт: это время
+    с последнего изменения, которое дошло до индекса
+    """
+
+    def __init__(self, state_manager: State) -> None:
+        self.state_manager = state_manager
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        lag = GaugeMetricFamily(
+            'etl_replication_lag_seconds',
+            'Сейчас минус updated_at последнего чекпоинта потока',
+            labels=['stream'])
+        now = datetime.now(timezone.utc)
+        for stream in STREAMS:
+            cursor = self.state_manager.get_cursor(stream)
+            if cursor.updated_at is None:
+                continue
+            updated_at, _ = cursor_order(cursor)
+            lag.add_metric([stream], (now - updated_at).total_seconds())
+        yield lag
+
+
+class PoolCollector:
+    """
+    Статистика пула соединений Postgres (PoolStats): ожидание
+    свободного слота и переиспользование соединений
+    """
+
+    def __init__(self, pool) -> None:
+        self.pool = pool
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        stats = self.pool.stats
+        checkouts = CounterMetricFamily(
+            'etl_pg_pool_checkouts', 'Выдачи соединений из пула')
+        checkouts.add_metric([], stats.checkouts)
+        connections = CounterMetricFamily(
+            'etl_pg_pool_connections',
+            'Соединения пула: открытые, переиспользованные, закрытые',
+            labels=['event'])
+        connections.add_metric(['opened'], stats.connections_opened)
+        connections.add_metric(['reused'], stats.connections_reused)
+        connections.add_metric(['discarded'], stats.connections_discarded)
+        health_checks = CounterMetricFamily(
+            'etl_pg_pool_health_checks',
+            'Проверки простаивавших соединений SELECT 1')
+        health_checks.add_metric([], stats.health_checks)
+        wait_total = CounterMetricFamily(
+            'etl_pg_pool_wait_seconds',
+            'Суммарное ожидание свободного соединения')
+        wait_total.add_metric([], stats.wait_time_total)
+        wait_max = GaugeMetricFamily(
+            'etl_pg_pool_wait_max_seconds',
+            'Самое долгое ожидание свободного соединения')
+        wait_max.add_metric([], stats.wait_time_max)
+        idle = GaugeMetricFamily(
+            'etl_pg_pool_idle_connections', 'Простаивающие соединения')
+        idle.add_metric([], self.pool.idle)
+        size = GaugeMetricFamily(
+            'etl_pg_pool_max_size', 'Размер пула (POSTGRES_POOL_MAX_SIZE)')
+        size.add_metric([], self.pool.max_size)
+        yield from (checkouts, connections, health_checks, wait_total,
+                    wait_max, idle, size)
+
+
+class ResilienceCollector:
+    """
+    Предохранители и регуляторы нагрузки из resilience.snapshot()
+    """
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        stats = resilience.snapshot()
+        state = GaugeMetricFamily(
+            'etl_circuit_open', 'Предохранитель разомкнут (1) или нет (0)',
+            labels=['backend'])
+        opened = CounterMetricFamily(
+            'etl_circuit_opened', 'Сколько раз предохранитель размыкался',
+            labels=['backend'])
+        rejected = CounterMetricFamily(
+            'etl_circuit_rejected',
+            'Вызовы, отложенные разомкнутым предохранителем',
+            labels=['backend'])
+        for name, breaker in stats['breakers'].items():
+            state.add_metric([name], float(breaker['state'] != 'closed'))
+            opened.add_metric([name], breaker['opened'])
+            rejected.add_metric([name], breaker['rejected'])
+
+        value = GaugeMetricFamily(
+            'etl_throttle_value', 'Текущее значение регулятора AIMD',
+            labels=['controller'])
+        decisions = CounterMetricFamily(
+            'etl_throttle_decisions', 'Решения регулятора AIMD',
+            labels=['controller', 'direction'])
+        for name, controller in stats['controllers'].items():
+            value.add_metric([name], controller['value'])
+            decisions.add_metric([name, 'increase'], controller['increases'])
+            decisions.add_metric([name, 'decrease'], controller['decreases'])
+        yield from (state, opened, rejected, value, decisions)
+
+
+def start_metrics_server(port: int, addr: str = '0.0.0.0',
+                         state_manager: Optional[State] = None) -> None:
+    """
+    HTTP-сервер /metrics в фоновом потоке
+    """
+    REGISTRY.register(ResilienceCollector())
+    if state_manager is not None:
+        REGISTRY.register(LagCollector(state_manager))
+    start_http_server(port, addr)
+    logger.info(f'Serving metrics on {addr}:{port}/metrics')
@@ -0,0 +1,203 @@
+"""
+Захват изменений через LISTEN/NOTIFY.
+
+Триггеры на таблицах фильмов, персон, жанров и таблицах связей
+отправляют в канал etl_changes id изменённой строки. Установка,
+удаление и проверка на локальном Postgres (из каталога etl):
+
+    python notify.py install
+    python notify.py listen
+    python notify.py uninstall
+"""
+import argparse
+import json
+import logging
+import select
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import connection as PgConnection
+
+from configs import pg_connection
+from utils import backoff
+
+logger = logging.getLogger('notify')
+
+CHANNEL = 'etl_changes'
+
+# Таблица -> (поток, колонка с id, отслеживаемые операции).
+# Изменение связи фильма с персоной или жанром меняет документ фильма
+TRIGGER_TABLES: Dict[str, Tuple[str, str, str]] = {
+    'film_work': ('film', 'id', 'INSERT OR UPDATE'),
+    'person': ('person', 'id', 'INSERT OR UPDATE'),
+    'genre': ('genre', 'id', 'INSERT OR UPDATE'),
+    'person_film_work': ('film', 'film_work_id',
+                         'INSERT OR UPDATE OR DELETE'),
+    'genre_film_work': ('film', 'film_work_id',
+                        'INSERT OR UPDATE OR DELETE'),
+}
+
+NOTIFY_FUNCTION_SQL = f'''
+    CREATE OR REPLACE FUNCTION content.etl_notify_change()
+    RETURNS trigger AS $$
+    DECLARE
+        rec record;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            rec := OLD;
+        ELSE
+            rec := NEW;
+        END IF;
+        PERFORM pg_notify('{CHANNEL}', json_build_object(
+            'stream', TG_ARGV[0],
+            'id', row_to_json(rec) ->> TG_ARGV[1])::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+'''
+
+TRIGGER_SQL = '''
+    DROP TRIGGER IF EXISTS etl_notify ON content.{table};
+    CREATE TRIGGER etl_notify AFTER {operations} ON content.{table}
+        FOR EACH ROW
+        EXECUTE FUNCTION content.etl_notify_change('{stream}', '{column}');
+'''
+
+DROP_TRIGGER_SQL = 'DROP TRIGGER IF EXISTS etl_notify ON content.{table};'
+
+DROP_FUNCTION_SQL = 'DROP FUNCTION IF EXISTS content.etl_notify_change();'
+
+
+@dataclass(frozen=True)
+class ChangeEvent:
+    """
+    Изменение строки потока, полученное через NOTIFY
+    """
+    stream: str
+    id: str
+
+
+def install_triggers(connection_params: dict) -> None:
+    """
+    Установка функции и триггеров уведомлений (идемпотентно)
+    """
+    with pg_connection(connection_params) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(NOTIFY_FUNCTION_SQL)
+            for table, (stream, column, ops) in TRIGGER_TABLES.items():
+                cursor.execute(TRIGGER_SQL.format(
+                    table=table, stream=stream, column=column,
+                    operations=ops))
+        conn.commit()
+    logger.info(f'Installed {CHANNEL} triggers on '
+                f'{", ".join(TRIGGER_TABLES)}')
+
+
+def uninstall_triggers(connection_params: dict) -> None:
+    """
+    Удаление триггеров и функции уведомлений
+    """
+    with pg_connection(connection_params) as conn:
+        with conn.cursor() as cursor:
+            for table in TRIGGER_TABLES:
+                cursor.execute(DROP_TRIGGER_SQL.format(table=table))
+            cursor.execute(DROP_FUNCTION_SQL)
+        conn.commit()
+    logger.info(f'Removed {CHANNEL} triggers')
+
+
+class ChangeListener:
+    """
+    Слушатель канала уведомлений на отдельном соединении.
+
+    Уведомления, отправленные, пока соединения не было, теряются,
+    поэтому listen() сообщает о (пере)подключении, и вызывающий
+    должен выполнить догоняющий проход по updated_at.
+    """
+
+    def __init__(self, connection_params: dict,
+                 channel: str = CHANNEL,
+                 debounce: float = 0.05) -> None:
+        self.connection_params = connection_params
+        self.channel = channel
+        self.debounce = debounce
+        self.conn: Optional[PgConnection] = None
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='postgres')
+    def listen(self) -> bool:
+        """
+        Подписка на канал; True, если соединение открыто заново
+        """
+        if self.conn is not None and not self.conn.closed:
+            return False
+        self.conn = psycopg2.connect(**self.connection_params)
+        self.conn.set_session(autocommit=True)
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel};')
+        logger.info(f'Listening for changes on {self.channel}')
+        return True
+
+    def wait(self, timeout: float) -> List[ChangeEvent]:
+        """
+        Ожидание уведомлений не дольше timeout секунд.
+
+        После пробуждения ещё debounce секунд собираются уведомления
+        той же волны изменений; повторы id схлопываются
+        """
+        try:
+            if not self._poll() and select.select([self.conn], [], [],
+                                                  timeout)[0]:
+                time.sleep(self.debounce)
+            self._poll()
+        except psycopg2.Error:
+            self.close()
+            raise
+
+        events = {}
+        for notify in self.conn.notifies:
+            try:
+                payload = json.loads(notify.payload)
+                event = ChangeEvent(payload['stream'], payload['id'])
+            except (ValueError, KeyError) as e:
+                logger.warning('Malformed notification %r: %s',
+                               notify.payload, e)
+                continue
+            events[event] = None
+        self.conn.notifies.clear()
+        return list(events)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _poll(self) -> bool:
+        self.conn.poll()
+        return bool(self.conn.notifies)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=('install', 'uninstall', 'listen'))
+    args = parser.parse_args()
+
+    # Импорт внутри функции: settings читает настройки при импорте
+    from settings import postgres_config as connection_params
+
+    if args.command == 'install':
+        install_triggers(connection_params)
+    elif args.command == 'uninstall':
+        uninstall_triggers(connection_params)
+    else:
+        listener = ChangeListener(connection_params)
+        listener.listen()
+        while True:
+            for event in listener.wait(timeout=60):
+                print(f'{event.stream} {event.id}')
+
+
+if __name__ == '__main__':
+    main()
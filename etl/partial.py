@@ -0,0 +1,276 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+
+from extract import PostgresInricher
+from fingerprints import FingerprintStore
+from sinks import get_sinks
+from state_manager import State
+from utils import backoff
+
+logger = logging.getLogger('partial_update')
+
+# Названия жанров на момент последнего обновления индекса: по id
+# жанра находится старое название, которое хранится в документах
+GENRE_NAMES_KEY = 'genre_names'
+
+# Новые имена персон в actors/writers и пересборка *_names в том же
+# порядке, что и в transform: уникальные имена по первому появлению
+PERSON_SCRIPT = '''
+    boolean changed = false;
+    for (def key : ['actors', 'writers']) {
+        def persons = ctx._source[key];
+        if (persons == null) {
+            continue;
+        }
+        List names = new ArrayList();
+        for (def person : persons) {
+            if (params.names.containsKey(person.id)) {
+                def name = params.names.get(person.id);
+                if (name != person.name) {
+                    person.name = name;
+                    changed = true;
+                }
+            }
+            if (!names.contains(person.name)) {
+                names.add(person.name);
+            }
+        }
+        ctx._source[key + '_names'] = names;
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+'''
+
+GENRE_SCRIPT = '''
+    List genres = new ArrayList();
+    for (def name : ctx._source.genre) {
+        def renamed = params.names.getOrDefault(name, name);
+        if (!genres.contains(renamed)) {
+            genres.add(renamed);
+        }
+    }
+    if (genres.equals(ctx._source.genre)) {
+        ctx.op = 'noop';
+    } else {
+        ctx._source.genre = genres;
+    }
+'''
+
+
+# Повторы update_by_query при конфликтах версий с параллельной
+# загрузкой; скрипты идемпотентны, уже обновлённые документы - noop
+CONFLICT_RETRIES = 3
+
+
+def nested_terms(path: str, ids: List[str]) -> dict:
+    return {'nested': {'path': path,
+                       'query': {'terms': {f'{path}.id': ids}}}}
+
+
+class PartialUpdater:
+    """
+    Частичное обновление документов при переименовании персон и жанров.
+
+    Вместо пересборки связанных фильмов в индексе скриптом
+    update_by_query переписываются только затронутые поля. Изменения,
+    которые так применить нельзя (режиссёры хранятся в документе без
+    id, жанры с неизвестным прежним названием), возвращаются
+    вызывающему для полной пересборки.
+
+    Документы, пропущенные update_by_query из-за конфликта версий
+    с параллельной загрузкой, обновляются повтором запроса, а если
+    конфликты не уходят - тоже полной пересборкой. Refresh индекса
+    перед запросом выполняется, только если после прошлого refresh
+    в индекс что-то загружалось (mark_stale). С приёмниками persons
+    и genres новое имя записывается и в документ персоны или жанра.
+    """
+
+    def __init__(self, es: Elasticsearch,
+                 inricher: PostgresInricher,
+                 state_manager: State,
+                 index: str = 'movies',
+                 fingerprints: Optional[FingerprintStore] = None,
+                 chunk_size: int = 500) -> None:
+        self.es = es
+        self.inricher = inricher
+        self.state_manager = state_manager
+        self.index = index
+        self.fingerprints = fingerprints
+        self.chunk_size = chunk_size
+        self._stale = True
+
+    def mark_stale(self) -> None:
+        """
+        В индекс загружались документы: следующему update_by_query
+        нужен refresh, чтобы их увидеть
+        """
+        self._stale = True
+
+    def update_persons(self, person_ids: List[str]) -> List[str]:
+        """
+        Переименование персон в документах; возвращает id режиссёров
+        и персон, чьи документы не удалось обновить из-за конфликтов,
+        для полной пересборки
+        """
+        rows = self.inricher.fetch_person_names(person_ids)
+        fallback = [str(row['id']) for row in rows if row['is_director']]
+        names = {str(row['id']): row['full_name']
+                 for row in rows if not row['is_director']}
+        if names:
+            ids = list(names)
+            query = {'bool': {'should': [nested_terms('actors', ids),
+                                         nested_terms('writers', ids)]}}
+            updated = self._update_by_query(query, PERSON_SCRIPT, names)
+            self._forget_fingerprints('person', ids)
+            if updated is None:
+                fallback.extend(ids)
+            else:
+                logger.info(f'Renamed {len(names)} persons in {updated} '
+                            f'documents with a partial update.')
+        if names and any(sink.index == 'persons' for sink in get_sinks()):
+            fallback.extend(self._rename_persons(names))
+        return fallback
+
+    def update_genres(self, genre_ids: List[str]
+                      ) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Переименование жанров в документах.
+
+        Возвращает id жанров с неизвестным прежним названием (или
+        не обновлённых из-за конфликтов) для полной пересборки
+        и текущие названия, которые нужно запомнить после того,
+        как пересборка будет поставлена в очередь
+        """
+        rows = self.inricher.fetch_genre_names(genre_ids)
+        known = self.state_manager.get_state(GENRE_NAMES_KEY) or {}
+        current = {str(row['id']): row['name'] for row in rows}
+        unknown = [id for id in current if id not in known]
+        renamed = [id for id in current
+                   if id in known and known[id] != current[id]]
+        if renamed:
+            # Старое название -> новое
+            renames = {known[id]: current[id] for id in renamed}
+            query = {'terms': {'genre': list(renames)}}
+            updated = self._update_by_query(query, GENRE_SCRIPT, renames)
+            self._forget_fingerprints('genre', renamed)
+            if updated is None:
+                unknown.extend(renamed)
+            else:
+                logger.info(f'Renamed {len(renames)} genres in {updated} '
+                            f'documents with a partial update.')
+                if any(sink.index == 'genres' for sink in get_sinks()):
+                    unknown.extend(self._rename_genres(
+                        {id: current[id] for id in renamed}))
+        return unknown, current
+
+    def remember_genres(self, names: Dict[str, str]) -> None:
+        known = self.state_manager.get_state(GENRE_NAMES_KEY) or {}
+        known.update(names)
+        self.state_manager.set_state(GENRE_NAMES_KEY, known)
+
+    def _update_by_query(self, query: dict, script: str,
+                         names: Dict[str, str]) -> Optional[int]:
+        """
+        update_by_query с повтором при конфликтах версий. Возвращает
+        число обновлённых документов или None, если конфликты
+        остались после CONFLICT_RETRIES повторов
+        """
+        if self._stale:
+            # Только что загруженные документы должны быть видны запросу
+            self._refresh()
+            self._stale = False
+        updated = 0
+        for attempt in range(CONFLICT_RETRIES + 1):
+            response = self._run_update_by_query(query, script, names)
+            updated += response['updated']
+            conflicts = response.get('version_conflicts', 0)
+            if not conflicts:
+                return updated
+            logger.info('Partial update hit %s version conflicts '
+                        '(attempt %s)', conflicts, attempt + 1)
+        logger.warning('Partial update still has %s version conflicts, '
+                       'falling back to a full rebuild', conflicts)
+        return None
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def _rename_persons(self, names: Dict[str, str]) -> List[str]:
+        """
+        Новые имена в индексе persons (приёмник ETL_SINKS). Персоны,
+        которых в индексе ещё нет, пропускаются: их документ придёт
+        из Postgres уже с новым именем. Возвращает id персон, чьё
+        имя записать не удалось, для полной пересборки
+        """
+        operations = []
+        for person_id, full_name in names.items():
+            operations.append({'update': {'_index': 'persons',
+                                          '_id': person_id,
+                                          'retry_on_conflict': 3}})
+            operations.append({'doc': {'full_name': full_name}})
+        return self._bulk_rename('persons', operations)
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def _rename_genres(self, names: Dict[str, str]) -> List[str]:
+        """
+        Новые названия в индексе genres (приёмник ETL_SINKS): документ
+        жанра целиком - id и название. Возвращает id жанров, которые
+        записать не удалось, для полной пересборки
+        """
+        operations = []
+        for genre_id, name in names.items():
+            operations.append({'index': {'_index': 'genres',
+                                         '_id': genre_id}})
+            operations.append({'id': genre_id, 'name': name})
+        return self._bulk_rename('genres', operations)
+
+    def _bulk_rename(self, index: str, operations: List[dict]) -> List[str]:
+        """
+        Отправка новых имён в индекс приёмника; документы, которых
+        в индексе ещё нет (404), пропускаются. Отпечатки документов
+        забываются, иначе возврат к прежнему имени счёлся бы
+        неизменившимся
+        """
+        response = self.es.bulk(operations=operations)
+        results = [next(iter(item.values())) for item in response['items']]
+        failed = [str(result['_id']) for result in results
+                  if 'error' in result and result.get('status') != 404]
+        if self.fingerprints is not None:
+            self.fingerprints.forget(index, [str(result['_id'])
+                                             for result in results])
+        if failed:
+            logger.warning('Failed to rename %s documents in the %s '
+                           'index, falling back to a full rebuild',
+                           len(failed), index)
+        return failed
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def _refresh(self) -> None:
+        self.es.indices.refresh(index=self.index)
+
+    @backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10,
+             breaker='elasticsearch')
+    def _run_update_by_query(self, query: dict, script: str,
+                             names: Dict[str, str]) -> dict:
+        response = self.es.update_by_query(
+            index=self.index, query=query, conflicts='proceed',
+            slices='auto', refresh=True,
+            script={'source': script, 'lang': 'painless',
+                    'params': {'names': names}})
+        if response.get('failures'):
+            logger.warning('Partial update failures: %s',
+                           response['failures'][:5])
+        return response
+
+    def _forget_fingerprints(self, stream: str, ids: List[str]) -> None:
+        # Документы изменены в обход загрузчика - их отпечатки устарели
+        if self.fingerprints is None or not ids:
+            return
+        for page in self.inricher.iter_related_film_works(
+                stream, ids, self.chunk_size):
+            self.fingerprints.forget(self.index,
+                                     [str(fw['id']) for fw in page])
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import queue
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from extract import PostgresMerger, PostgresScanner
+from settings import (create_dead_letters, create_es_loader, etl_config,
+                      postgres_config, postgres_pool_config)
+from pool import get_pool
+from state_manager import State
+from transform import transform_merged
+
+logger = logging.getLogger('partitioned_load')
+
+# Ключ состояния с прогрессом полной загрузки по партициям
+FULL_LOAD_KEY = 'full_load'
+
+
+def partition_bounds(count: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Разбиение пространства UUID на count непересекающихся диапазонов.
+
+    Диапазон задаётся как (after_id, before_id): id > after_id и
+    id < before_id, None означает отсутствие границы.
+    """
+    space = 2 ** 128
+    starts = [space * k // count for k in range(count)]
+    bounds = []
+    for k, start in enumerate(starts):
+        after_id = str(uuid.UUID(int=start - 1)) if start else None
+        before_id = (str(uuid.UUID(int=starts[k + 1]))
+                     if k + 1 < count else None)
+        bounds.append((after_id, before_id))
+    return bounds
+
+
+def load_partition(index: str, partition: int,
+                   after_id: Optional[str], before_id: Optional[str],
+                   progress: Any) -> None:
+    """
+    Загрузка одной партиции в отдельном процессе.
+
+    Процесс открывает собственные соединения с Postgres и Elasticsearch
+    и после каждой страницы сообщает координатору последний id.
+    С очередью недоставленных (ETL_DEAD_LETTERS) невалидные и
+    отклонённые Elasticsearch фильмы откладываются в неё под
+    индексом movies и не прерывают партицию.
+    """
+    pool = get_pool(postgres_config, **postgres_pool_config.dict())
+    scanner = PostgresScanner(postgres_config, pool)
+    merger = PostgresMerger(postgres_config, pool,
+                            mode=etl_config.merger_mode)
+    es_loader = create_es_loader(mode='streaming')
+    dead_letters = create_dead_letters()
+
+    while True:
+        rows = scanner.fetch_id_range('film_work', after_id, before_id,
+                                      etl_config.max_batch_size)
+        if not rows:
+            break
+        film_work_details = merger.fetch_film_work_details(
+            [film['id'] for film in rows])
+        rejected = [] if dead_letters is not None else None
+        transformed_data = transform_merged(film_work_details,
+                                            merger.mode,
+                                            etl_config.validation,
+                                            rejected)
+        loaded = es_loader.bulk_load(index, transformed_data)
+        if dead_letters is not None:
+            dead_letters.add_rejected(film_work_details, rejected)
+            dead_letters.add_failed('movies', es_loader.last_report.failed,
+                                    transformed_data)
+        after_id = str(rows[-1]['id'])
+        progress.put((partition, after_id, loaded, False))
+
+    progress.put((partition, after_id, 0, True))
+    if dead_letters is not None:
+        dead_letters.close()
+
+
+def run_partitioned_load(state_manager: State, index: str,
+                         workers: int, partitions: int) -> int:
+    """
+    Параллельная загрузка каталога пулом процессов.
+
+    Прогресс партиций хранится в состоянии под ключом full_load,
+    поэтому после падения повторный запуск догружает только
+    незавершённые партиции. Возвращает число загруженных документов.
+    """
+    full_load: Dict[str, Any] = state_manager.get_state(FULL_LOAD_KEY)
+    progress_state = full_load.setdefault('partitions', {})
+    if full_load.get('partition_count') != partitions:
+        progress_state.clear()
+        full_load['partition_count'] = partitions
+
+    tasks = []
+    for partition, (after_id, before_id) in enumerate(
+            partition_bounds(partitions)):
+        item = progress_state.setdefault(
+            str(partition), {'after_id': after_id, 'loaded': 0,
+                             'done': False})
+        if not item['done']:
+            tasks.append((index, partition, item['after_id'], before_id))
+    state_manager.set_state(FULL_LOAD_KEY, full_load)
+    logger.info('Loading %s of %s partitions with %s workers',
+                len(tasks), partitions, workers)
+
+    # spawn: дочерние процессы не наследуют соединения и потоки родителя
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager, context.Pool(workers) as pool:
+        progress = manager.Queue()
+        results = [pool.apply_async(load_partition, task + (progress,))
+                   for task in tasks]
+        pending = len(tasks)
+        while pending:
+            try:
+                partition, after_id, loaded, done = progress.get(timeout=1)
+            except queue.Empty:
+                _raise_failed(results)
+                continue
+            item = progress_state[str(partition)]
+            item['after_id'] = after_id
+            item['loaded'] += loaded
+            item['done'] = done
+            state_manager.set_state(FULL_LOAD_KEY, full_load)
+            if done:
+                pending -= 1
+                logger.info('Partition %s done: %s documents',
+                            partition, item['loaded'])
+        _raise_failed(results)
+
+    return sum(item['loaded'] for item in progress_state.values())
+
+
+def _raise_failed(results: list) -> None:
+    # Ошибка воркера прерывает загрузку, прогресс остаётся в состоянии
+    for result in results:
+        if result.ready() and not result.successful():
+            result.get()
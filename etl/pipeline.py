@@ -0,0 +1,222 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from fanout import FanOutJob
+from state_manager import Cursor, State
+
+logger = logging.getLogger('pipeline')
+
+
+def last_cursor(rows: list) -> Cursor:
+    """
+    Курсор последней строки страницы (строки отсортированы по курсору)
+    """
+    return Cursor(rows[-1]['updated_at'], str(rows[-1]['id']))
+
+
+@dataclass
+class Batch:
+    """
+    Пачка изменений одного потока, проходящая через стадии конвейера
+    """
+    stream: str
+    cursor: Cursor
+    ids: List[str]
+    film_ids: List[str] = field(default_factory=list)
+    details: list = field(default_factory=list)
+    documents: List[dict] = field(default_factory=list)
+    # Документы дополнительных индексов (sinks) по имени индекса
+    outputs: Dict[str, List[dict]] = field(default_factory=dict)
+    # Фильмы, отложенные в очередь недоставленных при преобразовании
+    rejected: List[str] = field(default_factory=list)
+    # Возобновляемое разветвление пачки персон или жанров
+    fanout: Optional[FanOutJob] = None
+
+
+@dataclass
+class StageStats:
+    """
+    Метрики стадии: время работы, ожидания входа и ожидания места
+    в очереди следующей стадии (backpressure)
+    """
+    processed: int = 0
+    busy: float = 0.0
+    idle: float = 0.0
+    blocked: float = 0.0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+
+
+class Stage:
+    """
+    Стадия конвейера: функция, обрабатывающая один элемент
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], Any]) -> None:
+        self.name = name
+        self.func = func
+        self.stats = StageStats()
+
+
+class StreamSource:
+    """
+    Источник пачек для конвейера.
+
+    Курсоры чтения потоков хранятся в памяти и обгоняют сохранённые
+    чекпоинты: чекпоинт сдвигает только стадия загрузки.
+    """
+
+    def __init__(self, fetch: Callable[[str, Cursor], Optional[Batch]],
+                 state_manager: State,
+                 streams: Iterable[str]) -> None:
+        self.fetch = fetch
+        self.streams = list(streams)
+        self.cursors = {stream: state_manager.get_cursor(stream)
+                        for stream in self.streams}
+        self._next = 0
+
+    def __call__(self) -> Optional[Batch]:
+        # Потоки опрашиваются по кругу, чтобы ни один не голодал
+        for offset in range(len(self.streams)):
+            stream = self.streams[(self._next + offset) % len(self.streams)]
+            batch = self.fetch(stream, self.cursors[stream])
+            if batch is not None:
+                self.cursors[stream] = batch.cursor
+                self._next = (self._next + offset + 1) % len(self.streams)
+                return batch
+        return None
+
+
+class Pipeline:
+    """
+    Конвейер стадий, связанных ограниченными очередями.
+
+    Каждая стадия работает в своём потоке. Когда очередь следующей
+    стадии заполнена, стадия ждёт, поэтому источник не уходит вперёд
+    больше чем на queue_size пачек на стадию. Ошибка любой стадии
+    останавливает конвейер и пробрасывается из run().
+    """
+
+    def __init__(self, source: Callable[[], Optional[Any]],
+                 stages: List[Stage],
+                 queue_size: int = 2,
+                 idle_sleep: float = 0.5,
+                 report_interval: float = 60.0) -> None:
+        self.source = Stage('extract', source)
+        self.stages = stages
+        self.idle_sleep = idle_sleep
+        self.report_interval = report_interval
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.error: Optional[BaseException] = None
+        self._stop = threading.Event()
+
+    def run(self) -> None:
+        """
+        Запуск конвейера; блокирует до остановки или ошибки
+        """
+        threads = [threading.Thread(target=self._run_source,
+                                    name='pipeline-extract', daemon=True)]
+        for position, stage in enumerate(self.stages):
+            outbox = (self.queues[position + 1]
+                      if position + 1 < len(self.stages) else None)
+            threads.append(threading.Thread(
+                target=self._run_stage,
+                args=(stage, self.queues[position], outbox),
+                name=f'pipeline-{stage.name}', daemon=True))
+
+        for thread in threads:
+            thread.start()
+        try:
+            while not self._stop.wait(self.report_interval):
+                self._log_stats()
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self._log_stats()
+
+        if self.error is not None:
+            raise self.error
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Метрики всех стадий, включая текущую глубину входных очередей
+        """
+        for stage, inbox in zip(self.stages, self.queues):
+            stage.stats.queue_depth = inbox.qsize()
+        return {stage.name: asdict(stage.stats)
+                for stage in [self.source] + self.stages}
+
+    def _run_source(self) -> None:
+        stats = self.source.stats
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                item = self.source.func()
+                stats.busy += time.monotonic() - started
+                if item is None:
+                    # Изменений нет - ждём следующего опроса
+                    started = time.monotonic()
+                    self._stop.wait(self.idle_sleep)
+                    stats.idle += time.monotonic() - started
+                    continue
+                stats.processed += 1
+                self._put(self.source, self.queues[0], item)
+        except BaseException as e:
+            self._fail(self.source, e)
+
+    def _run_stage(self, stage: Stage, inbox: queue.Queue,
+                   outbox: Optional[queue.Queue]) -> None:
+        stats = stage.stats
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                try:
+                    item = inbox.get(timeout=0.1)
+                except queue.Empty:
+                    stats.idle += time.monotonic() - started
+                    continue
+                stats.idle += time.monotonic() - started
+                stats.max_queue_depth = max(stats.max_queue_depth,
+                                            inbox.qsize() + 1)
+
+                started = time.monotonic()
+                result = stage.func(item)
+                stats.busy += time.monotonic() - started
+                stats.processed += 1
+
+                if outbox is not None:
+                    self._put(stage, outbox, result)
+        except BaseException as e:
+            self._fail(stage, e)
+
+    def _put(self, stage: Stage, outbox: queue.Queue, item: Any) -> None:
+        started = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stage.stats.blocked += time.monotonic() - started
+
+    def _fail(self, stage: Stage, error: BaseException) -> None:
+        logger.debug('Stage %s failed: %s', stage.name, error)
+        if self.error is None:
+            self.error = error
+        self._stop.set()
+
+    def _log_stats(self) -> None:
+        for name, stats in self.stats().items():
+            logger.info(f'Stage {name}: processed={stats["processed"]} '
+                        f'queue={stats["queue_depth"]} '
+                        f'busy={stats["busy"]:.1f}s '
+                        f'idle={stats["idle"]:.1f}s '
+                        f'blocked={stats["blocked"]:.1f}s')
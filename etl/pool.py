@@ -0,0 +1,178 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Deque, Dict, Iterator, Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import connection as PgConnection
+
+logger = logging.getLogger('postgres_pool')
+
+
+@dataclass
+class PoolStats:
+    """
+    Метрики пула соединений
+    """
+    checkouts: int = 0
+    connections_opened: int = 0
+    connections_reused: int = 0
+    connections_discarded: int = 0
+    health_checks: int = 0
+    wait_time_total: float = 0.0
+    wait_time_max: float = 0.0
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+class PostgresPool:
+    """
+    Пул долгоживущих соединений с Postgres.
+
+    Соединение выдаётся через контекстный менеджер `connection()`.
+    Если все соединения заняты, вызывающий ждёт освобождения слота.
+    Перед выдачей простаивавшее соединение проверяется `SELECT 1`,
+    сломанные соединения закрываются и не возвращаются в пул.
+    """
+
+    def __init__(self, connection_params: dict,
+                 max_size: int = 5,
+                 health_check_interval: float = 30.0) -> None:
+        self.connection_params = connection_params
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.stats = PoolStats()
+        self._idle: Deque[Tuple[PgConnection, float]] = deque()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> Iterator[PgConnection]:
+        """
+        Получение соединения из пула
+        """
+        started = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - started
+        try:
+            with self._lock:
+                self.stats.checkouts += 1
+                self.stats.wait_time_total += waited
+                self.stats.wait_time_max = max(self.stats.wait_time_max,
+                                               waited)
+            conn = self._checkout()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Соединение, скорее всего, разорвано - не переиспользуем
+                self._discard(conn)
+                raise
+            except BaseException:
+                # В том числе GeneratorExit незавершённого потокового
+                # чтения: соединение возвращается в пул, а не теряется
+                self._checkin(conn)
+                raise
+            else:
+                self._checkin(conn)
+        finally:
+            self._slots.release()
+
+    @property
+    def idle(self) -> int:
+        """
+        Число простаивающих соединений в пуле
+        """
+        with self._lock:
+            return len(self._idle)
+
+    def close(self) -> None:
+        """
+        Закрытие всех простаивающих соединений
+        """
+        with self._lock:
+            while self._idle:
+                conn, _ = self._idle.popleft()
+                conn.close()
+
+    def _checkout(self) -> PgConnection:
+        while True:
+            with self._lock:
+                item = self._idle.popleft() if self._idle else None
+            if item is None:
+                return self._open()
+            conn, last_used = item
+            if self._is_alive(conn, last_used):
+                with self._lock:
+                    self.stats.connections_reused += 1
+                return conn
+            self._discard(conn)
+
+    def _checkin(self, conn: PgConnection) -> None:
+        if conn.closed:
+            self._discard(conn)
+            return
+        try:
+            # Завершаем транзакцию, чтобы соединение не висело
+            # в состоянии idle in transaction
+            conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+    def _open(self) -> PgConnection:
+        conn = psycopg2.connect(**self.connection_params)
+        with self._lock:
+            self.stats.connections_opened += 1
+        return conn
+
+    def _discard(self, conn: PgConnection) -> None:
+        with self._lock:
+            self.stats.connections_discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error as e:
+            logger.debug('Error while closing connection: %s', e)
+
+    def _is_alive(self, conn: PgConnection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        with self._lock:
+            self.stats.health_checks += 1
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.info('Discarding broken Postgres connection: %s', e)
+            return False
+
+
+_pools: Dict[tuple, PostgresPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(connection_params: dict,
+             **pool_kwargs) -> PostgresPool:
+    """
+    Общий пул для набора параметров подключения.
+
+    Пул привязан к PID процесса: соединения psycopg2 нельзя
+    использовать после fork, поэтому дочерний процесс получает свой пул.
+    """
+    key = (os.getpid(), tuple(sorted(connection_params.items())))
+    with _pools_lock:
+        pool: Optional[PostgresPool] = _pools.get(key)
+        if pool is None:
+            pool = PostgresPool(connection_params, **pool_kwargs)
+            _pools[key] = pool
+        return pool
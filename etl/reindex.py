@@ -0,0 +1,149 @@
+"""
+Полная переиндексация фильмов.
+
+Каталог загружается в новый версионированный индекс с отключённым
+refresh и без реплик, после чего настройки возвращаются и алиас
+movies атомарно переключается на новый индекс. Запуск из каталога etl:
+
+    python reindex.py --force-merge --delete-old
+    python reindex.py --workers 8
+
+Без --workers каталог читается одним серверным курсором и идёт
+в загрузчик генератором, поэтому пиковая память не зависит от
+размера каталога; она выводится в итоговой строке лога.
+"""
+import argparse
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from deadletter import DeadLetterStore
+from extract import PostgresMerger
+from indices import (create_bulk_index, force_merge, load_index_body,
+                     restore_settings, swap_alias, versioned_name)
+from load import ElasticsearchLoader
+from settings import (create_dead_letters, create_es_loader,
+                      create_state_manager, etl_config, postgres_config,
+                      postgres_pool_config)
+from partitioned_load import FULL_LOAD_KEY, run_partitioned_load
+from pool import get_pool
+from transform import iter_film_work_documents
+from utils import peak_rss_mb
+
+logger = logging.getLogger('reindex')
+
+
+def load_catalogue(merger: PostgresMerger,
+                   es_loader: ElasticsearchLoader,
+                   index: str,
+                   since: Optional[str] = None,
+                   dead_letters: Optional[DeadLetterStore] = None) -> int:
+    """
+    Загрузка всех фильмов (или изменённых начиная с since) в индекс.
+
+    Строки читаются серверным курсором, документы собираются и
+    отправляются по мере чтения, не накапливаясь в памяти. С очередью
+    недоставленных фильмы, не прошедшие валидацию или отклонённые
+    Elasticsearch, откладываются в неё под индексом movies (без
+    исходных данных: replay читает их из Postgres заново)
+    """
+    rejected = [] if dead_letters is not None else None
+    documents = iter_film_work_documents(merger.iter_catalogue(since),
+                                         merger.mode, etl_config.validation,
+                                         rejected=rejected)
+    total = es_loader.load_stream(index, documents)
+    if dead_letters is not None:
+        dead_letters.add('movies', 'transform',
+                         ((fw_id, reason, None) for fw_id, reason in rejected))
+        dead_letters.add_failed('movies', es_loader.last_report.failed)
+    logger.info('Loaded %s films into %s', total, index)
+    return total
+
+
+def reindex(alias: str = 'movies',
+            replicas: int = 1,
+            merge: bool = False,
+            delete_old: bool = False,
+            workers: int = 1,
+            partitions: Optional[int] = None) -> str:
+    """
+    Пересборка индекса и переключение алиаса на него.
+
+    При workers > 1 каталог грузится партициями в пуле процессов,
+    а прерванная загрузка продолжается в тот же индекс.
+    """
+    state_manager = create_state_manager()
+    pool = get_pool(postgres_config, **postgres_pool_config.dict())
+    merger = PostgresMerger(postgres_config, pool,
+                            mode=etl_config.merger_mode,
+                            itersize=etl_config.stream_itersize)
+    # Загрузчик без очереди недоставленных: она ведётся под именем
+    # алиаса, а не версионированного индекса (load_catalogue)
+    es_loader = create_es_loader(mode='streaming')
+    dead_letters = create_dead_letters()
+    es = es_loader.es
+
+    full_load = state_manager.get_state(FULL_LOAD_KEY)
+    if (workers > 1 and full_load
+            and es.indices.exists(index=full_load['index'])):
+        logger.info('Resuming full load into %s', full_load['index'])
+    else:
+        index = versioned_name(alias)
+        full_load = {
+            'index': index,
+            'settings': create_bulk_index(es, index, load_index_body(),
+                                          replicas),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+        }
+        state_manager.set_state(FULL_LOAD_KEY, full_load)
+    index = full_load['index']
+    settings = full_load['settings']
+    started_at = full_load['started_at']
+
+    if workers > 1:
+        total = run_partitioned_load(state_manager, index, workers,
+                                     partitions or workers * 4)
+    else:
+        total = load_catalogue(merger, es_loader, index,
+                               dead_letters=dead_letters)
+
+    # Фильмы, изменённые во время загрузки (сами или переименованием
+    # их персон и жанров), досылаем перед переключением
+    total += load_catalogue(merger, es_loader, index, since=started_at,
+                            dead_letters=dead_letters)
+
+    restore_settings(es, index, settings)
+    if merge:
+        force_merge(es, index)
+
+    previous = swap_alias(es, alias, index)
+    state_manager.set_state(FULL_LOAD_KEY, None)
+    if delete_old:
+        for old in previous:
+            es.indices.delete(index=old)
+            logger.info('Index %s deleted', old)
+
+    logger.info('Reindex finished: %s documents in %s, peak RSS %.0f MB',
+                total, index, peak_rss_mb())
+    return index
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--alias', default='movies')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='number_of_replicas after the load')
+    parser.add_argument('--force-merge', action='store_true')
+    parser.add_argument('--delete-old', action='store_true',
+                        help='delete indices the alias pointed to before')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes for a partitioned load')
+    parser.add_argument('--partitions', type=int, default=None,
+                        help='number of id partitions (workers * 4)')
+    args = parser.parse_args()
+    reindex(args.alias, args.replicas, args.force_merge, args.delete_old,
+            args.workers, args.partitions)
+
+
+if __name__ == '__main__':
+    main()
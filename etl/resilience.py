@@ -0,0 +1,354 @@
+"""
+Общий слой устойчивости к сбоям Postgres и Elasticsearch.
+
+- jittered_delay: пауза повтора со случайным разбросом, чтобы повторы
+  разных потоков не приходили одновременно;
+- is_retryable / is_pressure: какие ошибки стоит повторять и какие
+  означают перегрузку backend;
+- CircuitBreaker: общий для всех вызовов одного backend предохранитель;
+- AimdController / BulkThrottle: размер и параллельность bulk-запросов
+  по схеме AIMD (аддитивный рост, мультипликативное уменьшение).
+
+Решения предохранителей и регуляторов доступны через snapshot().
+"""
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import psycopg2
+import psycopg2.errors
+from elasticsearch import ApiError, ConnectionError as ESConnectionError
+
+logger = logging.getLogger('resilience')
+
+# Ответы Elasticsearch, которые имеет смысл повторить
+RETRYABLE_STATUSES = {408, 429, 502, 503, 504}
+
+# Типы ошибок Elasticsearch, означающие перегрузку узла
+PRESSURE_ERRORS = ('es_rejected_execution_exception',
+                   'circuit_breaking_exception')
+
+# Ошибки Postgres, которые повтор не исправит
+FATAL_PG_ERRORS = (psycopg2.ProgrammingError, psycopg2.DataError,
+                   psycopg2.IntegrityError, psycopg2.NotSupportedError)
+
+# Ошибки Postgres, означающие перегрузку сервера
+PRESSURE_PG_ERRORS = (psycopg2.errors.QueryCanceled,
+                      psycopg2.errors.TooManyConnections)
+
+# Те же ошибки asyncpg по именам классов: asyncpg нужен только
+# асинхронному движку, и модуль не должен его импортировать
+FATAL_ASYNCPG_ERRORS = ('SyntaxOrAccessError', 'DataError',
+                        'IntegrityConstraintViolationError')
+PRESSURE_ASYNCPG_ERRORS = ('QueryCanceledError', 'TooManyConnectionsError')
+
+
+def jittered_delay(delay: float) -> float:
+    """
+    Пауза со случайным разбросом: половина фиксирована, половина
+    случайна ("equal jitter")
+    """
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def error_type(exc: BaseException) -> Optional[str]:
+    """
+    Тип ошибки из тела ответа Elasticsearch
+    """
+    body = getattr(exc, 'body', None)
+    if isinstance(body, dict):
+        error = body.get('error')
+        if isinstance(error, dict):
+            return error.get('type')
+    return None
+
+
+def is_asyncpg_error(exc: BaseException, names: Tuple[str, ...]) -> bool:
+    """
+    Ошибка asyncpg одного из классов names или их подклассов
+    """
+    return any(cls.__module__.split('.')[0] == 'asyncpg'
+               and cls.__name__ in names for cls in type(exc).__mro__)
+
+
+def is_pressure(exc: BaseException) -> bool:
+    """
+    Ошибка говорит о перегрузке backend: нагрузку нужно снизить
+    """
+    if isinstance(exc, ApiError):
+        return exc.status_code == 429 or error_type(exc) in PRESSURE_ERRORS
+    return (isinstance(exc, PRESSURE_PG_ERRORS)
+            or is_asyncpg_error(exc, PRESSURE_ASYNCPG_ERRORS))
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Имеет ли смысл повторять вызов после этой ошибки.
+
+    Ошибки запроса (синтаксис SQL, 400 от Elasticsearch) повтор
+    не исправит; остальное, включая неизвестные ошибки, повторяется
+    """
+    if isinstance(exc, CircuitOpenError):
+        return True
+    if isinstance(exc, ApiError):
+        return exc.status_code in RETRYABLE_STATUSES or is_pressure(exc)
+    if isinstance(exc, ESConnectionError):
+        return True
+    return not (isinstance(exc, FATAL_PG_ERRORS)
+                or is_asyncpg_error(exc, FATAL_ASYNCPG_ERRORS))
+
+
+class CircuitOpenError(Exception):
+    """
+    Предохранитель backend разомкнут, вызов не выполнялся
+    """
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f'Circuit {name} is open, '
+                         f'retry in {retry_after:.1f} seconds')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Предохранитель одного backend.
+
+    После failure_threshold ошибок подряд размыкается на reset_timeout
+    секунд: вызывающие ждут, а не повторяют запросы к лежащему
+    backend. Затем пропускает один пробный вызов (half_open): успех
+    замыкает предохранитель, ошибка снова размыкает.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """
+        0, если вызов можно выполнить, иначе сколько секунд подождать
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.OPEN:
+                remaining = (self._opened_at + self.reset_timeout
+                             - time.monotonic())
+                if remaining > 0:
+                    self.rejected += 1
+                    return remaining
+                self.state = self.HALF_OPEN
+                self._probing = False
+            # Пробный вызов один, остальные ждут его результата; пробу
+            # без результата дольше reset_timeout считаем потерянной
+            now = time.monotonic()
+            if self._probing and now - self._probe_started < self.reset_timeout:
+                self.rejected += 1
+                return min(self.reset_timeout, 1.0)
+            self._probing = True
+            self._probe_started = now
+            return 0.0
+
+    def check(self) -> None:
+        retry_after = self.retry_after()
+        if retry_after:
+            raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f'Circuit {self.name} closed')
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning(f'Circuit {self.name} opened after '
+                                   f'{self.failures} failures')
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def record_error(self, exc: BaseException) -> None:
+        """
+        Учёт ошибки вызова: отказом backend считаются только ошибки,
+        которые стоит повторять, кроме перегрузки - ею занимается AIMD
+        """
+        if is_retryable(exc) and not is_pressure(exc):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'state': self.state, 'failures': self.failures,
+                'opened': self.opened, 'rejected': self.rejected}
+
+
+class AimdController:
+    """
+    Регулятор по схеме AIMD: при успехе значение растёт на increase,
+    при перегрузке умножается на decrease, в пределах
+    [minimum, maximum]. Уменьшение не чаще раза в cooldown секунд,
+    чтобы одна волна отказов параллельных запросов не обнулила значение
+    """
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int,
+                 increase: float = 1.0, decrease: float = 0.5,
+                 cooldown: float = 1.0) -> None:
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase_step = increase
+        self.decrease_factor = decrease
+        self.cooldown = cooldown
+        self.increases = 0
+        self.decreases = 0
+        self.last_reason: Optional[str] = None
+        self._value = float(min(max(initial, minimum), maximum))
+        self._decreased_at = float('-inf')
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return int(self._value)
+
+    def increase(self) -> None:
+        with self._lock:
+            if self._value < self.maximum:
+                self._value = min(self._value + self.increase_step,
+                                  self.maximum)
+                self.increases += 1
+
+    def decrease(self, reason: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if (self._value <= self.minimum
+                    or now - self._decreased_at < self.cooldown):
+                return
+            self._value = max(self._value * self.decrease_factor,
+                              self.minimum)
+            self._decreased_at = now
+            self.decreases += 1
+            self.last_reason = reason
+        logger.info(f'{self.name} decreased to {self.value} ({reason})')
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'value': self.value, 'minimum': self.minimum,
+                'maximum': self.maximum, 'increases': self.increases,
+                'decreases': self.decreases,
+                'last_reason': self.last_reason}
+
+
+class BulkThrottle:
+    """
+    Размер чанка и число bulk-запросов в полёте.
+
+    Отказы 429/es_rejected_execution_exception и задержка bulk выше
+    latency_target уменьшают оба значения вдвое, успешные запросы
+    возвращают их к настроенным максимумам
+    """
+
+    def __init__(self, chunk_size: int, concurrency: int,
+                 latency_target: float = 2.0,
+                 min_chunk_size: int = 50,
+                 name: str = 'elasticsearch') -> None:
+        self.latency_target = latency_target
+        self.chunk = register(AimdController(
+            f'{name}_bulk_chunk_size', chunk_size,
+            min(min_chunk_size, chunk_size), chunk_size,
+            increase=max(chunk_size // 10, 1)))
+        self.in_flight = register(AimdController(
+            f'{name}_bulk_concurrency', concurrency, 1, concurrency))
+
+    @property
+    def chunk_size(self) -> int:
+        return self.chunk.value
+
+    @property
+    def concurrency(self) -> int:
+        return self.in_flight.value
+
+    def observe(self, latency: float, pressure: bool = False) -> None:
+        """
+        Учёт ответа на bulk-запрос
+        """
+        if pressure:
+            reason = 'rejected'
+        elif latency > self.latency_target:
+            reason = f'latency {latency:.2f}s'
+        else:
+            self.chunk.increase()
+            self.in_flight.increase()
+            return
+        self.chunk.decrease(reason)
+        self.in_flight.decrease(reason)
+
+
+# Предохранители по имени backend и параметры новых предохранителей
+_breakers: Dict[str, CircuitBreaker] = {}
+_breaker_defaults: Dict[str, Any] = {'failure_threshold': 5,
+                                     'reset_timeout': 30.0}
+_controllers: Dict[str, AimdController] = {}
+_registry_lock = threading.Lock()
+
+
+def configure_breakers(**defaults: Any) -> None:
+    """
+    Параметры предохранителей (failure_threshold, reset_timeout)
+    """
+    with _registry_lock:
+        _breaker_defaults.update(defaults)
+        for breaker in _breakers.values():
+            for key, value in defaults.items():
+                setattr(breaker, key, value)
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """
+    Общий предохранитель backend по имени (postgres, elasticsearch)
+    """
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_breaker_defaults)
+        return _breakers[name]
+
+
+def register(controller: AimdController) -> AimdController:
+    with _registry_lock:
+        _controllers[controller.name] = controller
+    return controller
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    Состояние предохранителей и регуляторов для метрик и логов
+    """
+    with _registry_lock:
+        return {
+            'breakers': {name: breaker.as_dict()
+                         for name, breaker in _breakers.items()},
+            'controllers': {name: controller.as_dict()
+                            for name, controller in _controllers.items()},
+        }
@@ -0,0 +1,143 @@
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List
+
+
+class IdleBackoff:
+    """
+    Пауза простоя: растёт в factor раз, пока изменений нет,
+    до потолка max_sleep и сбрасывается при первой находке
+    """
+
+    def __init__(self, min_sleep: float = 0.5,
+                 max_sleep: float = 30.0,
+                 factor: float = 2.0) -> None:
+        self.min_sleep = min_sleep
+        self.max_sleep = max(max_sleep, min_sleep)
+        self.factor = factor
+        self.current = 0.0
+
+    def idle(self) -> float:
+        """
+        Следующая пауза после пустого опроса
+        """
+        self.current = min(max(self.current * self.factor, self.min_sleep),
+                           self.max_sleep)
+        return self.current
+
+    def reset(self) -> None:
+        self.current = 0.0
+
+
+@dataclass
+class StreamStats:
+    """
+    Наблюдения за потоком: заполненность страниц (0..1) и время
+    обработки пачки, сглаженные экспоненциально
+    """
+    fullness: float = 0.0
+    latency: float = 0.0
+    polls: int = 0
+    skipped: int = 0
+    credit: float = 0.0
+    next_poll: float = 0.0
+    sleep: float = 0.0
+
+
+class StreamScheduler:
+    """
+    Планировщик опроса потоков изменений.
+
+    Поток с полной страницей опрашивается снова без паузы. Пустой
+    поток ждёт экспоненциально растущую паузу до max_sleep, поэтому
+    в простое запросов к Postgres почти нет. Если отставание есть
+    у нескольких потоков, они опрашиваются пропорционально весу
+    (заполненность / время пачки): быстрый поток с большим
+    отставанием не ждёт медленного.
+    """
+
+    def __init__(self, streams: Iterable[str],
+                 min_sleep: float = 0.5,
+                 max_sleep: float = 30.0,
+                 factor: float = 2.0,
+                 smoothing: float = 0.3,
+                 drain: bool = True) -> None:
+        self.min_sleep = min_sleep
+        self.smoothing = smoothing
+        self.drain = drain
+        self.streams = list(streams)
+        self.stats = {stream: StreamStats() for stream in self.streams}
+        self.backoffs = {stream: IdleBackoff(min_sleep, max_sleep, factor)
+                         for stream in self.streams}
+
+    def due(self) -> List[str]:
+        """
+        Потоки, которые пора опросить, в порядке убывания веса
+        """
+        now = time.monotonic()
+        ready = [stream for stream in self.streams
+                 if self.stats[stream].next_poll <= now]
+        weights = self.weights(ready)
+
+        # Потоки с отставанием копят кредит по весу и опрашиваются,
+        # когда он достигает 1; у самого тяжёлого из готовых вес 1,
+        # поэтому хотя бы один поток опрашивается всегда
+        due = []
+        for stream in ready:
+            stats = self.stats[stream]
+            if stats.fullness < 1e-3 or len(ready) == 1:
+                due.append(stream)
+                continue
+            stats.credit += weights[stream]
+            if stats.credit >= 1.0:
+                stats.credit -= 1.0
+                due.append(stream)
+            else:
+                stats.skipped += 1
+        return sorted(due, key=weights.get, reverse=True)
+
+    def weights(self, streams: List[str]) -> Dict[str, float]:
+        raw = {stream: self.stats[stream].fullness
+               / max(self.stats[stream].latency, 1e-3)
+               for stream in streams}
+        top = max(raw.values(), default=0.0)
+        if top <= 0:
+            return {stream: 1.0 for stream in raw}
+        return {stream: value / top for stream, value in raw.items()}
+
+    def record(self, stream: str, fullness: float, elapsed: float) -> None:
+        """
+        Учёт результата опроса: fullness - доля заполненной страницы
+        (1 - полная, 0 - изменений нет), elapsed - время пачки
+        """
+        stats = self.stats[stream]
+        alpha = self.smoothing
+        stats.polls += 1
+        stats.latency = (elapsed if stats.polls == 1
+                         else alpha * elapsed + (1 - alpha) * stats.latency)
+        stats.fullness = alpha * fullness + (1 - alpha) * stats.fullness
+
+        backoff = self.backoffs[stream]
+        now = time.monotonic()
+        if fullness <= 0:
+            stats.fullness = 0.0
+            stats.credit = 0.0
+            stats.sleep = backoff.idle()
+        elif fullness >= 1.0 and self.drain:
+            backoff.reset()
+            stats.sleep = 0.0
+        else:
+            backoff.reset()
+            stats.sleep = self.min_sleep
+        stats.next_poll = now + stats.sleep
+
+    def sleep_time(self) -> float:
+        """
+        Пауза до ближайшего потока, который пора опросить
+        """
+        now = time.monotonic()
+        return max(min((stats.next_poll for stats in self.stats.values()),
+                       default=now) - now, 0.0)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {stream: asdict(stats) for stream, stats in self.stats.items()}
@@ -0,0 +1,130 @@
+"""
+Настройки ETL из окружения и фабрики компонентов по ним.
+
+Общие для точек входа: main.py, async_main.py, reindex.py и
+служебных команд. Импорт модуля читает .env, настраивает логирование
+и предохранители.
+"""
+import atexit
+import logging
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from configs import (PostgresConfig, PostgresPoolConfig, LoggingConfig,
+                     ElasticsearchConfig, EtlConfig, MetricsConfig,
+                     ResilienceConfig, SpoolConfig, StateConfig)
+from deadletter import DeadLetterStore
+from fingerprints import FingerprintStore
+from load import ElasticsearchLoader
+from resilience import BulkThrottle, configure_breakers
+from sinks import Sink, configure_sinks
+from spool import Spool
+from state_manager import (State, JsonFileStorage, SQLiteStorage,
+                           RedisStorage)
+from utils import create_etl_state_json
+
+# Загрузка конфигурации
+load_dotenv()
+postgres_config = PostgresConfig().dict()
+postgres_pool_config = PostgresPoolConfig()
+logging_config = LoggingConfig()
+elasticsearch_config = ElasticsearchConfig()
+etl_config = EtlConfig()
+state_config = StateConfig()
+resilience_config = ResilienceConfig()
+metrics_config = MetricsConfig()
+spool_config = SpoolConfig()
+configure_breakers(
+    failure_threshold=resilience_config.breaker_failure_threshold,
+    reset_timeout=resilience_config.breaker_reset_timeout)
+
+# Настройка логирования
+logging.basicConfig(level=getattr(logging, logging_config.level),
+                    format=logging_config.format)
+
+
+def create_state_manager() -> State:
+    """
+    Менеджер состояний с хранилищем из настроек
+    """
+    if state_config.backend == 'sqlite':
+        storage = SQLiteStorage(state_config.path)
+    elif state_config.backend == 'redis':
+        storage = RedisStorage(state_config.redis_url,
+                               state_config.redis_key)
+    else:
+        # Создание файла состояний etl_state.json
+        create_etl_state_json(file_path=state_config.path)
+        storage = JsonFileStorage(state_config.path)
+    state_manager = State(storage,
+                          flush_interval=state_config.flush_interval)
+    # Несброшенные чекпоинты записываются при выходе
+    atexit.register(state_manager.flush)
+    return state_manager
+
+
+def create_fingerprints() -> Optional[FingerprintStore]:
+    """
+    Кэш отпечатков документов, если он включён
+    """
+    if not etl_config.fingerprints:
+        return None
+    return FingerprintStore(etl_config.fingerprints_path)
+
+
+def create_dead_letters() -> Optional[DeadLetterStore]:
+    """
+    Очередь недоставленных документов, если она включена
+    """
+    if not etl_config.dead_letters:
+        return None
+    return DeadLetterStore(etl_config.dead_letters_path)
+
+
+def create_sinks() -> List[Sink]:
+    """
+    Дополнительные индексы из настроек (ETL_SINKS)
+    """
+    return configure_sinks([name.strip()
+                            for name in etl_config.sinks.split(',')
+                            if name.strip()])
+
+
+def create_es_loader(mode: Optional[str] = None,
+                     fingerprints: Optional[FingerprintStore] = None,
+                     dead_letters: Optional[DeadLetterStore] = None
+                     ) -> ElasticsearchLoader:
+    """
+    Загрузчик Elasticsearch по настройкам из окружения
+    """
+    return ElasticsearchLoader(
+        elasticsearch_config.host,
+        mode=mode or elasticsearch_config.loader_mode,
+        chunk_size=elasticsearch_config.bulk_chunk_size,
+        max_chunk_bytes=elasticsearch_config.bulk_max_chunk_bytes,
+        concurrency=elasticsearch_config.bulk_concurrency,
+        max_retries=elasticsearch_config.bulk_max_retries,
+        fingerprints=fingerprints,
+        dead_letters=dead_letters,
+        throttle=create_bulk_throttle())
+
+
+def create_spool() -> Optional[Spool]:
+    """
+    Дисковая очередь перед загрузкой, если она включена
+    """
+    if not spool_config.enabled:
+        return None
+    return Spool(spool_config.path,
+                 segment_bytes=spool_config.segment_bytes,
+                 max_bytes=spool_config.max_bytes,
+                 compression_level=spool_config.compression_level)
+
+
+def create_bulk_throttle() -> BulkThrottle:
+    return BulkThrottle(
+        elasticsearch_config.bulk_chunk_size,
+        elasticsearch_config.bulk_concurrency,
+        latency_target=resilience_config.bulk_latency_target,
+        min_chunk_size=resilience_config.bulk_min_chunk_size)
@@ -0,0 +1,203 @@
+"""
+Дополнительные приёмники: индексы persons и genres из того же
+прохода, что и movies.
+
+Подробности фильмов читаются PostgresMerger один раз на пачку,
+а каждый приёмник строит из них документы своего индекса и отдаёт
+их загрузчику отдельным bulk-потоком. Добавление индекса не
+добавляет запросов к Postgres.
+
+Документ персоны собирается по фильмам разных пачек, поэтому
+в индекс уходит не документ целиком, а upsert со скриптом:
+фильмы пачки заменяются в списке films, остальные остаются.
+Роли, которых больше нет в Postgres, убирает update_by_query
+по фильмам пачки; он идёт через тот же загрузчик, что и upsert,
+поэтому с дисковой очередью выполняется после него при разборе
+очереди.
+"""
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import orjson
+
+from load import Serializer, to_bulk_lines
+
+logger = logging.getLogger('sinks')
+
+# Роль персоны и ключ списка персон в строке режима aggregated
+AGGREGATED_ROLES = (('actor', 'actors'), ('writer', 'writers'),
+                    ('director', 'directors'))
+
+# Замена фильмов пачки в документе персоны
+PERSON_UPSERT_SCRIPT = '''
+    ctx._source.full_name = params.full_name;
+    Set ids = new HashSet();
+    for (film in params.films) { ids.add(film.id); }
+    ctx._source.films.removeIf(film -> ids.contains(film.id));
+    ctx._source.films.addAll(params.films);
+'''
+
+# Удаление фильмов пачки, в которых персоны больше нет
+PERSON_CLEANUP_SCRIPT = '''
+    boolean removed = ctx._source.films.removeIf(
+        film -> params.current.containsKey(film.id)
+            && !params.current.get(film.id).contains(ctx._source.id));
+    if (!removed) { ctx.op = 'noop'; }
+'''
+
+
+def iter_roles(details: list, mode: str
+               ) -> Iterator[Tuple[Any, str, str, str]]:
+    """
+    Участия персон в фильмах пачки: (строка фильма, id персоны,
+    имя, роль)
+    """
+    if mode == 'aggregated':
+        for row in details:
+            for role, key in AGGREGATED_ROLES:
+                for person in row[key]:
+                    yield row, person['id'], person['name'], role
+        return
+    for row in details:
+        if row['person_id'] is not None and row['role']:
+            yield row, str(row['person_id']), row['full_name'], row['role']
+
+
+def iter_genres(details: list, mode: str) -> Iterator[Tuple[str, str]]:
+    """
+    Жанры фильмов пачки: (id, название)
+    """
+    if mode == 'aggregated':
+        for row in details:
+            for genre in row['genre_items']:
+                yield genre['id'], genre['name']
+        return
+    for row in details:
+        if row['genre_id'] is not None and row['name']:
+            yield str(row['genre_id']), row['name']
+
+
+class Sink:
+    """
+    Приёмник: индекс, преобразование подробностей фильмов
+    в его документы и действие bulk для документа
+    """
+    index: str = ''
+
+    def transform(self, details: list, mode: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @property
+    def serialize(self) -> Serializer:
+        return to_bulk_lines
+
+    def cleanup(self, es_loader, film_ids: List[str],
+                documents: List[Dict[str, Any]]) -> None:
+        """
+        Действия после загрузки пачки через загрузчик es_loader
+        (по умолчанию нет)
+        """
+
+
+class GenresSink(Sink):
+    """
+    Индекс genres: id и название жанра
+    """
+    index = 'genres'
+
+    def transform(self, details: list, mode: str) -> List[Dict[str, Any]]:
+        genres = dict(iter_genres(details, mode))
+        return [{'id': genre_id, 'name': name}
+                for genre_id, name in genres.items()]
+
+
+class PersonsSink(Sink):
+    """
+    Индекс persons: персона и её фильмы с ролями
+    """
+    index = 'persons'
+
+    def transform(self, details: list, mode: str) -> List[Dict[str, Any]]:
+        persons: Dict[str, Dict[str, Any]] = {}
+        for row, person_id, full_name, role in iter_roles(details, mode):
+            person = persons.get(person_id)
+            if person is None:
+                person = persons[person_id] = {
+                    'id': person_id, 'full_name': full_name, 'films': {}}
+            fw_id = str(row['fw_id'])
+            film = person['films'].get(fw_id)
+            if film is None:
+                film = person['films'][fw_id] = {
+                    'id': fw_id,
+                    'title': row['title'],
+                    'imdb_rating': float(row['rating'])
+                    if row['rating'] is not None else None,
+                    'roles': []}
+            if role not in film['roles']:
+                film['roles'].append(role)
+        for person in persons.values():
+            person['films'] = list(person['films'].values())
+        return list(persons.values())
+
+    @property
+    def serialize(self) -> Serializer:
+        return to_person_upsert
+
+    def cleanup(self, es_loader, film_ids: List[str],
+                documents: List[Dict[str, Any]]) -> None:
+        """
+        Удаление фильмов пачки у персон, которых в них больше нет
+        """
+        if not film_ids:
+            return
+        current: Dict[str, List[str]] = {str(film_id): []
+                                         for film_id in film_ids}
+        for person in documents:
+            for film in person['films']:
+                current.setdefault(film['id'], []).append(person['id'])
+        updated = es_loader.update_by_query(
+            self.index,
+            {'nested': {'path': 'films', 'query': {
+                'terms': {'films.id': list(current)}}}},
+            {'source': PERSON_CLEANUP_SCRIPT, 'lang': 'painless',
+             'params': {'current': current}})
+        if updated:
+            logger.info('Removed stale roles from %s persons', updated)
+
+
+def to_person_upsert(index: str, person: Dict[str, Any]) -> bytes:
+    """
+    Строки bulk update со скриптом и upsert для документа персоны
+    """
+    action = orjson.dumps({'update': {'_index': index, '_id': person['id'],
+                                      'retry_on_conflict': 3}})
+    body = orjson.dumps({
+        'script': {'source': PERSON_UPSERT_SCRIPT, 'lang': 'painless',
+                   'params': {'full_name': person['full_name'],
+                              'films': person['films']}},
+        'upsert': person})
+    return action + b'\n' + body + b'\n'
+
+
+SINKS = {'persons': PersonsSink, 'genres': GenresSink}
+
+_sinks: List[Sink] = []
+
+
+def configure_sinks(names: Iterable[str]) -> List[Sink]:
+    """
+    Включение приёмников по именам индексов (ETL_SINKS)
+    """
+    sinks = []
+    for name in names:
+        if name not in SINKS:
+            raise ValueError(f'Unknown sink: {name}')
+        sinks.append(SINKS[name]())
+    _sinks[:] = sinks
+    if sinks:
+        logger.info('Extra sinks: %s', ', '.join(s.index for s in sinks))
+    return sinks
+
+
+def get_sinks() -> List[Sink]:
+    return _sinks
@@ -0,0 +1,355 @@
+"""
+Дисковая очередь (spool) между преобразованием и загрузкой.
+
+Пачки документов пишутся готовыми телами bulk-запросов (NDJSON),
+сжатыми zlib, в сегменты только на дозапись. Запись пачки
+завершается fsync, и только после этого сдвигается чекпоинт
+в State. Загрузчик в отдельном потоке читает сегменты через mmap,
+отправляет тела в Elasticsearch и сохраняет свой подтверждённый
+сдвиг. Пока Elasticsearch недоступен, извлечение и преобразование
+продолжают работать, а после восстановления накопленное уходит
+со скоростью bulk без повторных запросов к Postgres.
+
+Кроме тел bulk в очередь пишутся запросы update_by_query (очистка
+ролей приёмника persons): они выполняются в том же порядке, что и
+пачки, после которых были записаны. С кэшем отпечатков неизменившиеся
+документы отбрасываются до записи в очередь, а отпечатки записанных
+сохраняются сразу: следующая версия документа сравнивается с той, что
+уже стоит в очереди. Отпечатки документов, которые Elasticsearch
+отклонил при разборе очереди, забываются.
+"""
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import orjson
+
+from fingerprints import FingerprintStore
+from deadletter import iter_bulk_sources
+from load import (ElasticsearchLoader, LoadReport, Serializer,
+                  save_fingerprints, skip_unchanged, to_bulk_lines,
+                  to_bulk_ndjson)
+from metrics import count_documents
+from state_manager import JsonFileStorage
+
+logger = logging.getLogger('spool')
+
+# Заголовок записи: длина сжатого тела и его crc32
+RECORD_HEADER = struct.Struct('<II')
+
+SEGMENT_SUFFIX = '.seg'
+
+# Начало записи с запросом update_by_query вместо тела bulk
+QUERY_RECORD = b'{"update_by_query":'
+
+
+class SpoolOffset(NamedTuple):
+    """
+    Позиция в очереди: номер сегмента и смещение в нём
+    """
+    segment: int
+    position: int
+
+
+class Spool:
+    """
+    Сегментированная очередь сжатых пачек на диске.
+
+    Одна запись - одно тело bulk-запроса. Недописанная при сбое
+    запись в конце последнего сегмента отбрасывается при открытии
+    (по длине и crc32). Подтверждённый загрузчиком сдвиг хранится
+    в offsets.json, прочитанные сегменты удаляются.
+    """
+
+    def __init__(self, directory: str = 'etl_spool',
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 max_bytes: int = 1024 * 1024 * 1024,
+                 compression_level: int = 1) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.compression_level = compression_level
+        self.offsets = JsonFileStorage(os.path.join(directory,
+                                                    'offsets.json'))
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+
+        committed = self.offsets.retrieve_state().get('committed')
+        segments = self._segments()
+        self.committed = (SpoolOffset(*committed) if committed
+                          else SpoolOffset(segments[0] if segments else 0,
+                                           0))
+        # Конец записанных данных; читатель не заходит дальше него
+        self.end = self._recover(segments)
+        self._file = open(self._path(self.end.segment), 'ab')
+
+    def append(self, body: bytes) -> SpoolOffset:
+        """
+        Дозапись тела bulk-запроса; возвращает конец записи после fsync
+        """
+        payload = zlib.compress(body, self.compression_level)
+        record = RECORD_HEADER.pack(len(payload),
+                                    zlib.crc32(payload)) + payload
+        with self._lock:
+            if self.end.position and (self.end.position + len(record)
+                                      > self.segment_bytes):
+                self._rotate()
+            self._file.write(record)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.end = SpoolOffset(self.end.segment,
+                                   self.end.position + len(record))
+            self._appended.notify_all()
+            return self.end
+
+    def read(self, after: Optional[SpoolOffset] = None
+             ) -> Iterator[Tuple[SpoolOffset, bytes]]:
+        """
+        Записи после подтверждённого сдвига (или after): пары
+        (сдвиг после записи, тело bulk-запроса)
+        """
+        offset = after or self.committed
+        while True:
+            with self._lock:
+                end = self.end
+            if offset >= end:
+                return
+            if offset.segment < end.segment:
+                limit = None
+            else:
+                limit = end.position
+            for position, payload in self._read_segment(
+                    offset.segment, offset.position, limit):
+                offset = SpoolOffset(offset.segment, position)
+                yield offset, zlib.decompress(payload)
+            if offset.segment < end.segment:
+                # Сегмент прочитан до конца, дальше следующий
+                offset = SpoolOffset(offset.segment + 1, 0)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Ожидание новых записей; False, если их так и не появилось
+        """
+        with self._lock:
+            if self.committed < self.end:
+                return True
+            return self._appended.wait(timeout)
+
+    def commit(self, offset: SpoolOffset) -> None:
+        """
+        Сохранение сдвига, подтверждённого загрузчиком, и удаление
+        полностью прочитанных сегментов
+        """
+        self.offsets.save_state({'committed': list(offset)})
+        with self._lock:
+            previous, self.committed = self.committed, offset
+        if offset.segment == previous.segment:
+            return
+        for segment in self._segments():
+            if segment < offset.segment:
+                os.remove(self._path(segment))
+
+    def pending_bytes(self) -> int:
+        """
+        Сжатый объём записей, ещё не подтверждённых загрузчиком
+        """
+        with self._lock:
+            committed, end = self.committed, self.end
+        total = 0
+        for segment in self._segments():
+            if committed.segment <= segment <= end.segment:
+                total += os.path.getsize(self._path(segment))
+        return max(total - committed.position, 0)
+
+    def full(self) -> bool:
+        return self.pending_bytes() >= self.max_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        return {'committed': list(self.committed), 'end': list(self.end),
+                'pending_bytes': self.pending_bytes()}
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def _read_segment(self, segment: int, start: int,
+                      limit: Optional[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        Записи сегмента от start до limit через mmap: пары
+        (смещение после записи, сжатое тело)
+        """
+        with open(self._path(segment), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            limit = size if limit is None else min(limit, size)
+            if limit <= start:
+                return
+            with mmap.mmap(file.fileno(), limit,
+                           access=mmap.ACCESS_READ) as data:
+                position = start
+                while position + RECORD_HEADER.size <= limit:
+                    length, crc = RECORD_HEADER.unpack_from(data, position)
+                    begin = position + RECORD_HEADER.size
+                    payload = data[begin:begin + length]
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        raise ValueError(f'Corrupted spool segment '
+                                         f'{segment} at {position}')
+                    position = begin + length
+                    yield position, payload
+
+    def _recover(self, segments: List[int]) -> SpoolOffset:
+        """
+        Конец последнего сегмента после отбрасывания недописанной
+        записи
+        """
+        if not segments:
+            return SpoolOffset(self.committed.segment, 0)
+        segment = segments[-1]
+        position = 0
+        with open(self._path(segment), 'rb') as file:
+            data = file.read()
+        while position + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, position)
+            begin = position + RECORD_HEADER.size
+            payload = data[begin:begin + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            position = begin + length
+        if position < len(data):
+            logger.warning('Dropping %s bytes of a torn record at the end '
+                           'of spool segment %s', len(data) - position,
+                           segment)
+            with open(self._path(segment), 'r+b') as file:
+                file.truncate(position)
+                os.fsync(file.fileno())
+        return SpoolOffset(segment, position)
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self.end = SpoolOffset(self.end.segment + 1, 0)
+        self._file = open(self._path(self.end.segment), 'ab')
+        # Новый файл должен пережить сбой вместе с каталогом
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+            for path in glob.glob(os.path.join(self.directory,
+                                               '*' + SEGMENT_SUFFIX)))
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory,
+                            f'{segment:012d}{SEGMENT_SUFFIX}')
+
+
+class SpoolWriter:
+    """
+    Замена ElasticsearchLoader для стадии загрузки: пачка уходит
+    не в Elasticsearch, а в очередь на диске. Документы, не
+    изменившиеся по кэшу отпечатков, в очередь не пишутся, а
+    отпечатки записанных сохраняются сразу после записи
+    """
+
+    def __init__(self, spool: Spool,
+                 fingerprints: Optional[FingerprintStore] = None) -> None:
+        self.spool = spool
+        self.fingerprints = fingerprints
+
+    def bulk_load(self, index: str, data: list,
+                  serialize: Serializer = to_bulk_lines) -> int:
+        changed, hashes = skip_unchanged(self.fingerprints, index, data,
+                                         logger)
+        count_documents('skipped', len(data) - len(changed))
+        if not changed:
+            return 0
+        self.spool.append(to_bulk_ndjson(index, changed, serialize))
+        # Иначе версия, ещё не дошедшая из очереди, сравнивалась бы
+        # с устаревшим отпечатком и возврат к нему считался неизменным
+        save_fingerprints(self.fingerprints, index, hashes, LoadReport())
+        count_documents('spooled', len(changed))
+        return len(changed)
+
+    def update_by_query(self, index: str, query: Dict[str, Any],
+                        script: Dict[str, Any]) -> int:
+        """
+        Запрос записывается в очередь и выполняется загрузчиком
+        после записанных до него пачек; возвращает 0
+        """
+        self.spool.append(orjson.dumps({'update_by_query': {
+            'index': index, 'query': query, 'script': script}}))
+        return 0
+
+
+class SpoolReplayer(threading.Thread):
+    """
+    Фоновая загрузка записей очереди в Elasticsearch.
+
+    Сдвиг подтверждается после каждой принятой записи. Пока
+    Elasticsearch недоступен, bulk_load_ndjson повторяет запрос
+    (backoff и предохранитель), а извлечение продолжает писать
+    в очередь. Документы записи, отклонённые Elasticsearch,
+    уходят в очередь недоставленных загрузчика, а их отпечатки
+    забываются. Запись, которую
+    повтор не исправит целиком, повторяется с начала через
+    poll_interval и задерживает очередь
+    """
+
+    def __init__(self, spool: Spool, es_loader: ElasticsearchLoader,
+                 poll_interval: float = 1.0) -> None:
+        super().__init__(name='spool-replayer', daemon=True)
+        self.spool = spool
+        self.es_loader = es_loader
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            if not self.spool.wait(self.poll_interval):
+                continue
+            try:
+                self._replay()
+            except Exception as e:
+                logger.error('Failed to load a spooled batch: %s', e)
+                self._stopped.wait(self.poll_interval)
+
+    def _replay(self) -> None:
+        for offset, body in self.spool.read():
+            if body.startswith(QUERY_RECORD):
+                self.es_loader.update_by_query(
+                    **orjson.loads(body)['update_by_query'])
+            else:
+                report = LoadReport()
+                count_documents('indexed', self.es_loader.bulk_load_ndjson(
+                    body, report))
+                self._forget_failed(body, report)
+            self.spool.commit(offset)
+            if self._stopped.is_set():
+                return
+
+    def _forget_failed(self, body: bytes, report: LoadReport) -> None:
+        """
+        Отпечатки документов, отклонённых Elasticsearch: они были
+        сохранены при записи в очередь, но в индекс не попали
+        """
+        fingerprints = self.es_loader.fingerprints
+        if fingerprints is None or not report.failed:
+            return
+        failed = {str(doc_id) for doc_id, _ in report.failed}
+        by_index: Dict[str, List[str]] = {}
+        for index, doc_id, _ in iter_bulk_sources(body):
+            if doc_id in failed:
+                by_index.setdefault(index, []).append(doc_id)
+        for index, ids in by_index.items():
+            fingerprints.forget(index, ids)
+
+    def stop(self) -> None:
+        self._stopped.set()
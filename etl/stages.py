@@ -0,0 +1,225 @@
+"""
+Стадии ETL процесса над пачкой (Batch).
+
+Общие для последовательного движка, конвейера, режима notify
+(main.py) и повторной обработки недоставленных документов
+(deadletter.py); асинхронный движок берёт отсюда чекпоинты.
+"""
+import logging
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+from deadletter import get_dead_letters
+from extract import PostgresMerger, PostgresProducer
+from fanout import FanOut, FanOutJob
+from load import ElasticsearchLoader
+from metrics import count_rows, stage_timer
+from partial import PartialUpdater
+from pipeline import Batch, last_cursor
+from settings import etl_config
+from sinks import get_sinks
+from state_manager import Cursor, State
+from transform import transform_merged
+
+logger = logging.getLogger('stages')
+
+
+def extract_updates(producer: PostgresProducer, stream: str,
+                    cursor: Optional[Cursor] = None) -> Optional[Batch]:
+    """
+    Получение следующей пачки изменений потока
+    """
+    with stage_timer('producer'):
+        rows = producer.fetch_updated(stream, cursor)
+    count_rows('producer', len(rows))
+    if not rows:
+        logger.info(f'No {stream} updates found.')
+        return None
+    return Batch(stream, last_cursor(rows), [row['id'] for row in rows])
+
+
+def partial_update(updater: PartialUpdater, fanout: FanOut,
+                   batch: Batch) -> Optional[FanOutJob]:
+    """
+    Частичное обновление документов по пачке персон или жанров.
+
+    Возвращает задание полной пересборки для изменений,
+    которые частично применить нельзя
+    """
+    genre_names = None
+    if batch.stream == 'person':
+        fallback_ids = updater.update_persons(batch.ids)
+    else:
+        fallback_ids, genre_names = updater.update_genres(batch.ids)
+
+    job = None
+    if fallback_ids:
+        job = FanOutJob(batch.stream, fallback_ids, batch.cursor)
+        # Задание сохраняется раньше названий жанров, чтобы после
+        # сбоя пересборка продолжилась, а не была пропущена
+        fanout.save(job)
+    if genre_names:
+        updater.remember_genres(genre_names)
+    return job
+
+
+def extract_batch(producer: PostgresProducer, fanout: FanOut,
+                  stream: str,
+                  updater: Optional[PartialUpdater] = None
+                  ) -> Optional[Batch]:
+    """
+    Следующая пачка фильмов потока.
+
+    Для персон и жанров это очередная порция связанных фильмов:
+    продолжение незавершённого разветвления или начало нового
+    по следующей странице изменений. С частичным обновлением
+    (updater) переименования применяются прямо к индексу, а полная
+    пересборка остаётся только для того, что так обновить нельзя
+    """
+    if stream not in FanOut.STREAMS:
+        batch = extract_updates(producer, stream)
+        if batch is not None:
+            batch.film_ids = batch.ids
+        return batch
+
+    job = fanout.pending(stream)
+    if job is None:
+        batch = extract_updates(producer, stream)
+        if batch is None:
+            return None
+        if updater is None:
+            job = FanOutJob(stream, batch.ids, batch.cursor)
+        else:
+            job = partial_update(updater, fanout, batch)
+            if job is None:
+                return batch
+    else:
+        batch = Batch(stream, job.cursor, job.ids)
+    with stage_timer('inricher'):
+        batch.film_ids = fanout.next_chunk(job)
+    count_rows('inricher', len(batch.film_ids))
+    batch.fanout = job
+    return batch
+
+
+def extract_chunk(producer: PostgresProducer, fanout: FanOut,
+                  jobs: Dict[str, Optional[FanOutJob]], stream: str,
+                  cursor: Optional[Cursor] = None) -> Optional[Batch]:
+    """
+    Следующая пачка фильмов потока для конвейера (StreamSource).
+
+    Курсор потока и текущие разветвления (jobs) хранятся в памяти
+    источника и обгоняют сохранённые чекпоинты, поэтому задание
+    берётся из jobs, а не из состояния. Пачка несёт копию задания:
+    стадия чекпоинта сохраняет подкурсор этой порции, а не того,
+    до которого источник уже дошёл
+    """
+    if stream not in FanOut.STREAMS:
+        batch = extract_updates(producer, stream, cursor)
+        if batch is not None:
+            batch.film_ids = batch.ids
+        return batch
+
+    job = jobs.get(stream)
+    if job is None or job.done:
+        batch = extract_updates(producer, stream, cursor)
+        if batch is None:
+            return None
+        job = jobs[stream] = FanOutJob(stream, batch.ids, batch.cursor)
+    with stage_timer('inricher'):
+        film_ids = fanout.next_chunk(job)
+    count_rows('inricher', len(film_ids))
+    if not job.done:
+        # Незавершённое задание запишет чекпоинт этой порции
+        job.persisted = True
+    return Batch(stream, job.cursor, job.ids, film_ids=film_ids,
+                 fanout=replace(job))
+
+
+def merge_batch(merger: PostgresMerger, batch: Batch) -> Batch:
+    """
+    Получение подробной информации о фильмах пачки
+    """
+    with stage_timer('merger'):
+        batch.details = merger.fetch_film_work_details(batch.film_ids)
+    count_rows('merger', len(batch.details))
+    return batch
+
+
+def transform_batch(merger: PostgresMerger, batch: Batch) -> Batch:
+    """
+    Преобразование фильмов пачки в документы индекса
+    """
+    dead_letters = get_dead_letters()
+    # С очередью недоставленных фильмы, не прошедшие валидацию,
+    # откладываются, а не останавливают пачку
+    rejected = [] if dead_letters is not None else None
+    with stage_timer('transform'):
+        batch.documents = transform_merged(batch.details,
+                                           merger.mode,
+                                           etl_config.validation,
+                                           rejected)
+        details = batch.details
+        if rejected:
+            dead_letters.add_rejected(details, rejected)
+            batch.rejected = [str(fw_id) for fw_id, _ in rejected]
+            rejected_ids = set(batch.rejected)
+            details = [row for row in details
+                       if str(row['fw_id']) not in rejected_ids]
+        for sink in get_sinks():
+            batch.outputs[sink.index] = sink.transform(details, merger.mode)
+    count_rows('transform', len(batch.documents))
+    batch.details = []
+    return batch
+
+
+def load_batch(es_loader: ElasticsearchLoader, batch: Batch) -> Batch:
+    """
+    Загрузка документов пачки в Elasticsearch
+    """
+    # Отложенные фильмы не трогаются ни в одном индексе: очистка
+    # ролей иначе убрала бы их у всех персон
+    rejected_ids = set(batch.rejected)
+    film_ids = [film_id for film_id in batch.film_ids
+                if str(film_id) not in rejected_ids]
+    try:
+        with stage_timer('load'):
+            es_loader.bulk_load('movies', batch.documents)
+            for sink in get_sinks():
+                documents = batch.outputs.get(sink.index, [])
+                es_loader.bulk_load(sink.index, documents,
+                                    serialize=sink.serialize)
+                sink.cleanup(es_loader, film_ids, documents)
+        count_rows('load', len(batch.documents))
+        logger.info(f'Successfully loaded {len(batch.documents)} films '
+                    f'for {batch.stream} updates to Elasticsearch.')
+    except Exception as e:
+        logger.debug('Failed to load %s-related film data '
+                     'into Elasticsearch: %s', batch.stream, e)
+        raise
+    return batch
+
+
+def checkpoint_batch(state_manager: State, fanout: FanOut,
+                     batch: Batch) -> Batch:
+    """
+    Сдвиг чекпоинта потока (или подкурсора разветвления) после
+    подтверждения загрузки
+    """
+    checkpoint_batches(state_manager, fanout, [batch])
+    return batch
+
+
+def checkpoint_batches(state_manager: State, fanout: FanOut,
+                       batches: List[Batch]) -> None:
+    """
+    Сдвиг курсоров потоков, чьи пачки загружены полностью, и
+    сохранение подкурсоров незавершённых разветвлений
+    """
+    cursors = {batch.stream: batch.cursor for batch in batches
+               if batch.fanout is None or batch.fanout.done}
+    if cursors:
+        state_manager.set_cursors(cursors)
+    for batch in batches:
+        if batch.fanout is not None:
+            fanout.save(batch.fanout)
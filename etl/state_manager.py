@@ -1,24 +1,123 @@
+import copy
+import fcntl
 import json
 import os
-from datetime import datetime
-from typing import Any, Dict
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple, Union
+
+# Минимальный id для курсора, сохранённого до появления поля id
+NIL_UUID = '00000000-0000-0000-0000-000000000000'
+
+
+class Cursor(NamedTuple):
+    """
+    Составной курсор потока изменений: (updated_at, id)
+    """
+    updated_at: Union[str, datetime, None]
+    id: Optional[str]
+
+
+def cursor_order(cursor: Cursor) -> Tuple[datetime, str]:
+    """
+    Ключ сравнения курсоров; пустой курсор меньше любого другого
+    """
+    updated_at = cursor.updated_at
+    if updated_at is None:
+        updated_at = datetime.min.replace(tzinfo=timezone.utc)
+    elif isinstance(updated_at, str):
+        updated_at = datetime.fromisoformat(updated_at)
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    return updated_at, str(cursor.id or NIL_UUID)
+
+
+def cursor_state(stream: str, cursor: Cursor) -> Dict[str, Any]:
+    """
+    Ключи состояния, в которых хранится курсор потока
+    """
+    updated_at = cursor.updated_at
+    if isinstance(updated_at, datetime):
+        updated_at = updated_at.isoformat()
+    return {f'last_{stream}_update': updated_at,
+            f'last_{stream}_id': str(cursor.id)}
 
 
 class BaseStorage:
+    # Хранилище рассчитано на несколько процессов: курсоры
+    # сдвигаются через compare_and_set
+    shared = False
+
     def save_state(self, state: Dict[str, Any]) -> None:
         pass
 
     def retrieve_state(self) -> Dict[str, Any]:
         pass
 
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        yield
+
+    def update_state(self, changes: Dict[str, Any]) -> None:
+        """
+        Запись только изменённых ключей
+        """
+        with self.lock():
+            state = self.retrieve_state()
+            state.update(changes)
+            self.save_state(state)
+
+    def compare_and_set(self, expected: Dict[str, Any],
+                        changes: Dict[str, Any]) -> bool:
+        """
+        Запись changes, только если ключи expected не изменились
+        """
+        with self.lock():
+            state = self.retrieve_state()
+            if any(state.get(key) != value
+                   for key, value in expected.items()):
+                return False
+            state.update(changes)
+            self.save_state(state)
+            return True
+
 
 class JsonFileStorage(BaseStorage):
+    """
+    Состояние в JSON-файле.
+
+    Файл перезаписывается атомарно: временный файл в том же каталоге,
+    fsync и rename, поэтому после сбоя остаётся старая или новая
+    версия, но не обрезанная. Чтение-изменение-запись защищены
+    блокировкой flock на соседнем файле .lock.
+    """
+
     def __init__(self, file_path: str) -> None:
         self.file_path = file_path
+        self._thread_lock = threading.Lock()
 
     def save_state(self, state: Dict[str, Any]) -> None:
-        with open(self.file_path, 'w') as file:
-            json.dump(state, file)
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(state, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        # rename становится надёжным только после fsync каталога
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def retrieve_state(self) -> Dict[str, Any]:
         if os.path.exists(self.file_path):
@@ -27,19 +126,239 @@ class JsonFileStorage(BaseStorage):
         else:
             return {}
 
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with self._thread_lock, open(f'{self.file_path}.lock', 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Состояние в SQLite: ключ - строка таблицы, значение - JSON.
+
+    Запись отдельных ключей и compare_and_set выполняются
+    в транзакции BEGIN IMMEDIATE, поэтому безопасны для нескольких
+    процессов на одной машине.
+    """
+    shared = True
+
+    def __init__(self, path: str = 'etl_state.sqlite') -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                                     check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS state '
+                           '(key TEXT PRIMARY KEY, value TEXT)')
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM state')
+            self._upsert(conn, state)
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute('SELECT key, value FROM state')
+            return {key: json.loads(value) for key, value in rows}
+
+    def update_state(self, changes: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            self._upsert(conn, changes)
+
+    def compare_and_set(self, expected: Dict[str, Any],
+                        changes: Dict[str, Any]) -> bool:
+        with self._transaction() as conn:
+            for key, value in expected.items():
+                row = conn.execute('SELECT value FROM state WHERE key = ?',
+                                   (key,)).fetchone()
+                if (json.loads(row[0]) if row else None) != value:
+                    return False
+            self._upsert(conn, changes)
+            return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            else:
+                self._conn.execute('COMMIT')
+
+    @staticmethod
+    def _upsert(conn: sqlite3.Connection, values: Dict[str, Any]) -> None:
+        conn.executemany(
+            'INSERT INTO state (key, value) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+            ((key, json.dumps(value)) for key, value in values.items()))
+
+
+class RedisStorage(BaseStorage):
+    """
+    Состояние в хэше Redis: поле - ключ состояния, значение - JSON.
+
+    compare_and_set построен на WATCH/MULTI. Клиент можно передать
+    готовым, например fakeredis.FakeRedis() вместо сервера в тестах.
+    """
+    shared = True
+
+    def __init__(self, url: str = 'redis://localhost:6379/0',
+                 key: str = 'etl_state', client: Any = None) -> None:
+        if client is None:
+            # redis нужен только этому хранилищу
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.key = key
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        with self.client.pipeline() as pipe:
+            pipe.delete(self.key)
+            if state:
+                pipe.hset(self.key, mapping=self._dump(state))
+            pipe.execute()
+
+    def retrieve_state(self) -> Dict[str, Any]:
+        return {field.decode(): json.loads(value)
+                for field, value in self.client.hgetall(self.key).items()}
+
+    def update_state(self, changes: Dict[str, Any]) -> None:
+        if changes:
+            self.client.hset(self.key, mapping=self._dump(changes))
+
+    def compare_and_set(self, expected: Dict[str, Any],
+                        changes: Dict[str, Any]) -> bool:
+        # Импорт здесь, чтобы модуль не требовал redis без этого хранилища
+        from redis.exceptions import WatchError
+
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                current = pipe.hmget(self.key, list(expected))
+                for value, raw in zip(expected.values(), current):
+                    if (json.loads(raw) if raw is not None else None) != value:
+                        pipe.unwatch()
+                        return False
+                pipe.multi()
+                pipe.hset(self.key, mapping=self._dump(changes))
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    @staticmethod
+    def _dump(values: Dict[str, Any]) -> Dict[str, str]:
+        return {key: json.dumps(value) for key, value in values.items()}
+
 
 class State:
-    def __init__(self, storage: BaseStorage) -> None:
+    """
+    Состояние ETL с копией в памяти.
+
+    Чтение не обращается к хранилищу. Запись копится в памяти и
+    сбрасывается в хранилище не чаще раза в flush_interval секунд
+    (0 - сразу) или явным вызовом flush(). В общем хранилище
+    (shared) курсоры сдвигаются только вперёд через compare_and_set,
+    поэтому параллельные процессы не откатывают курсоры друг друга.
+    """
+
+    def __init__(self, storage: BaseStorage,
+                 flush_interval: float = 0.0) -> None:
         self.storage = storage
+        self.flush_interval = flush_interval
+        self._state = storage.retrieve_state() or {}
+        self._dirty: Dict[str, Any] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
 
     def set_state(self, key: str, value: Any) -> None:
         if isinstance(value, datetime):
             value = value.isoformat()
-        state = self.storage.retrieve_state()
-        state[key] = value
-        self.storage.save_state(state)
+        self.update({key: value})
 
     def get_state(self, key: str) -> Any:
-        state = self.storage.retrieve_state()
-        value = state.get(key, None)
-        return value
+        with self._lock:
+            # Копия, чтобы изменения вызывающего не попали в состояние
+            # без set_state
+            return copy.deepcopy(self._state.get(key, None))
+
+    def update(self, changes: Dict[str, Any]) -> None:
+        """
+        Изменение нескольких ключей одной записью
+        """
+        with self._lock:
+            changes = copy.deepcopy(changes)
+            self._state.update(changes)
+            self._dirty.update(changes)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Запись накопленных изменений в хранилище
+        """
+        with self._lock:
+            if self._dirty:
+                self.storage.update_state(self._dirty)
+                self._dirty = {}
+            self._last_flush = time.monotonic()
+
+    def reload(self) -> None:
+        """
+        Перечитывание хранилища (несохранённые изменения остаются)
+        """
+        with self._lock:
+            self._state = self.storage.retrieve_state() or {}
+            self._state.update(self._dirty)
+
+    def get_cursor(self, stream: str) -> Cursor:
+        with self._lock:
+            return Cursor(self._state.get(f'last_{stream}_update'),
+                          self._state.get(f'last_{stream}_id'))
+
+    def set_cursor(self, stream: str, cursor: Cursor) -> None:
+        self.set_cursors({stream: cursor})
+
+    def set_cursors(self, cursors: Dict[str, Cursor]) -> None:
+        """
+        Сдвиг курсоров нескольких потоков одной записью состояния
+        """
+        if self.storage.shared:
+            for stream, cursor in cursors.items():
+                self.advance_cursor(stream, cursor)
+            return
+        changes = {}
+        for stream, cursor in cursors.items():
+            changes.update(cursor_state(stream, cursor))
+        self.update(changes)
+
+    def advance_cursor(self, stream: str, cursor: Cursor) -> bool:
+        """
+        Сдвиг курсора в хранилище только вперёд.
+
+        Возвращает False, если другой процесс уже сохранил
+        курсор не меньше этого
+        """
+        changes = cursor_state(stream, cursor)
+        with self._lock:
+            while True:
+                stored = self.storage.retrieve_state() or {}
+                expected = {key: stored.get(key) for key in changes}
+                current = Cursor(*expected.values())
+                if cursor_order(current) >= cursor_order(cursor):
+                    self._state.update(expected)
+                    return False
+                if self.storage.compare_and_set(expected, changes):
+                    self._state.update(changes)
+                    return True
@@ -0,0 +1,22 @@
+"""
+Общие настройки тестов: модули ETL импортируются из каталога etl,
+как при запуске из него, а настройки читаются из окружения.
+
+Запуск из каталога etl:
+
+    pip install pytest fakeredis
+    python -m pytest tests
+"""
+import os
+import sys
+
+ETL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ETL_DIR not in sys.path:
+    sys.path.insert(0, ETL_DIR)
+
+# settings читает конфигурацию при импорте; соединения не открываются
+for name, value in {'POSTGRES_HOST': 'localhost', 'POSTGRES_PORT': '5432',
+                    'POSTGRES_DBNAME': 'movies', 'POSTGRES_USER': 'app',
+                    'POSTGRES_PASSWORD': 'app',
+                    'ELASTICSEARCH_HOST': 'http://localhost:9200'}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,18 @@
+from coalesce import coalesce_batches
+from pipeline import Batch
+from state_manager import Cursor
+
+CURSOR = Cursor('2024-01-01T00:00:00+00:00', 'x')
+
+
+def test_films_of_all_streams_are_loaded_once():
+    work = coalesce_batches([
+        Batch('film', CURSOR, ['1', '2'], film_ids=['1', '2']),
+        Batch('person', CURSOR, ['p1'], film_ids=['2', '3']),
+        Batch('genre', CURSOR, ['g1'], film_ids=['3', '1', '4']),
+    ])
+    # Порядок первого появления: фильмы потока film первыми
+    assert work.film_ids == ['1', '2', '3', '4']
+    assert (work.stats.affected, work.stats.unique,
+            work.stats.duplicates) == (7, 4, 3)
+    assert work.stats.by_stream == {'film': 2, 'person': 2, 'genre': 3}
@@ -0,0 +1,61 @@
+import time
+
+import orjson
+import pytest
+
+from deadletter import DeadLetterStore, iter_bulk_sources, replay
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DeadLetterStore(str(tmp_path / 'dead_letters.sqlite'))
+    yield store
+    store.close()
+
+
+def test_repeated_failure_updates_entry(store):
+    store.add('movies', 'transform', [('1', 'bad title', None)])
+    store.add('movies', 'load', [('1', {'type': 'mapper_parsing_exception',
+                                        'reason': 'failed'}, {'id': '1'})])
+    [entry] = store.entries('movies')
+    assert entry['stage'] == 'load'
+    assert entry['reason'] == 'mapper_parsing_exception: failed'
+    assert entry['attempts'] == 2
+
+
+def test_bulk_failures_keep_document(store):
+    body = (b'{"index":{"_index":"movies","_id":"1"}}\n{"id":"1"}\n'
+            b'{"index":{"_index":"movies","_id":"2"}}\n{"id":"2"}\n')
+    assert [source for *_, source in iter_bulk_sources(body)] == [
+        b'{"id":"1"}', b'{"id":"2"}']
+    store.add_bulk_failures(body, [{'_index': 'movies', '_id': '2',
+                                    'status': 400,
+                                    'error': {'type': 'x', 'reason': 'y'}}])
+    assert store.ids('movies') == ['2']
+    payload = store._conn.execute(
+        'SELECT payload FROM dead_letters').fetchone()[0]
+    assert orjson.loads(payload) == {'id': '2'}
+
+
+def test_replay_resolves_only_loaded_documents(store, monkeypatch):
+    store.add('movies', 'transform', [('1', 'bad', None), ('2', 'bad', None)])
+    time.sleep(0.01)
+
+    def fail_second(batch):
+        # Фильм 2 снова не прошёл преобразование и вернулся в очередь
+        store.add('movies', 'transform', [('2', 'still bad', None)])
+        return batch
+
+    import stages
+    monkeypatch.setattr(stages, 'merge_batch', lambda merger, batch: batch)
+    monkeypatch.setattr(stages, 'transform_batch',
+                        lambda merger, batch: fail_second(batch))
+    monkeypatch.setattr(stages, 'load_batch', lambda loader, batch: batch)
+
+    class Loader:
+        fingerprints = None
+
+    resolved = replay(store, 'movies', ['1', '2'], None, None, Loader())
+    assert resolved == 1
+    [entry] = store.entries('movies')
+    assert entry['id'] == '2' and entry['attempts'] == 2
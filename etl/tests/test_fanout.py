@@ -0,0 +1,72 @@
+from fanout import FanOut, FanOutJob
+from stages import checkpoint_batch, extract_chunk
+from state_manager import Cursor, SQLiteStorage, State
+
+UPDATED_AT = '2024-01-01T00:00:00+00:00'
+
+
+class Producer:
+    """
+    Одна страница изменений жанров, дальше пусто
+    """
+
+    def __init__(self):
+        self.pages = [[{'id': 'g1', 'updated_at': UPDATED_AT}]]
+
+    def fetch_updated(self, stream, cursor=None):
+        return self.pages.pop(0) if self.pages else []
+
+
+class Inricher:
+    """
+    Пять связанных фильмов с id '1'..'5' по порядку
+    """
+
+    def fetch_related_page(self, stream, ids, after, limit):
+        start = int(after.id) if after.id else 0
+        return [{'id': str(film), 'updated_at': UPDATED_AT}
+                for film in range(start + 1, min(start + limit, 5) + 1)]
+
+
+def make_state():
+    return State(SQLiteStorage(':memory:'))
+
+
+def test_next_chunk_is_resumable():
+    state = make_state()
+    fanout = FanOut(Inricher(), state, chunk_size=2)
+    job = FanOutJob('genre', ['g1'], Cursor(UPDATED_AT, 'g1'))
+    assert fanout.next_chunk(job) == ['1', '2']
+    fanout.save(job)
+    assert fanout.has_pending('genre')
+
+    # После перезапуска задание продолжается с подкурсора
+    resumed = FanOut(Inricher(), state, chunk_size=2).pending('genre')
+    assert resumed.after == Cursor(UPDATED_AT, '2')
+    assert fanout.next_chunk(resumed) == ['3', '4']
+    assert fanout.next_chunk(resumed) == ['5']
+    assert resumed.done
+    fanout.save(resumed)
+    assert fanout.pending('genre') is None
+
+
+def test_pipeline_chunks_checkpoint_their_own_subcursor():
+    state = make_state()
+    fanout = FanOut(Inricher(), state, chunk_size=2)
+    producer = Producer()
+    jobs = {'genre': fanout.pending('genre')}
+    # Источник конвейера уходит вперёд, пока чекпоинты не записаны
+    batches = []
+    while batch := extract_chunk(producer, fanout, jobs, 'genre'):
+        batches.append(batch)
+    assert [batch.film_ids for batch in batches] == [['1', '2'], ['3', '4'],
+                                                     ['5']]
+
+    checkpoint_batch(state, fanout, batches[0])
+    assert state.get_state('fanout_genre')['after'] == [UPDATED_AT, '2']
+    assert state.get_cursor('genre') == Cursor(None, None)
+    checkpoint_batch(state, fanout, batches[1])
+    assert state.get_state('fanout_genre')['after'] == [UPDATED_AT, '4']
+    checkpoint_batch(state, fanout, batches[2])
+    assert state.get_state('fanout_genre') is None
+    assert state.get_cursor('genre') == Cursor(UPDATED_AT, 'g1')
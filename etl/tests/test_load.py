@@ -0,0 +1,93 @@
+import threading
+
+import orjson
+import pytest
+
+from deadletter import DeadLetterStore
+from load import ElasticsearchLoader
+
+DOCUMENTS = [{'id': str(doc_id), 'title': f'Film {doc_id}'}
+             for doc_id in range(1, 6)]
+
+
+class FakeElasticsearch:
+    """
+    bulk, отвечающий ошибками из errors: id -> список статусов
+    по попыткам, остальные документы принимаются
+    """
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.requests = []
+        self.indexed = []
+        self._lock = threading.Lock()
+
+    def bulk(self, operations):
+        lines = operations.splitlines()
+        actions = [orjson.loads(line)['index'] for line in lines[::2]]
+        items = []
+        with self._lock:
+            self.requests.append([action['_id'] for action in actions])
+            for action in actions:
+                statuses = self.errors.get(action['_id'])
+                status = statuses.pop(0) if statuses else 201
+                result = {'_index': action['_index'], '_id': action['_id'],
+                          'status': status}
+                if status >= 400:
+                    result['error'] = {'type': f'error_{status}',
+                                       'reason': 'failed'}
+                else:
+                    self.indexed.append(action['_id'])
+                items.append({'index': result})
+        return {'errors': any('error' in item['index'] for item in items),
+                'items': items}
+
+
+def make_loader(es, **kwargs):
+    loader = ElasticsearchLoader('http://localhost:9200', chunk_size=2,
+                                 initial_backoff=0, **kwargs)
+    loader.es = es
+    return loader
+
+
+@pytest.fixture
+def dead_letters(tmp_path):
+    store = DeadLetterStore(str(tmp_path / 'dead_letters.sqlite'))
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize('mode, requests', [('simple', 1), ('streaming', 3)])
+def test_modes_load_the_same_documents(mode, requests):
+    es = FakeElasticsearch()
+    loader = make_loader(es, mode=mode)
+    assert loader.bulk_load('movies', DOCUMENTS) == len(DOCUMENTS)
+    assert sorted(es.indexed) == [doc['id'] for doc in DOCUMENTS]
+    assert len(es.requests) == requests
+
+
+def test_streaming_retries_only_rejected_documents():
+    es = FakeElasticsearch({'2': [429]})
+    loader = make_loader(es, mode='streaming', concurrency=1)
+    assert loader.bulk_load('movies', DOCUMENTS) == len(DOCUMENTS)
+    assert es.requests[:2] == [['1', '2'], ['2']]
+    report = loader.last_report
+    assert (report.rejected, report.retried, report.failed) == (1, 1, [])
+
+
+def test_simple_retries_whole_request_on_rejection():
+    es = FakeElasticsearch({'2': [429]})
+    loader = make_loader(es, mode='simple')
+    assert loader.bulk_load('movies', DOCUMENTS) == len(DOCUMENTS)
+    assert es.requests == [[doc['id'] for doc in DOCUMENTS]] * 2
+
+
+@pytest.mark.parametrize('mode', ['simple', 'streaming'])
+def test_failed_documents_go_to_dead_letters(mode, dead_letters):
+    es = FakeElasticsearch({'2': [400]})
+    loader = make_loader(es, mode=mode, dead_letters=dead_letters)
+    # Ошибка, которую повтор не исправит, не задерживает остальные
+    assert loader.bulk_load('movies', DOCUMENTS) == len(DOCUMENTS) - 1
+    assert [doc_id for doc_id, _ in loader.last_report.failed] == ['2']
+    assert dead_letters.ids('movies') == ['2']
+    assert len(es.requests) == (1 if mode == 'simple' else 3)
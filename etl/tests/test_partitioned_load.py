@@ -0,0 +1,33 @@
+import uuid
+
+import pytest
+
+from partitioned_load import partition_bounds
+
+
+def in_range(value, after_id, before_id):
+    return ((after_id is None or value > uuid.UUID(after_id))
+            and (before_id is None or value < uuid.UUID(before_id)))
+
+
+def test_single_partition_is_unbounded():
+    assert partition_bounds(1) == [(None, None)]
+
+
+@pytest.mark.parametrize('count', [2, 3, 7, 16])
+def test_partitions_cover_uuid_space_once(count):
+    bounds = partition_bounds(count)
+    assert len(bounds) == count
+    assert bounds[0][0] is None
+    assert bounds[-1][1] is None
+    samples = [uuid.UUID(int=0), uuid.UUID(int=2 ** 128 - 1)]
+    for after_id, before_id in bounds:
+        # Граница и соседние с ней id попадают ровно в одну партицию
+        for edge in (after_id, before_id):
+            if edge is not None:
+                value = uuid.UUID(edge).int
+                samples.extend(uuid.UUID(int=v)
+                               for v in (value - 1, value, value + 1))
+    for sample in samples:
+        matches = [bound for bound in bounds if in_range(sample, *bound)]
+        assert len(matches) == 1, sample
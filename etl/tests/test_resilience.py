@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import pytest
+
+import resilience
+from resilience import is_pressure, is_retryable
+
+
+def test_sync_modules_work_without_asyncpg():
+    # asyncpg нужен только асинхронному движку
+    code = ("import sys; sys.modules['asyncpg'] = None; "
+            "import resilience, utils, load, extract")
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=resilience.__file__.rsplit('/', 1)[0])
+
+
+def test_asyncpg_errors_are_classified_by_class():
+    asyncpg = pytest.importorskip('asyncpg')
+    assert not is_retryable(asyncpg.UndefinedTableError('no table'))
+    assert not is_retryable(asyncpg.InvalidTextRepresentationError('uuid'))
+    assert is_pressure(asyncpg.QueryCanceledError('timeout'))
+    assert is_pressure(asyncpg.TooManyConnectionsError('full'))
+    assert is_retryable(asyncpg.ConnectionDoesNotExistError('closed'))
+    assert not is_pressure(asyncpg.ConnectionDoesNotExistError('closed'))
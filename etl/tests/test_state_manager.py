@@ -0,0 +1,85 @@
+import pytest
+
+from state_manager import (Cursor, JsonFileStorage, SQLiteStorage, State,
+                           RedisStorage)
+
+OLD = Cursor('2024-01-01T00:00:00+00:00',
+             '00000000-0000-0000-0000-000000000001')
+NEW = Cursor('2024-01-02T00:00:00+00:00',
+             '00000000-0000-0000-0000-000000000002')
+
+
+@pytest.fixture
+def sqlite_storage():
+    storage = SQLiteStorage(':memory:')
+    yield storage
+    storage.close()
+
+
+@pytest.fixture
+def redis_storage():
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisStorage(client=fakeredis.FakeRedis())
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def shared_storage(request):
+    return request.getfixturevalue(f'{request.param}_storage')
+
+
+def test_json_storage_roundtrip(tmp_path):
+    storage = JsonFileStorage(str(tmp_path / 'state.json'))
+    assert storage.retrieve_state() == {}
+    storage.update_state({'a': 1})
+    storage.update_state({'b': [1, 2]})
+    assert storage.retrieve_state() == {'a': 1, 'b': [1, 2]}
+    # Временные файлы атомарной записи не остаются
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'state.json', 'state.json.lock']
+
+
+def test_json_storage_cursor_can_regress(tmp_path):
+    # JSON-файл рассчитан на один процесс: курсор пишется как есть
+    state = State(JsonFileStorage(str(tmp_path / 'state.json')))
+    state.set_cursor('film', NEW)
+    state.set_cursor('film', OLD)
+    assert State(state.storage).get_cursor('film') == OLD
+
+
+def test_json_storage_compare_and_set(tmp_path):
+    storage = JsonFileStorage(str(tmp_path / 'state.json'))
+    storage.update_state({'key': 1})
+    assert not storage.compare_and_set({'key': 2}, {'key': 3})
+    assert storage.compare_and_set({'key': 1}, {'key': 3})
+    assert storage.retrieve_state() == {'key': 3}
+
+
+def test_shared_storage_compare_and_set(shared_storage):
+    shared_storage.update_state({'key': 1, 'other': 'x'})
+    assert not shared_storage.compare_and_set({'key': 2}, {'key': 3})
+    assert shared_storage.compare_and_set({'key': 1}, {'key': 3})
+    assert shared_storage.compare_and_set({'missing': None},
+                                          {'missing': 'set'})
+    assert shared_storage.retrieve_state() == {'key': 3, 'other': 'x',
+                                               'missing': 'set'}
+
+
+def test_shared_storage_cursor_only_moves_forward(shared_storage):
+    first, second = State(shared_storage), State(shared_storage)
+    assert first.advance_cursor('film', NEW)
+    # Второй процесс со старым курсором не откатывает первый
+    assert not second.advance_cursor('film', OLD)
+    assert second.get_cursor('film') == NEW
+    second.set_cursors({'film': OLD, 'person': OLD})
+    stored = State(shared_storage)
+    assert stored.get_cursor('film') == NEW
+    assert stored.get_cursor('person') == OLD
+
+
+def test_state_flush_interval(sqlite_storage):
+    state = State(sqlite_storage, flush_interval=3600)
+    state.set_state('key', 'value')
+    assert state.get_state('key') == 'value'
+    assert sqlite_storage.retrieve_state() == {}
+    state.flush()
+    assert sqlite_storage.retrieve_state() == {'key': 'value'}
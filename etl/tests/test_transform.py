@@ -0,0 +1,63 @@
+import json
+
+from transform import (transform_film_work_details,
+                       transform_film_work_details_legacy, transform_merged)
+
+FILM_ID = '00000000-0000-0000-0000-000000000001'
+
+
+def flat_row(role, person_id, full_name, genre, fw_id=FILM_ID):
+    return {'fw_id': fw_id, 'title': 'Film', 'description': None,
+            'rating': 7.5, 'role': role, 'person_id': person_id,
+            'full_name': full_name, 'name': genre}
+
+
+def test_matches_legacy_transform():
+    other_id = '00000000-0000-0000-0000-000000000002'
+    rows = [flat_row(role, person_id, name, genre)
+            for role, person_id, name in (('actor', 'p1', 'Ann'),
+                                          ('writer', 'p1', 'Ann'),
+                                          ('director', 'p1', 'Ann'),
+                                          ('actor', 'p2', 'Bob'),
+                                          ('writer', 'p3', 'Bob'))
+            for genre in ('Comedy', 'Drama')]
+    # Повторы строк и фильм без режиссёра и жанров
+    rows += rows[:3]
+    rows += [flat_row('actor', 'p4', 'Cid', None, other_id),
+             flat_row('actor', 'p4', 'Cid', None, other_id)]
+    # Исходная реализация сохраняет порядок строк, поэтому строки
+    # идут в порядке, в котором списки уже отсортированы
+    rows.sort(key=lambda row: (row['fw_id'], row['full_name'],
+                               row['person_id'], row['name'] or ''))
+
+    legacy = transform_film_work_details_legacy(rows)
+    current = transform_film_work_details(list(reversed(rows)))
+    assert json.dumps(sorted(current, key=lambda doc: doc['id'])) == \
+        json.dumps(legacy)
+    assert [doc['director'] for doc in legacy] == ['Ann', '']
+    assert legacy[0]['writers_names'] == ['Ann', 'Bob']
+
+
+def test_flat_and_aggregated_modes_agree_on_order():
+    # Порядок строк JOIN и сортировка в Postgres не влияют на документ
+    flat = [flat_row(role, person_id, name, genre)
+            for role, person_id, name in (('writer', 'w2', 'Bob'),
+                                          ('actor', 'a2', 'Zoe'),
+                                          ('actor', 'a1', 'Ann'),
+                                          ('writer', 'w1', 'Bob'),
+                                          ('director', 'd1', 'Dan'))
+            for genre in ('Drama', 'Comedy')]
+    aggregated = [{'fw_id': FILM_ID, 'title': 'Film', 'description': None,
+                   'rating': 7.5, 'genres': ['Drama', 'Comedy'],
+                   'director': 'Dan',
+                   'actors': [{'id': 'a2', 'name': 'Zoe'},
+                              {'id': 'a1', 'name': 'Ann'}],
+                   'writers': [{'id': 'w2', 'name': 'Bob'},
+                               {'id': 'w1', 'name': 'Bob'}]}]
+
+    [document] = transform_merged(flat, 'flat')
+    assert transform_merged(aggregated, 'aggregated') == [document]
+    assert document['genre'] == ['Comedy', 'Drama']
+    assert [actor['id'] for actor in document['actors']] == ['a1', 'a2']
+    assert [writer['id'] for writer in document['writers']] == ['w1', 'w2']
+    assert document['writers_names'] == ['Bob']
@@ -0,0 +1,72 @@
+import uuid
+
+from verify import DriftVerifier, document_hash, hash_value, prefix_bounds
+
+
+class FakeChecksums:
+    """
+    Контрольные суммы по словарю id -> хэш, как у обеих сторон
+    """
+
+    def __init__(self, hashes):
+        self._hashes = hashes
+        self.requested = []
+
+    def hashes(self, prefix):
+        self.requested.append(prefix)
+        return {film_id: digest for film_id, digest in self._hashes.items()
+                if film_id.startswith(prefix)}
+
+    def buckets(self, prefix, depth):
+        buckets = {}
+        for film_id, digest in self.hashes(prefix).items():
+            count, checksum = buckets.get(film_id[:depth], (0, 0))
+            buckets[film_id[:depth]] = (count + 1,
+                                        checksum + hash_value(digest))
+        return buckets
+
+
+def film_ids(count):
+    return [str(uuid.UUID(int=(k * 7919 + 1) << 100)) for k in range(count)]
+
+
+def test_prefix_bounds():
+    assert prefix_bounds('') == (str(uuid.UUID(int=0)), None)
+    assert prefix_bounds('ff') == ('ff000000-0000-0000-0000-000000000000',
+                                   None)
+    assert prefix_bounds('0a') == ('0a000000-0000-0000-0000-000000000000',
+                                   '0b000000-0000-0000-0000-000000000000')
+
+
+def test_matching_sides_compare_no_films():
+    hashes = {film_id: 'a' * 32 for film_id in film_ids(50)}
+    verifier = DriftVerifier(FakeChecksums(hashes), FakeChecksums(hashes),
+                             depth=1, leaf_size=5)
+    report = verifier.verify()
+    assert report.compared == 0
+    assert report.drifted == [] and report.extra == []
+
+
+def test_drift_found_by_bucket_recursion():
+    ids = film_ids(200)
+    expected = {film_id: 'a' * 32 for film_id in ids}
+    actual = dict(expected)
+    actual[ids[3]] = 'b' * 32
+    del actual[ids[10]]
+    actual['f' * 8 + '-0000-0000-0000-000000000000'] = 'c' * 32
+    postgres, elasticsearch = FakeChecksums(expected), FakeChecksums(actual)
+
+    report = DriftVerifier(postgres, elasticsearch, depth=1,
+                           leaf_size=2).verify()
+    assert sorted(report.drifted) == sorted([ids[3], ids[10]])
+    assert report.extra == ['f' * 8 + '-0000-0000-0000-000000000000']
+    # Поштучно сравниваются только расходящиеся корзины
+    assert report.compared < len(ids)
+
+
+def test_person_without_name_hashes_as_empty():
+    # В FILM_HASHES_QUERY имя NULL превращается в пустую строку
+    document = {'id': '1', 'title': 'A',
+                'actors': [{'id': '2', 'name': None}]}
+    assert document_hash(document) == document_hash(
+        dict(document, actors=[{'id': '2', 'name': ''}]))
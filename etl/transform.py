@@ -1,7 +1,8 @@
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, TypeAdapter, ValidationError
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 from collections import defaultdict
+from itertools import islice
 
 logger = logging.getLogger('transform')
 
@@ -29,9 +30,123 @@ class FilmWork(BaseModel):
     writers: List[Writer]
 
 
-def transform_film_work_details(film_work_data: List) -> List[Dict[str, Any]]:
+# Валидатор всей пачки документов за один вызов
+FILM_WORKS_ADAPTER = TypeAdapter(List[FilmWork])
+
+# Фильм, не прошедший валидацию: (id, причина)
+Rejected = Tuple[str, str]
+
+
+def max_director(current: Optional[str], full_name: Optional[str]
+                 ) -> Optional[str]:
     """
-    Преобразование данных о фильмах
+    Режиссёр фильма с несколькими режиссёрами - наибольшее имя
+    по кодовым точкам, как max(full_name COLLATE "C") в SQL
+    режима aggregated и в проверке verify.py
+    """
+    if not current:
+        return full_name
+    if not full_name:
+        return current
+    return max(current, full_name)
+
+
+class _FilmAccumulator:
+    """
+    Накопитель документа одного фильма.
+
+    Множества просмотренных жанров и персон дают проверку вхождения
+    за O(1) вместо линейного поиска по спискам документа. Списки
+    сортируются в document(), как в режиме aggregated.
+    """
+    __slots__ = ('doc', 'genres', 'actor_ids', 'writer_ids')
+
+    def __init__(self, fw_id: str, rating: Optional[float], title: str,
+                 description: Optional[str]) -> None:
+        self.doc = {
+            'id': fw_id,
+            'imdb_rating': float(rating) if rating is not None else None,
+
+            'genre': [],
+            'title': title,
+            'description': description if description is not None else '',
+
+            'director': '',
+            'actors_names': [],
+            'writers_names': [],
+            'actors': [],
+            'writers': []
+        }
+        self.genres = set()
+        self.actor_ids = set()
+        self.writer_ids = set()
+
+    def add_genre(self, name: Optional[str]) -> None:
+        if name and name not in self.genres:
+            self.genres.add(name)
+            self.doc['genre'].append(name)
+
+    def add_person(self, role: Optional[str], person_id: str,
+                   full_name: Optional[str]) -> None:
+        if role == 'actor':
+            self._add(person_id, full_name, self.actor_ids, 'actors')
+        elif role == 'writer':
+            self._add(person_id, full_name, self.writer_ids, 'writers')
+        elif role == 'director':
+            self.doc['director'] = max_director(self.doc['director'],
+                                                full_name)
+
+    def document(self) -> Dict[str, Any]:
+        doc = self.doc
+        if not doc['director']:
+            doc['director'] = ''
+        doc['genre'].sort()
+        doc['actors'].sort(key=_person_key)
+        doc['writers'].sort(key=_person_key)
+        doc['actors_names'] = _unique_names(doc['actors'])
+        doc['writers_names'] = _unique_names(doc['writers'])
+        return doc
+
+    def _add(self, person_id, full_name, seen_ids, persons_key) -> None:
+        if person_id not in seen_ids:
+            seen_ids.add(person_id)
+            self.doc[persons_key].append({'id': person_id,
+                                          'name': full_name})
+
+
+def transform_film_work_details(
+        film_work_data: List,
+        validation: str = 'document',
+        rejected: Optional[List[Rejected]] = None) -> List[Dict[str, Any]]:
+    """
+    Преобразование данных о фильмах за один линейный проход
+    """
+    film_works: Dict[str, _FilmAccumulator] = {}
+
+    for entry in film_work_data:
+        fw_id = entry['fw_id']
+        accumulator = film_works.get(fw_id)
+        if accumulator is None:
+            accumulator = film_works[fw_id] = _FilmAccumulator(
+                fw_id, entry['rating'], entry['title'],
+                entry['description'])
+        accumulator.add_genre(entry['name'])
+        accumulator.add_person(entry['role'], str(entry['person_id']),
+                               entry['full_name'])
+
+    transformed_data = [accumulator.document()
+                        for accumulator in film_works.values()]
+
+    return validate_film_works(transformed_data, validation, rejected)
+
+
+def transform_film_work_details_legacy(
+        film_work_data: List) -> List[Dict[str, Any]]:
+    """
+    Исходная реализация преобразования данных о фильмах.
+
+    Оставлена для сравнения в бенчмарке benchmarks/bench_transform.py
+    и в tests/test_transform.py
     """
     transformed_data = []
     film_works = defaultdict(dict)
@@ -88,27 +203,205 @@ def transform_film_work_details(film_work_data: List) -> List[Dict[str, Any]]:
 
     # Валидация и преобразование
     for fw_id, film_work in film_works.items():
-        try:
+        if not film_work['director']:
+            film_work['director'] = ''
+        transformed_data.append(
+            _validate_film_work(fw_id, film_work, dump=True))
+
+    return transformed_data
+
+
+def transform_aggregated_film_work_details(
+        film_work_data: List,
+        validation: str = 'document',
+        rejected: Optional[List[Rejected]] = None) -> List[Dict[str, Any]]:
+    """
+    Преобразование данных о фильмах, агрегированных в Postgres
+    (одна строка на фильм)
+    """
+    transformed_data = [
+        _aggregated_document(entry['fw_id'], entry['rating'],
+                             entry['title'], entry['description'],
+                             entry['genres'], entry['director'],
+                             entry['actors'], entry['writers'])
+        for entry in film_work_data]
+
+    return validate_film_works(transformed_data, validation, rejected)
+
+
+def _aggregated_document(fw_id: str, rating: Optional[float], title: str,
+                         description: Optional[str], genres: List[str],
+                         director: Optional[str], actors: List[dict],
+                         writers: List[dict]) -> Dict[str, Any]:
+    # Порядок списков не зависит от сортировки в Postgres
+    actors = sorted(actors, key=_person_key)
+    writers = sorted(writers, key=_person_key)
+    return {
+        'id': fw_id,
+        'imdb_rating': float(rating) if rating is not None else None,
+
+        'genre': sorted(genres),
+        'title': title,
+        'description': description if description is not None else '',
+
+        'director': director or '',
+        'actors_names': _unique_names(actors),
+        'writers_names': _unique_names(writers),
+        'actors': actors,
+        'writers': writers
+    }
+
+
+def transform_merged(film_work_data: List,
+                     mode: str = 'flat',
+                     validation: str = 'document',
+                     rejected: Optional[List[Rejected]] = None
+                     ) -> List[Dict[str, Any]]:
+    """
+    Преобразование результата PostgresMerger в зависимости от его режима.
+
+    Со списком rejected фильмы, не прошедшие валидацию, не прерывают
+    пачку: они попадают в rejected и в результат не входят
+    """
+    if mode == 'aggregated':
+        return transform_aggregated_film_work_details(film_work_data,
+                                                      validation, rejected)
+    return transform_film_work_details(film_work_data, validation, rejected)
+
+
+def iter_film_work_documents(rows: Iterable,
+                             mode: str = 'flat',
+                             validation: str = 'document',
+                             batch_size: int = 500,
+                             rejected: Optional[List[Rejected]] = None
+                             ) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковое преобразование строк PostgresMerger.iter_* в документы.
+
+    Строки - namedtuple, строки одного фильма идут подряд, поэтому
+    документ отдаётся, как только начинается следующий фильм. В памяти
+    не больше batch_size документов: ими же идёт валидация. С rejected
+    невалидные документы пропускаются и переносятся туда с причиной
+    """
+    if mode == 'aggregated':
+        documents = (_aggregated_document(row.fw_id, row.rating, row.title,
+                                          row.description, row.genres,
+                                          row.director, row.actors,
+                                          row.writers)
+                     for row in rows)
+    else:
+        documents = _iter_flat_documents(rows)
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            return
+        yield from validate_film_works(batch, validation, rejected)
+
 
-            if not film_work['director']:
-                film_work['director'] = ''
+def _iter_flat_documents(rows: Iterable) -> Iterator[Dict[str, Any]]:
+    accumulator = None
+    for row in rows:
+        if accumulator is None or accumulator.doc['id'] != row.fw_id:
+            if accumulator is not None:
+                yield accumulator.document()
+            accumulator = _FilmAccumulator(row.fw_id, row.rating,
+                                           row.title, row.description)
+        accumulator.add_genre(row.name)
+        accumulator.add_person(row.role, str(row.person_id), row.full_name)
+    if accumulator is not None:
+        yield accumulator.document()
+
+
+def validate_film_works(film_works: List[Dict[str, Any]],
+                        validation: str = 'document',
+                        rejected: Optional[List[Rejected]] = None
+                        ) -> List[Dict[str, Any]]:
+    """
+    Валидация пачки документов.
+
+    document - каждый документ отдельно через FilmWork,
+    batch - вся пачка одним вызовом TypeAdapter(List[FilmWork]),
+    debug - пачкой и только при уровне логирования DEBUG.
+    Документы возвращаются как есть, без повторной сборки словарей.
+    Без rejected ошибка валидации пробрасывается, с ним невалидные
+    документы переносятся туда с причиной
+    """
+    if validation == 'document':
+        if rejected is None:
+            for film_work in film_works:
+                _validate_film_work(film_work['id'], film_work)
+            return film_works
+        valid = []
+        for film_work in film_works:
+            try:
+                _validate_film_work(film_work['id'], film_work)
+            except ValidationError as e:
+                rejected.append((film_work['id'],
+                                 _validation_reason(e.errors())))
             else:
-                # Если у нас есть список режиссеров, преобразуем его в строку
-                film_work['director'] = film_work['director']
-
-            # Валидация данных с помощью Pydantic
-            validated_data = FilmWork.parse_obj(film_work)
-
-            # Добавление валидированных и преобразованных данных в список
-            transformed_data.append(validated_data.dict())
-        except ValidationError as e:
-            # Логирование ошибок валидации
-            logger.debug('Data validation error '
-                         'for film work ID %s: %s', fw_id, e)
-            raise e
-        except Exception as e:
-            # Логирование непредвиденных ошибок
-            logger.debug('Unexpected error for film work ID %s: %s', fw_id, e)
+                valid.append(film_work)
+        return valid
+    elif validation == 'batch' or (validation == 'debug'
+                                   and logger.isEnabledFor(logging.DEBUG)):
+        return _validate_batch(film_works, rejected)
+    return film_works
+
+
+def _person_key(person: Dict[str, Any]) -> Tuple[str, str]:
+    # Персоны по имени и id побайтно, как COLLATE "C" в verify.py
+    return person['name'] or '', person['id']
+
+
+def _unique_names(persons: List[Dict[str, Any]]) -> List[Optional[str]]:
+    # Имена без повторов в порядке появления
+    return list(dict.fromkeys(person['name'] for person in persons))
+
+
+def _validation_reason(errors: List[Dict[str, Any]]) -> str:
+    return '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                     for error in errors)
+
+
+def _validate_batch(film_works: List[Dict[str, Any]],
+                    rejected: Optional[List[Rejected]] = None
+                    ) -> List[Dict[str, Any]]:
+    try:
+        FILM_WORKS_ADAPTER.validate_python(film_works)
+    except ValidationError as e:
+        # Первый элемент loc - индекс документа в пачке
+        errors = defaultdict(list)
+        for error in e.errors():
+            errors[error['loc'][0]].append(
+                {**error, 'loc': error['loc'][1:]})
+        fw_ids = sorted(film_works[position]['id'] for position in errors)
+        logger.debug('Data validation error '
+                     'for film work IDs %s: %s', fw_ids, e)
+        if rejected is None:
             raise e
+        rejected.extend((film_works[position]['id'],
+                         _validation_reason(position_errors))
+                        for position, position_errors in errors.items())
+        return [film_work for position, film_work in enumerate(film_works)
+                if position not in errors]
+    return film_works
 
-    return transformed_data
+
+def _validate_film_work(fw_id: str,
+                        film_work: Dict[str, Any],
+                        dump: bool = False) -> Dict[str, Any]:
+    try:
+        # Валидация данных с помощью Pydantic
+        validated_data = FilmWork.model_validate(film_work)
+
+        # Документ уже имеет форму FilmWork, поэтому без dump
+        # возвращаем его как есть, не собирая словарь заново
+        return validated_data.model_dump() if dump else film_work
+    except ValidationError as e:
+        # Логирование ошибок валидации
+        logger.debug('Data validation error '
+                     'for film work ID %s: %s', fw_id, e)
+        raise e
+    except Exception as e:
+        # Логирование непредвиденных ошибок
+        logger.debug('Unexpected error for film work ID %s: %s', fw_id, e)
+        raise e
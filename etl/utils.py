@@ -1,17 +1,32 @@
+import asyncio
 import time
 from functools import wraps
 import logging
 import os
 import json
+import resource
+import sys
+from typing import Callable, Optional
+
+from metrics import count_retry
+from resilience import (CircuitBreaker, get_breaker, is_retryable,
+                        jittered_delay)
 
 logger = logging.getLogger(__name__)
 
 
 def backoff(start_sleep_time: float = 0.1,
             factor: int = 2,
-            border_sleep_time: int = 10) -> callable:
+            border_sleep_time: int = 10,
+            breaker: Optional[str] = None) -> callable:
     """
-    Функция для реализации backoff
+    Функция для реализации backoff.
+
+    Пауза растёт экспоненциально со случайным разбросом. Ошибки,
+    которые повтор не исправит (синтаксис SQL, 400 от Elasticsearch),
+    пробрасываются сразу. С breaker вызовы проходят через общий
+    предохранитель backend: пока он разомкнут, вызывающие ждут
+    вместо повторных запросов
     """
 
     def decorator(func):
@@ -19,20 +34,90 @@ def backoff(start_sleep_time: float = 0.1,
         def wrapper(*args, **kwargs):
             sleep_time = start_sleep_time
             while True:
+                circuit = get_breaker(breaker) if breaker else None
+                wait = circuit.retry_after() if circuit else 0
+                if wait:
+                    time.sleep(wait)
+                    continue
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    delay = retry_delay(func, e, circuit, sleep_time)
+                    time.sleep(delay)
+                    sleep_time = min(sleep_time * factor, border_sleep_time)
+                else:
+                    if circuit:
+                        circuit.record_success()
+                    return result
+
+        return wrapper
+
+    return decorator
+
+
+def async_backoff(start_sleep_time: float = 0.1,
+                  factor: int = 2,
+                  border_sleep_time: int = 10,
+                  breaker: Optional[str] = None) -> callable:
+    """
+    Функция для реализации backoff корутин: ожидание через
+    asyncio.sleep не блокирует цикл событий
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            sleep_time = start_sleep_time
+            while True:
+                circuit = get_breaker(breaker) if breaker else None
+                wait = circuit.retry_after() if circuit else 0
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
                 try:
-                    return func(*args, **kwargs)
+                    result = await func(*args, **kwargs)
                 except Exception as e:
-                    logger.info(f'Ошибка: {e}. '
-                                f'Повторное выполнение через '
-                                f'{sleep_time} секунд...')
-                    time.sleep(sleep_time)
+                    delay = retry_delay(func, e, circuit, sleep_time)
+                    await asyncio.sleep(delay)
                     sleep_time = min(sleep_time * factor, border_sleep_time)
+                else:
+                    if circuit:
+                        circuit.record_success()
+                    return result
 
         return wrapper
 
     return decorator
 
 
+def retry_delay(func: Callable, error: Exception,
+                circuit: Optional[CircuitBreaker],
+                sleep_time: float) -> float:
+    """
+    Учёт ошибки в предохранителе и пауза перед повтором;
+    ошибка, которую повтор не исправит, пробрасывается
+    """
+    if circuit:
+        circuit.record_error(error)
+    if not is_retryable(error):
+        raise error
+    count_retry(func.__qualname__)
+    delay = jittered_delay(sleep_time)
+    logger.info(f'Ошибка: {error}. '
+                f'Повторное выполнение через '
+                f'{delay:.2f} секунд...')
+    return delay
+
+
+def peak_rss_mb() -> float:
+    """
+    Пиковый RSS текущего процесса, МБ (ru_maxrss: КБ в Linux,
+    байты в macOS)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
 def create_etl_state_json(file_path: str):
     # Проверяем, существует ли файл
     if not os.path.isfile(file_path):
@@ -0,0 +1,348 @@
+"""
+Проверка расхождений индекса movies с content.film_work.
+
+Фильмы делятся на корзины по префиксу id. Для каждой корзины обе
+стороны считают число фильмов и контрольную сумму их содержимого:
+Postgres - агрегатами SQL, Elasticsearch - по хэшам _source.
+Совпавшие корзины пропускаются, несовпавшие делятся на 16 более
+мелких. Когда корзина становится достаточно маленькой, фильмы
+сравниваются поштучно. С --repair расходящиеся фильмы
+переиндексируются, с --delete-extra из индекса удаляются фильмы,
+которых нет в Postgres. Запуск из каталога etl:
+
+    python verify.py
+    python verify.py --repair --delete-extra
+
+Фильмы, изменённые во время проверки, могут попасть в расхождения;
+повторная загрузка для них безвредна.
+"""
+import argparse
+import hashlib
+import logging
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+
+from deadletter import configure_dead_letters, get_dead_letters
+from extract import PostgresBase, PostgresMerger
+from load import ElasticsearchLoader
+from transform import transform_merged
+
+logger = logging.getLogger('verify')
+
+# Разделители полей и элементов списков в каноническом виде фильма
+FIELD_SEPARATOR = '\x1f'
+ITEM_SEPARATOR = '\x1e'
+
+# Канонический вид фильма и его md5. Списки сортируются побайтно
+# (COLLATE "C"), как sorted() в Python; режиссёр - max(), как в
+# AGGREGATED_DETAILS_QUERY
+FILM_HASHES_QUERY = '''
+    SELECT
+        fw.id::text as id,
+        md5(concat_ws(E'\\x1f',
+            fw.id::text,
+            fw.title,
+            COALESCE(fw.description, ''),
+            COALESCE(fw.rating::text, ''),
+            COALESCE(g.genres, ''),
+            COALESCE(p.director, ''),
+            COALESCE(p.actors, ''),
+            COALESCE(p.writers, ''))) as hash
+    FROM content.film_work fw
+    LEFT JOIN LATERAL (
+        SELECT string_agg(gn.name, E'\\x1e' ORDER BY gn.name COLLATE "C")
+            as genres
+        FROM (
+            SELECT DISTINCT g.name
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id AND g.name <> ''
+        ) gn
+    ) g ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT
+            string_agg(pr.entry, E'\\x1e' ORDER BY pr.entry COLLATE "C")
+                FILTER (WHERE pr.role = 'actor') as actors,
+            string_agg(pr.entry, E'\\x1e' ORDER BY pr.entry COLLATE "C")
+                FILTER (WHERE pr.role = 'writer') as writers,
+            max(pr.full_name COLLATE "C")
+                FILTER (WHERE pr.role = 'director') as director
+        FROM (
+            SELECT DISTINCT pfw.role, p.full_name,
+                            p.id::text || ':' || COALESCE(p.full_name, '')
+                                as entry
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ) pr
+    ) p ON TRUE
+    WHERE fw.id >= %s::uuid AND (%s::uuid IS NULL OR fw.id < %s::uuid)
+'''
+
+# Число фильмов и сумма первых 60 бит md5 по корзинам префикса
+BUCKETS_QUERY = '''
+    SELECT
+        substr(films.id, 1, %s) as bucket,
+        count(*) as count,
+        sum(('x' || substr(films.hash, 1, 15))::bit(60)::bigint) as checksum
+    FROM ({films}) films
+    GROUP BY 1;
+'''.format(films=FILM_HASHES_QUERY)
+
+# Поля документа, входящие в контрольную сумму
+CHECKSUM_FIELDS = ['id', 'title', 'description', 'imdb_rating', 'genre',
+                   'director', 'actors', 'writers']
+
+# Префикс id не длиннее первой группы UUID (до дефиса)
+MAX_DEPTH = 8
+
+# Сводка корзины: (число фильмов, контрольная сумма)
+Bucket = Tuple[int, int]
+
+
+def format_rating(rating: Optional[float]) -> str:
+    """
+    Рейтинг как float8::text в Postgres: 8.5, но 8 вместо 8.0
+    """
+    if rating is None:
+        return ''
+    text = repr(float(rating))
+    return text[:-2] if text.endswith('.0') else text
+
+
+def document_hash(document: Dict[str, Any]) -> str:
+    """
+    md5 канонического вида документа, тот же, что в FILM_HASHES_QUERY
+    """
+    def persons(key: str) -> str:
+        return ITEM_SEPARATOR.join(sorted(
+            {f'{person["id"]}:{person["name"] or ""}'
+             for person in document.get(key) or []}))
+
+    fields = [
+        str(document['id']),
+        document.get('title') or '',
+        document.get('description') or '',
+        format_rating(document.get('imdb_rating')),
+        ITEM_SEPARATOR.join(sorted(set(document.get('genre') or []))),
+        document.get('director') or '',
+        persons('actors'),
+        persons('writers'),
+    ]
+    return hashlib.md5(FIELD_SEPARATOR.join(fields).encode()).hexdigest()
+
+
+def hash_value(digest: str) -> int:
+    # Первые 60 бит, как ('x' || substr(hash, 1, 15))::bit(60)::bigint
+    return int(digest[:15], 16)
+
+
+def prefix_bounds(prefix: str) -> Tuple[str, Optional[str]]:
+    """
+    Полуинтервал UUID [low, high) с данным шестнадцатеричным
+    префиксом; high = None - до конца пространства
+    """
+    bits = 4 * len(prefix)
+    start = int(prefix, 16) << (128 - bits) if prefix else 0
+    end = start + (1 << (128 - bits))
+    high = str(uuid.UUID(int=end)) if end < 2 ** 128 else None
+    return str(uuid.UUID(int=start)), high
+
+
+@dataclass
+class DriftReport:
+    """
+    Итоги проверки: drifted - фильмы, которых нет в индексе или
+    которые в нём устарели, extra - документы без фильма в Postgres
+    """
+    buckets: int = 0
+    compared: int = 0
+    drifted: List[str] = field(default_factory=list)
+    extra: List[str] = field(default_factory=list)
+
+
+class PostgresChecksums(PostgresBase):
+    """
+    Контрольные суммы фильмов на стороне Postgres
+    """
+
+    def buckets(self, prefix: str, depth: int) -> Dict[str, Bucket]:
+        low, high = prefix_bounds(prefix)
+        rows = self._fetch_data(BUCKETS_QUERY, (depth, low, high, high))
+        return {row['bucket']: (row['count'], int(row['checksum']))
+                for row in rows}
+
+    def hashes(self, prefix: str) -> Dict[str, str]:
+        low, high = prefix_bounds(prefix)
+        rows = self._fetch_data(FILM_HASHES_QUERY, (low, high, high))
+        return {row['id']: row['hash'] for row in rows}
+
+
+class ElasticsearchChecksums:
+    """
+    Контрольные суммы документов индекса по _source
+    """
+
+    def __init__(self, es: Elasticsearch, index: str = 'movies',
+                 scroll_size: int = 1000) -> None:
+        self.es = es
+        self.index = index
+        self.scroll_size = scroll_size
+
+    def iter_hashes(self, prefix: str) -> Iterator[Tuple[str, str]]:
+        low, high = prefix_bounds(prefix)
+        bounds = {'gte': low}
+        if high is not None:
+            bounds['lt'] = high
+        for hit in scan(self.es, index=self.index, size=self.scroll_size,
+                        _source=CHECKSUM_FIELDS,
+                        query={'query': {'range': {'id': bounds}}}):
+            yield hit['_id'], document_hash(hit['_source'])
+
+    def buckets(self, prefix: str, depth: int) -> Dict[str, Bucket]:
+        buckets: Dict[str, Bucket] = {}
+        for doc_id, digest in self.iter_hashes(prefix):
+            count, checksum = buckets.get(doc_id[:depth], (0, 0))
+            buckets[doc_id[:depth]] = (count + 1,
+                                       checksum + hash_value(digest))
+        return buckets
+
+    def hashes(self, prefix: str) -> Dict[str, str]:
+        return dict(self.iter_hashes(prefix))
+
+
+class DriftVerifier:
+    """
+    Поиск расхождений рекурсивным сравнением корзин.
+
+    Корзина не больше leaf_size фильмов сравнивается поштучно,
+    большая делится на 16 корзин следующего уровня
+    """
+
+    def __init__(self, postgres: PostgresChecksums,
+                 elasticsearch: ElasticsearchChecksums,
+                 depth: int = 2, leaf_size: int = 1000) -> None:
+        self.postgres = postgres
+        self.elasticsearch = elasticsearch
+        self.depth = depth
+        self.leaf_size = leaf_size
+
+    def verify(self) -> DriftReport:
+        report = DriftReport()
+        self._verify_prefix('', self.depth, report)
+        logger.info('Checked %s buckets, compared %s films one by one: '
+                    '%s drifted, %s extra', report.buckets,
+                    report.compared, len(report.drifted),
+                    len(report.extra))
+        return report
+
+    def _verify_prefix(self, prefix: str, depth: int,
+                       report: DriftReport) -> None:
+        expected = self.postgres.buckets(prefix, depth)
+        actual = self.elasticsearch.buckets(prefix, depth)
+        report.buckets += len(expected.keys() | actual.keys())
+        for bucket in sorted(expected.keys() | actual.keys()):
+            pg = expected.get(bucket, (0, 0))
+            es = actual.get(bucket, (0, 0))
+            if pg == es:
+                continue
+            logger.debug('Bucket %s differs: %s films in Postgres, '
+                         '%s in Elasticsearch', bucket, pg[0], es[0])
+            if max(pg[0], es[0]) <= self.leaf_size or depth >= MAX_DEPTH:
+                self._compare_films(bucket, report)
+            else:
+                self._verify_prefix(bucket, depth + 1, report)
+
+    def _compare_films(self, prefix: str, report: DriftReport) -> None:
+        expected = self.postgres.hashes(prefix)
+        actual = self.elasticsearch.hashes(prefix)
+        report.compared += len(expected.keys() | actual.keys())
+        report.drifted.extend(sorted(
+            film_id for film_id, digest in expected.items()
+            if actual.get(film_id) != digest))
+        report.extra.extend(sorted(actual.keys() - expected.keys()))
+
+
+def repair(report: DriftReport, merger: PostgresMerger,
+           es_loader: ElasticsearchLoader, index: str,
+           batch_size: int = 1000, delete_extra: bool = False,
+           validation: str = 'document') -> int:
+    """
+    Переиндексация расходящихся фильмов и, с delete_extra, удаление
+    лишних документов. Возвращает число загруженных документов
+    """
+    dead_letters = get_dead_letters()
+    if es_loader.fingerprints is not None:
+        # Иначе загрузчик сочтёт документы неизменившимися
+        es_loader.fingerprints.forget(index, report.drifted)
+    total = 0
+    for start in range(0, len(report.drifted), batch_size):
+        ids = report.drifted[start:start + batch_size]
+        details = merger.fetch_film_work_details(ids)
+        # Как в transform_batch: не прошедшие валидацию фильмы
+        # откладываются в очередь недоставленных
+        rejected = [] if dead_letters is not None else None
+        documents = transform_merged(details, merger.mode, validation,
+                                     rejected)
+        if rejected:
+            dead_letters.add_rejected(details, rejected)
+        total += es_loader.bulk_load(index, documents)
+    if delete_extra and report.extra:
+        es_loader.es.bulk(operations=[
+            {'delete': {'_index': index, '_id': doc_id}}
+            for doc_id in report.extra])
+        if es_loader.fingerprints is not None:
+            es_loader.fingerprints.forget(index, report.extra)
+        logger.info('Deleted %s extra documents', len(report.extra))
+    logger.info('Re-indexed %s drifted films', total)
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--index', default='movies')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='длина префикса id на первом уровне')
+    parser.add_argument('--leaf-size', type=int, default=1000,
+                        help='корзины не больше этого сравниваются '
+                             'поштучно')
+    parser.add_argument('--repair', action='store_true',
+                        help='переиндексировать расходящиеся фильмы')
+    parser.add_argument('--delete-extra', action='store_true',
+                        help='удалить документы без фильма в Postgres')
+    args = parser.parse_args()
+
+    # Импорт внутри функции: settings читает настройки при импорте
+    from settings import (create_dead_letters, create_es_loader,
+                          create_fingerprints, etl_config, postgres_config,
+                          postgres_pool_config)
+    from pool import get_pool
+
+    pool = get_pool(postgres_config, **postgres_pool_config.dict())
+    es_loader = create_es_loader(fingerprints=create_fingerprints())
+    verifier = DriftVerifier(
+        PostgresChecksums(postgres_config, pool),
+        ElasticsearchChecksums(es_loader.es, args.index),
+        depth=min(args.depth, MAX_DEPTH), leaf_size=args.leaf_size)
+    report = verifier.verify()
+    for film_id in report.drifted[:20]:
+        logger.info('Drifted film %s', film_id)
+
+    if args.repair:
+        merger = PostgresMerger(postgres_config, pool,
+                                mode=etl_config.merger_mode)
+        configure_dead_letters(create_dead_letters())
+        repair(report, merger, es_loader, args.index,
+               etl_config.max_batch_size, args.delete_extra,
+               etl_config.validation)
+    elif report.drifted or report.extra:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()